@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for the download write path.
+
+Serves a synthetic file from a local HTTP server (in a child process, so its CPU time is not counted)
+and streams it to disk with the old 1 KB iter_content loop and with downloader.copy_stream.
+Reports throughput and client CPU-seconds per GB.
+
+usage: python benchmarks/bench_download.py [size_mb]
+"""
+import http.server
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from tqdm import tqdm
+
+from scripts import downloader
+
+BLOCK = os.urandom(1024 * 1024)
+
+def serve(size, port_queue):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *args):
+            pass
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remaining = size
+            while remaining:
+                n = min(remaining, len(BLOCK))
+                self.wfile.write(BLOCK[:n])
+                remaining -= n
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+def old_loop(response, f, progress):
+    for chunk in response.iter_content(chunk_size=1024):
+        if chunk:
+            f.write(chunk)
+            progress.update(len(chunk))
+
+def new_loop(response, f, progress):
+    downloader.copy_stream(response, f, on_progress=progress.update)
+
+def run(name, url, size, loop, buffering):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model.bin")
+        progress = tqdm(total=size, unit="B", unit_scale=True, leave=False, disable=True)
+        wall, cpu = time.perf_counter(), time.process_time()
+        with requests.get(url, stream=True) as response, open(path, "wb", buffering=buffering) as f:
+            loop(response, f, progress)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        assert os.path.getsize(path) == size
+    gb = size / 1024 ** 3
+    print(f"{name:<28} {size / wall / 1024 ** 2:10.1f} MB/s {cpu / gb:10.2f} CPU-s/GB")
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 512) * 1024 * 1024
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(size, port_queue), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{port_queue.get()}/model.safetensors"
+    try:
+        run("iter_content(1024)", url, size, old_loop, -1)
+        run(f"copy_stream({downloader.buffer_size // 1024 ** 2} MB readinto)", url, size, new_loop, 0)
+    finally:
+        server.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Memory benchmark for parsing CivitAI listing pages.
+
+Serves synthetic pages shaped like real API responses (long HTML descriptions, several versions,
+images with generation metadata) from a local HTTP server in a child process. Each page size and parser
+runs in a fresh process, which reports the peak RSS added by fetching and parsing the page and the RSS
+still held afterwards by the result:
+  json.loads        - the old path, response.text + json.loads, keeping the full object tree
+  parse_page        - records.parse_page over the response byte stream, keeping compact records
+  request_civit_api - the extension's own path: parse_page plus the API cache put (memory and the SQLite copy)
+                      and the search index update. Needs gradio (run it from the webui venv), skipped otherwise
+
+usage: python benchmarks/bench_parse.py [items ...]   (default: 50 100 500)
+"""
+import gc
+import http.server
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from scripts import records
+
+def make_item(rng, model_id):
+    words = ["lora", "anime", "portrait", "photorealistic", "style", "detailed", "lighting", "character", "landscape", "concept"]
+    text = lambda n: " ".join(rng.choice(words) for _ in range(n))
+    return {
+        "id": model_id, "name": f"{text(2).title()} {model_id}", "type": "LORA", "nsfw": rng.random() < 0.2, "poi": False,
+        "allowNoCredit": True, "allowCommercialUse": "Sell", "allowDerivatives": True,
+        "creator": {"username": f"user{rng.randrange(10000)}", "image": f"https://imagecache.civitai.com/{rng.getrandbits(64):x}.jpeg"},
+        "tags": [text(1) for _ in range(8)],
+        "description": "".join(f"<p>{text(40)}</p>" for _ in range(rng.randrange(10, 40))),
+        "stats": {"downloadCount": rng.randrange(10 ** 6), "favoriteCount": rng.randrange(10 ** 4), "commentCount": rng.randrange(500),
+                  "ratingCount": rng.randrange(500), "rating": round(rng.uniform(3, 5), 2)},
+        "modelVersions": [{
+            "id": model_id * 10 + v, "modelId": model_id, "name": f"v{v + 1}.0", "createdAt": "2023-03-01T12:00:00.000Z",
+            "updatedAt": "2023-03-02T12:00:00.000Z", "trainedWords": [text(1) for _ in range(3)], "baseModel": "SD 1.5",
+            "description": f"<p>{text(30)}</p>",
+            "downloadUrl": f"https://civitai.com/api/download/models/{model_id * 10 + v}",
+            "files": [{"id": model_id * 10 + v, "name": f"model_{model_id}_v{v}.safetensors", "sizeKB": rng.uniform(10 ** 4, 2 * 10 ** 6),
+                       "type": "Model", "primary": True, "format": "SafeTensor", "pickleScanResult": "Success", "virusScanResult": "Success",
+                       "scannedAt": "2023-03-01T12:05:00.000Z", "metadata": {"fp": "fp16", "size": "pruned", "format": "SafeTensor"},
+                       "hashes": {"AutoV2": f"{rng.getrandbits(40):010X}", "SHA256": f"{rng.getrandbits(256):064X}", "CRC32": f"{rng.getrandbits(32):08X}",
+                                  "BLAKE3": f"{rng.getrandbits(256):064X}"},
+                       "downloadUrl": f"https://civitai.com/api/download/models/{model_id * 10 + v}"}],
+            "images": [{"url": f"https://imagecache.civitai.com/{rng.getrandbits(128):x}/width=768", "nsfw": "None", "width": 512, "height": 768,
+                        "hash": f"U{rng.getrandbits(100):x}",
+                        "meta": {"prompt": text(60), "negativePrompt": text(40), "seed": rng.randrange(2 ** 32), "steps": 30,
+                                 "sampler": "DPM++ 2M Karras", "cfgScale": 7, "Model": text(2), "resources": [{"name": text(1), "type": "lora", "weight": 0.8}]}}
+                       for _ in range(10)],
+        } for v in range(rng.randrange(1, 5))],
+    }
+
+def make_page(items):
+    rng = random.Random(items)
+    page = {"items": [make_item(rng, i + 1) for i in range(items)],
+            "metadata": {"totalItems": 100000, "currentPage": 1, "pageSize": items, "totalPages": 100000 // items,
+                         "nextPage": f"https://civitai.com/api/v1/models?limit={items}&page=2"}}
+    return json.dumps(page).encode()
+
+def serve(sizes, port_queue):
+    pages = {f"/{items}": make_page(items) for items in sizes}
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *args):
+            pass
+        def do_GET(self):
+            body = pages[self.path]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    port_queue.put((server.server_port, {path: len(body) for path, body in pages.items()}))
+    server.serve_forever()
+
+def current_rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+def measure(parser, url, result_queue):
+    session = requests.Session()
+    if parser == "request_civit_api":
+        from scripts import api_cache, functions, search_index
+        from scripts.http_client import get_session
+        # cache and index files of this run only, opened before measuring
+        folder = tempfile.mkdtemp()
+        api_cache.disk_cache_path = os.path.join(folder, "api_cache.sqlite3")
+        search_index.index_path = os.path.join(folder, "search_index.sqlite3")
+        api_cache.get_api_cache()._connect()
+        search_index.get_search_index()
+        session = get_session()
+    session.get(url.rsplit("/", 1)[0] + "/50").close() # warm up the connection machinery
+    gc.collect()
+    before = current_rss_kb()
+    if parser == "json.loads":
+        data = json.loads(session.get(url).text)
+    elif parser == "request_civit_api":
+        data = functions.request_civit_api(url)
+    else:
+        with session.get(url, stream=True) as response:
+            data = records.parse_page(response.iter_content(records.parse_chunk_size))
+    gc.collect()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_queue.put((len(data["items"]), max(0, peak - before), current_rss_kb() - before))
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [50, 100, 500]
+    parsers = ["json.loads", "parse_page"]
+    # scripts.functions needs gradio
+    if importlib.util.find_spec("gradio"):
+        parsers.append("request_civit_api")
+    else:
+        print("gradio is not installed, skipping request_civit_api")
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(sorted(set(sizes) | {50}), port_queue), daemon=True)
+    server.start()
+    port, body_sizes = port_queue.get()
+    try:
+        print(f"{'items':>6} {'body':>9} {'parser':<17} {'peak RSS +':>11} {'held after':>11}")
+        for items in sizes:
+            for parser in parsers:
+                result_queue = multiprocessing.Queue()
+                worker = multiprocessing.Process(target=measure, args=(parser, f"http://127.0.0.1:{port}/{items}", result_queue))
+                worker.start()
+                count, peak_kb, held_kb = result_queue.get()
+                worker.join()
+                assert count == items
+                print(f"{items:>6} {body_sizes[f'/{items}'] / 1024 ** 2:7.1f}MB {parser:<17} {peak_kb / 1024:9.1f}MB {held_kb / 1024:9.1f}MB")
+    finally:
+        server.terminate()
+
+if __name__ == "__main__":
+    main()
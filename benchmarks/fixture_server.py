@@ -0,0 +1,464 @@
+"""
+Local stand-in for the CivitAI API and its download CDN, for repeatable browse and download load tests.
+
+Listings are replayed from pages recorded off the real API (see "record" below) or from synthetic items
+shaped like real ones, paginated with nextPage cursors and filtered by types/query. Model files are synthetic,
+any size (multi-GB is fine, nothing is held in memory), served with Range support behind a redirect like
+the real download endpoint. JSON responses carry an ETag and answer a matching If-None-Match with 304.
+Latency, throttling, error statuses and dropped connections can be injected,
+from a seeded random generator so a run can be repeated.
+
+  GET  /api/v1/models?limit=&page=&types=&query=   listing page
+  GET  /api/v1/models/{id}                        one model
+  GET  /api/v1/model-versions/{id}                one version with its model summary
+  GET  /api/download/models/{version_id}?file=    307 to /files/..., like civitai.com
+  GET  /files/{version_id}/{index}/{name}         the synthetic file (HEAD, Range and If-Range supported)
+  GET  /images/{version_id}_{index}.png           a small generated preview image
+  GET  /_fixture/stats                            request, byte and fault counters
+  POST /_fixture/faults                           change the fault settings, JSON body with Faults fields
+
+usage:
+  python benchmarks/fixture_server.py serve [--port 8765] [--pages DIR] [--synthetic 200] [--file-mb 4096]
+                                            [--latency 0.05] [--fail-rate 0.02] [--drop-rate 0.01] [--bandwidth-mb 50]
+  python benchmarks/fixture_server.py record DIR [--api https://civitai.com/api/v1] [--pages 5] [--params "types=LORA&sort=Newest"]
+
+then start the webui with CIVITAI_API_BASE=http://127.0.0.1:8765/api/v1 (or call functions.set_api_root).
+Tests can run it in-process: with FixtureServer(items).start() as server: ... server.api_base
+"""
+import argparse
+import copy
+import glob
+import hashlib
+import http.server
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+# Bytes written per send, also the granularity of throttling and dropped connections
+chunk_size = 256 * 1024
+# Synthetic file contents repeat this block, shifted per file so every file hashes differently
+BLOCK = random.Random(0).randbytes(1024 * 1024)
+CONTENT_TYPES = ["Checkpoint", "LORA", "LoCon", "TextualInversion", "Hypernetwork"]
+
+class Faults:
+    """
+    What goes wrong, and how often. Rates are probabilities per request
+    """
+    FIELDS = ("latency", "jitter", "fail_rate", "fail_status", "retry_after", "drop_rate", "bandwidth")
+
+    def __init__(self, latency:float=0.0, jitter:float=0.0, fail_rate:float=0.0, fail_status:int=503,
+                 retry_after:Optional[float]=None, drop_rate:float=0.0, bandwidth:float=0.0):
+        self.latency = latency # seconds before every response
+        self.jitter = jitter # up to this many more, uniformly
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.retry_after = retry_after # sent with failures when set
+        self.drop_rate = drop_rate # file bodies cut off at a random offset
+        self.bandwidth = bandwidth # bytes per second per response, 0 for unlimited
+
+    def update(self, values:dict):
+        for key, value in values.items():
+            if key not in self.FIELDS:
+                raise KeyError(key)
+            setattr(self, key, value)
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+def file_byte_source(key:str) -> int:
+    """
+    Offset into BLOCK where the content of a file starts
+    """
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:4], "big") % len(BLOCK)
+
+def file_chunks(key:str, start:int, end:int):
+    """
+    Bytes start..end (inclusive) of a synthetic file, in chunk_size pieces
+    """
+    shift = file_byte_source(key)
+    pos = start
+    while pos <= end:
+        offset = (pos + shift) % len(BLOCK)
+        n = min(end + 1 - pos, chunk_size, len(BLOCK) - offset)
+        yield BLOCK[offset:offset + n]
+        pos += n
+
+def file_sha256(key:str, size:int) -> str:
+    h = hashlib.sha256()
+    for chunk in file_chunks(key, 0, size - 1):
+        h.update(chunk)
+    return h.hexdigest().upper()
+
+def png_image(width:int, height:int, seed:int) -> bytes:
+    """
+    A solid-colour PNG, which compresses to almost nothing whatever its size
+    """
+    color = bytes(random.Random(seed).randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + color * width for _ in range(height))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 9)) + chunk(b"IEND", b""))
+
+def load_items(path:str) -> List[dict]:
+    """
+    Items of recorded pages: a directory of page_*.json files, or one listing file. Duplicates are dropped
+    """
+    files = sorted(glob.glob(os.path.join(path, "page_*.json"))) if os.path.isdir(path) else [path]
+    items, seen = [], set()
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            for item in json.load(f).get("items") or []:
+                if item.get("id") not in seen:
+                    seen.add(item.get("id"))
+                    items.append(item)
+    return items
+
+def synthetic_items(count:int, seed:int=0) -> List[dict]:
+    """
+    count items shaped like real API items, see benchmarks/bench_parse.py
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from bench_parse import make_item
+    rng = random.Random(seed)
+    items = []
+    for model_id in range(1, count + 1):
+        item = make_item(rng, model_id)
+        item["type"] = CONTENT_TYPES[model_id % len(CONTENT_TYPES)]
+        items.append(item)
+    return items
+
+def record(out_dir:str, api:str, pages:int, params:str="", limit:int=100):
+    """
+    Save listing pages of the real API to out_dir/page_0001.json... for replay
+    """
+    import requests
+    os.makedirs(out_dir, exist_ok=True)
+    url = f"{api.rstrip('/')}/models?limit={limit}" + (f"&{params}" if params else "")
+    for number in range(1, pages + 1):
+        response = requests.get(url, timeout=60)
+        response.raise_for_status()
+        path = os.path.join(out_dir, f"page_{number:04d}.json")
+        with open(path, "wb") as f:
+            f.write(response.content)
+        data = response.json()
+        print(f"{path}: {len(data.get('items') or [])} items")
+        url = (data.get("metadata") or {}).get("nextPage")
+        if not url:
+            break
+
+class FixtureHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hang up mid-response all the time (cancelled downloads, dropped connections on purpose)
+        pass
+
+class FixtureServer:
+    """
+    The server on a background thread. Item URLs (downloads, images) are rewritten to point at it
+    """
+    def __init__(self, items:List[dict], file_size:int=64 * 1024 * 1024, page_size:int=20, faults:Optional[Faults]=None,
+                 seed:int=0, host:str="127.0.0.1", port:int=0, hashes:bool=False):
+        self.faults = faults or Faults()
+        self.file_size = file_size
+        self.page_size = page_size
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "bytes_sent": 0, "failed": 0, "dropped": 0, "ranges": 0, "not_modified": 0, "by_path": {}}
+        self._lock = threading.Lock()
+        self.httpd = FixtureHTTPServer((host, port), self._handler())
+        self.base = f"http://{host}:{self.httpd.server_port}"
+        self.api_base = f"{self.base}/api/v1"
+        self.items = [self._rewrite(copy.deepcopy(item), hashes) for item in items]
+        self.models = {item.get("id"): item for item in self.items}
+        self.versions = {version.get("id"): (version, item) for item in self.items for version in item.get("modelVersions") or []}
+        self._thread:Optional[threading.Thread] = None
+
+    def _rewrite(self, item:dict, hashes:bool) -> dict:
+        for version in item.get("modelVersions") or []:
+            version_id = version.get("id")
+            version["modelId"] = item.get("id")
+            version["downloadUrl"] = f"{self.base}/api/download/models/{version_id}"
+            for index, file in enumerate(version.get("files") or []):
+                file["downloadUrl"] = f"{self.base}/api/download/models/{version_id}?file={index}"
+                file["sizeKB"] = self.file_size / 1024
+                file["hashes"] = {"SHA256": file_sha256(f"{version_id}/{index}", self.file_size)} if hashes else {}
+            for index, image in enumerate(version.get("images") or []):
+                image["url"] = f"{self.base}/images/{version_id}_{index}.png"
+        return item
+
+    def start(self) -> "FixtureServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="civitai-fixture", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self if self._thread else self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, key:str, n:int=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def roll(self, rate:float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self.rng.random() < rate
+
+    def delay(self) -> float:
+        faults = self.faults
+        with self._lock:
+            return faults.latency + (self.rng.uniform(0, faults.jitter) if faults.jitter > 0 else 0.0)
+
+    def listing(self, query:Dict[str, List[str]]) -> dict:
+        def first(name, default=None):
+            return (query.get(name) or [default])[0]
+        items = self.items
+        types = set(query.get("types") or [])
+        if types:
+            items = [item for item in items if item.get("type") in types]
+        term = (first("query") or "").lower()
+        if term:
+            items = [item for item in items if term in (item.get("name") or "").lower()]
+        limit = max(1, min(int(first("limit", self.page_size)), 100))
+        page = max(1, int(first("page", 1)))
+        total_pages = max(1, -(-len(items) // limit))
+        params = {key: values[0] for key, values in query.items()}
+        def page_url(number):
+            return f"{self.api_base}/models?{urlencode(dict(params, page=number))}"
+        metadata = {"totalItems": len(items), "currentPage": page, "pageSize": limit, "totalPages": total_pages}
+        if page < total_pages:
+            metadata["nextPage"] = page_url(page + 1)
+        if page > 1:
+            metadata["prevPage"] = page_url(page - 1)
+        return {"items": items[(page - 1) * limit:page * limit], "metadata": metadata}
+
+    def _handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data, status:int=200):
+                body = json.dumps(data).encode()
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    server.count("not_modified")
+                    return self.send_empty(304, {"ETag": etag})
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+                server.count("bytes_sent", len(body))
+
+            def send_empty(self, status:int, headers:Optional[Dict[str, str]]=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_POST(self):
+                if urlsplit(self.path).path != "/_fixture/faults":
+                    return self.send_empty(404)
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    server.faults.update(json.loads(self.rfile.read(length) or b"{}"))
+                except (KeyError, ValueError) as e:
+                    return self.send_json({"error": f"bad fault setting {e}"}, 400)
+                self.send_json(server.faults.to_dict())
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                path, query = url.path, parse_qs(url.query)
+                if path == "/_fixture/stats":
+                    with server._lock:
+                        stats = copy.deepcopy(server.stats)
+                    return self.send_json(dict(stats, faults=server.faults.to_dict()))
+                kind = path.strip("/").split("/")
+                kind = "/".join(kind[:3]) if kind[:1] == ["api"] else kind[0]
+                with server._lock:
+                    server.stats["requests"] += 1
+                    server.stats["by_path"][kind] = server.stats["by_path"].get(kind, 0) + 1
+                delay = server.delay()
+                if delay:
+                    time.sleep(delay)
+                if server.roll(server.faults.fail_rate):
+                    server.count("failed")
+                    retry_after = server.faults.retry_after
+                    return self.send_empty(server.faults.fail_status, {"Retry-After": str(int(retry_after))} if retry_after is not None else None)
+                try:
+                    self.route(path, query)
+                except (ValueError, KeyError) as e:
+                    self.send_json({"error": str(e)}, 400)
+
+            def route(self, path:str, query:Dict[str, List[str]]):
+                parts = path.strip("/").split("/")
+                if parts == ["api", "v1", "models"]:
+                    return self.send_json(server.listing(query))
+                if parts[:3] == ["api", "v1", "models"] and len(parts) == 4:
+                    item = server.models.get(int(parts[3]))
+                    return self.send_json(item) if item else self.send_json({"error": "No model"}, 404)
+                if parts[:3] == ["api", "v1", "model-versions"] and len(parts) == 4:
+                    version, item = server.versions.get(int(parts[3]), (None, None))
+                    if version is None:
+                        return self.send_json({"error": "No version"}, 404)
+                    return self.send_json(dict(version, model={key: item.get(key) for key in ("name", "type", "nsfw", "poi")}))
+                if parts[:3] == ["api", "download", "models"] and len(parts) == 4:
+                    version, _ = server.versions.get(int(parts[3]), (None, None))
+                    index = int((query.get("file") or [0])[0])
+                    if version is None or index >= len(version.get("files") or []):
+                        return self.send_json({"error": "No file"}, 404)
+                    name = version["files"][index]["name"]
+                    return self.send_empty(307, {"Location": f"{server.base}/files/{parts[3]}/{index}/{quote(name)}"})
+                if parts[0] == "files" and len(parts) == 4:
+                    return self.send_file(f"{parts[1]}/{parts[2]}", parts[3])
+                if parts[0] == "images" and len(parts) == 2 and parts[1].endswith(".png"):
+                    return self.send_image(parts[1])
+                self.send_json({"error": "Not found"}, 404)
+
+            def send_image(self, name:str):
+                version_id, index = name[:-4].split("_")
+                version, _ = server.versions.get(int(version_id), (None, None))
+                images = (version or {}).get("images") or []
+                if int(index) >= len(images):
+                    return self.send_empty(404)
+                image = images[int(index)]
+                body = png_image(min(image.get("width") or 512, 1024), min(image.get("height") or 768, 1536), zlib.crc32(name.encode()))
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", f'"{name}"')
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+                server.count("bytes_sent", len(body))
+
+            def send_file(self, key:str, name:str):
+                size = server.file_size
+                start, end = 0, size - 1
+                partial = False
+                etag = f'"{key.replace("/", "-")}-{size}"'
+                value = self.headers.get("Range", "")
+                if self.headers.get("If-Range") not in (None, etag):
+                    # the client has part of another file, it gets the whole current one
+                    value = ""
+                if value.startswith("bytes=") and "," not in value:
+                    first, _, last = value[6:].strip().partition("-")
+                    if first:
+                        start = int(first)
+                        end = min(int(last), size - 1) if last else size - 1
+                    elif last:
+                        start = max(0, size - int(last))
+                    if start >= size or start > end:
+                        return self.send_empty(416, {"Content-Range": f"bytes */{size}"})
+                    partial = True
+                    server.count("ranges")
+                self.send_response(206 if partial else 200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+                if partial:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.end_headers()
+                if self.command == "HEAD":
+                    return
+                drop_at = None
+                if server.roll(server.faults.drop_rate):
+                    with server._lock:
+                        drop_at = server.rng.randrange(end - start + 1)
+                sent = 0
+                began = time.monotonic()
+                try:
+                    for chunk in file_chunks(key, start, end):
+                        if drop_at is not None and sent + len(chunk) > drop_at:
+                            self.wfile.write(chunk[:drop_at - sent])
+                            self.wfile.flush()
+                            server.count("dropped")
+                            server.count("bytes_sent", drop_at - sent)
+                            self.close_connection = True
+                            self.connection.shutdown(socket.SHUT_RDWR)
+                            return
+                        self.wfile.write(chunk)
+                        sent += len(chunk)
+                        server.count("bytes_sent", len(chunk))
+                        bandwidth = server.faults.bandwidth
+                        if bandwidth > 0:
+                            ahead = sent / bandwidth - (time.monotonic() - began)
+                            if ahead > 0:
+                                time.sleep(ahead)
+                except OSError:
+                    self.close_connection = True
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the CivitAI API and download CDN")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve recorded or synthetic listings and synthetic files")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--pages", help="recorded pages, a directory of page_*.json or one listing file")
+    serve.add_argument("--synthetic", type=int, default=200, help="synthetic items when no pages are given")
+    serve.add_argument("--page-size", type=int, default=20)
+    serve.add_argument("--file-mb", type=float, default=4096, help="size of every model file")
+    serve.add_argument("--hashes", action="store_true", help="publish SHA256 of the files (reads every file once at startup)")
+    serve.add_argument("--seed", type=int, default=0)
+    serve.add_argument("--latency", type=float, default=0.0)
+    serve.add_argument("--jitter", type=float, default=0.0)
+    serve.add_argument("--fail-rate", type=float, default=0.0)
+    serve.add_argument("--fail-status", type=int, default=503)
+    serve.add_argument("--retry-after", type=float)
+    serve.add_argument("--drop-rate", type=float, default=0.0)
+    serve.add_argument("--bandwidth-mb", type=float, default=0.0, help="per response, 0 for unlimited")
+    rec = commands.add_parser("record", help="save listing pages of the real API for replay")
+    rec.add_argument("out_dir")
+    rec.add_argument("--api", default="https://civitai.com/api/v1")
+    rec.add_argument("--pages", type=int, default=5)
+    rec.add_argument("--limit", type=int, default=100)
+    rec.add_argument("--params", default="", help='extra query, e.g. "types=LORA&sort=Newest"')
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.out_dir, args.api, args.pages, args.params, args.limit)
+        return
+    items = load_items(args.pages) if args.pages else synthetic_items(args.synthetic, args.seed)
+    faults = Faults(args.latency, args.jitter, args.fail_rate, args.fail_status, args.retry_after, args.drop_rate, args.bandwidth_mb * 1024 ** 2)
+    server = FixtureServer(items, int(args.file_mb * 1024 ** 2), args.page_size, faults, args.seed, args.host, args.port, args.hashes)
+    print(f"{len(server.items)} models, {len(server.versions)} versions, {args.file_mb:g} MB files")
+    print(f"CIVITAI_API_BASE={server.api_base}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
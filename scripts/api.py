@@ -1,14 +1,23 @@
 """
 Registers API routes for the webui
 """
+import asyncio
+import json
 import gradio as gr
-import threading
 from pydantic import BaseModel
-from typing import Optional, Tuple, Union
-from scripts.functions import download_file_thread
+from typing import Dict, List, Optional, Tuple, Union
+import os
+from scripts.functions import download_file_thread, get_installed_inventory, reclaim_stale_dummies, replace_invalid_chars
+from scripts.routing import content_types, get_router
+from scripts.install import InstallError, ModelInstall, start_install
+from scripts.api_cache import get_api_cache
+from scripts.download_queue import DownloadJob, DONE, RUNNING, SKIPPED, get_scheduler
+from scripts import throttle, thumbnails
 from secrets import compare_digest
 from fastapi import HTTPException
 from fastapi import Depends, FastAPI, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 ### ====================classes========================
@@ -19,6 +28,146 @@ class DownloadRequestResponse(BaseModel):
     message:str
     success:bool
 
+class DownloadJobRequest(BaseModel):
+    """
+    One entry of a batch download
+    """
+    url:str
+    file_name:str
+    content_type:str
+    model_name:Optional[str] = None
+    use_new_folder:bool = False
+    sha256:Optional[str] = None # skips installed copies and verifies the download
+    size_bytes:int = 0 # declared size, only used for the batch totals
+    priority:int = 0
+
+class BatchDownloadRequest(BaseModel):
+    """
+    Body of POST /download/batch
+    """
+    jobs:List[DownloadJobRequest]
+
+class BatchDownloadResponse(BaseModel):
+    """
+    Batch download response. errors lists the invalid jobs by index when the batch was rejected
+    """
+    message:str
+    success:bool
+    batch_id:Optional[str] = None
+    job_ids:List[str] = []
+    job_count:int = 0
+    total_bytes:int = 0
+    errors:List[str] = []
+
+class BatchStatusResponse(BaseModel):
+    """
+    Aggregated state of a batch
+    """
+    batch_id:str
+    job_count:int
+    total_bytes:int
+    states:Dict[str, int]
+    downloaded_bytes:int = 0
+    finished:bool
+
+class JobStatusResponse(BaseModel):
+    """
+    State and live progress of one queued download. Times are unix timestamps
+    """
+    id:str
+    url:str
+    file_name:str
+    state:str
+    priority:int
+    error:Optional[str] = None
+    message:Optional[str] = None
+    created:float
+    started:Optional[float] = None
+    finished:Optional[float] = None
+    downloaded_bytes:int
+    total_bytes:int # 0 while unknown
+    bytes_per_second:float
+    eta_seconds:Optional[float] = None
+    retries:int
+    bytes_per_second_limit:float = 0 # 0 when the job has no cap of its own
+
+class LimitsRequest(BaseModel):
+    """
+    Body of POST /download/limits. Fields left out are unchanged, 0 means unlimited
+    """
+    max_bytes_per_second:Optional[float] = None
+    job_bytes_per_second:Optional[float] = None # default cap of jobs started afterwards
+    max_connections_per_host:Optional[int] = None
+    host_connection_limits:Optional[Dict[str, int]] = None # replaces the per-host overrides
+    max_workers:Optional[int] = None
+
+class LimitsResponse(BaseModel):
+    """
+    Current limits and the measured download throughput
+    """
+    max_bytes_per_second:float
+    job_bytes_per_second:float
+    max_connections_per_host:int
+    host_connection_limits:Dict[str, int]
+    max_workers:int
+    running_jobs:int
+    bytes_per_second:float # sum over the running jobs
+    active_connections:Dict[str, int]
+
+class CacheStatsResponse(BaseModel):
+    """
+    Counters of the API listing cache since startup
+    """
+    hits:int
+    misses:int
+    disk_hits:int # hits served from the SQLite file, included in hits
+    revalidated:int # misses on expired entries the server then confirmed with 304
+    entries:int # in memory
+    bytes:int # in memory
+
+class JobLimitRequest(BaseModel):
+    """
+    Body of POST /download/jobs/{job_id}/limit, 0 removes the cap
+    """
+    bytes_per_second:float
+
+class InstallRequest(BaseModel):
+    """
+    Body of POST /download/install. Either id is enough: a model id alone installs its latest version
+    """
+    model_id:Optional[int] = None
+    version_id:Optional[int] = None
+    content_type:Optional[str] = None # defaults to the model's type
+    file_name:Optional[str] = None # defaults to the primary file
+    use_new_folder:bool = False
+    include_nsfw:bool = True # nsfw preview images
+    priority:int = 0
+    wait:bool = False # also wait for the model download
+    timeout:Optional[float] = None
+
+class InstallResponse(BaseModel):
+    """
+    Result of an install. timings has the seconds of each stage: resolve, queue, text, previews, info,
+    and once the download has finished model and total
+    """
+    message:str
+    success:bool
+    model_id:Optional[int] = None
+    version_id:Optional[int] = None
+    model_name:Optional[str] = None
+    version_name:Optional[str] = None
+    content_type:Optional[str] = None
+    file_name:Optional[str] = None
+    job_id:Optional[str] = None
+    state:Optional[str] = None
+    path:Optional[str] = None
+    text_path:Optional[str] = None
+    info_path:Optional[str] = None
+    previews:List[str] = []
+    previews_failed:int = 0
+    errors:Dict[str, str] = {}
+    timings:Dict[str, float] = {}
+
 ### ====================functions======================
 def assert_download_conditions(url:str, file_name:str, content_type:str, use_new_folder:bool, model_name:Optional[str]=None) -> Union[DownloadRequestResponse, Tuple]:
     """
@@ -28,16 +177,22 @@ def assert_download_conditions(url:str, file_name:str, content_type:str, use_new
         return DownloadRequestResponse(message="No URL provided", success=False)
     if not file_name:
         return DownloadRequestResponse(message="No file name provided", success=False)
-    # check content_type in Checkpoint, Hypernetwork, TextualInversion, AestheticGradient, VAE, LORA, LoCon
-    if content_type not in ["Checkpoint", "Hypernetwork", "TextualInversion", "AestheticGradient", "VAE", "LORA", "LoCon"]:
+    # check content_type is one of the routed types (Checkpoint, Hypernetwork, TextualInversion, AestheticGradient, VAE, LORA, LoCon by default)
+    if content_type not in content_types():
         return DownloadRequestResponse(
-            message=f"Invalid content type, given {content_type} but expected one of ['Checkpoint', 'Hypernetwork', 'TextualInversion', 'AestheticGradient', 'VAE', 'LORA', 'LoCon']", success=False)
+            message=f"Invalid content type, given {content_type} but expected one of {content_types()}", success=False)
+    # names become path components, keep them inside the content type folder
+    file_name = replace_invalid_chars(file_name)
+    if file_name in ("", ".", ".."):
+        return DownloadRequestResponse(message="Invalid file name", success=False)
     if not model_name:
         # remove ext from file name
         if "." in file_name:
             model_name = file_name[:file_name.rindex(".")]
         else:
             model_name = file_name
+    if replace_invalid_chars(model_name) in ("", ".", ".."):
+        return DownloadRequestResponse(message="Invalid model name", success=False)
     return url, file_name, content_type, use_new_folder, model_name
 
 def wrapped_download_file_thread(url:str, model_name:str, file_name:str, content_type:str, use_new_folder:bool=False, wait:bool=False) -> DownloadRequestResponse:
@@ -48,11 +203,132 @@ def wrapped_download_file_thread(url:str, model_name:str, file_name:str, content
     if isinstance(assert_download_conditions_response, DownloadRequestResponse):
         return assert_download_conditions_response
     url, file_name, content_type, use_new_folder, model_name = assert_download_conditions_response
-    thread:threading.Thread = download_file_thread(url, file_name, content_type, use_new_folder, model_name) # started thread
+    job:DownloadJob = download_file_thread(url, file_name, content_type, use_new_folder, model_name) # queued job
+    if wait:
+        job.join()
+        return job_result(job, model_name)
+    return DownloadRequestResponse(message=f"Downloading {model_name}... (job {job.id})", success=True)
+
+async def async_download_file(url:str, model_name:str, file_name:str, content_type:str, use_new_folder:bool=False, wait:bool=False) -> DownloadRequestResponse:
+    """
+    Same as wrapped_download_file_thread, but waiting happens on the event loop instead of a blocked thread
+    """
+    assert_download_conditions_response = assert_download_conditions(url, file_name, content_type, use_new_folder, model_name)
+    if isinstance(assert_download_conditions_response, DownloadRequestResponse):
+        return assert_download_conditions_response
+    url, file_name, content_type, use_new_folder, model_name = assert_download_conditions_response
+    # queueing reads the inventory and creates folders, keep that disk I/O off the event loop
+    job:DownloadJob = await run_in_threadpool(download_file_thread, url, file_name, content_type, use_new_folder, model_name)
     if wait:
-        thread.join()
-        return DownloadRequestResponse(message=f"Downloaded {model_name}", success=True)
-    return DownloadRequestResponse(message=f"Downloading {model_name}...", success=True)
+        await wait_for_job(job)
+        return job_result(job, model_name)
+    return DownloadRequestResponse(message=f"Downloading {model_name}... (job {job.id})", success=True)
+
+def job_result(job:DownloadJob, model_name:str) -> DownloadRequestResponse:
+    """
+    DownloadRequestResponse for a finished job
+    """
+    if job.state == SKIPPED:
+        return DownloadRequestResponse(message=f"{model_name} {job.message}", success=True)
+    if job.state != DONE:
+        return DownloadRequestResponse(message=f"Download of {model_name} {job.state}: {job.error or ''}".strip(), success=False)
+    return DownloadRequestResponse(message=f"Downloaded {model_name}", success=True)
+
+async def wait_for_job(job:DownloadJob, timeout:Optional[float]=None) -> bool:
+    """
+    Await the job on an asyncio future resolved by the scheduler thread. Returns False on timeout
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def resolve(_):
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+    job.add_done_callback(resolve)
+    try:
+        await asyncio.wait_for(future, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return job.finished
+    finally:
+        job.remove_done_callback(resolve)
+
+async def job_events(job:DownloadJob, interval:float=1.0):
+    """
+    Server-Sent Events stream of the job status: a "progress" event every interval seconds and a final "done" event
+    """
+    finished = job.finished
+    while True:
+        event = "done" if finished else "progress"
+        yield f"event: {event}\ndata: {json.dumps(job.status())}\n\n"
+        if finished:
+            return
+        finished = await wait_for_job(job, interval)
+
+async def install_model(request:InstallRequest) -> InstallResponse:
+    """
+    Runs the install pipeline on a worker thread, then optionally awaits the download on the event loop
+    """
+    try:
+        install:ModelInstall = await run_in_threadpool(start_install, request.model_id, request.version_id, request.content_type,
+                                                       request.file_name, request.use_new_folder, request.include_nsfw, request.priority)
+    except InstallError as e:
+        return InstallResponse(message=str(e), success=False)
+    if request.wait:
+        await wait_for_job(install.job, request.timeout)
+    result = job_result(install.job, install.model_name) if install.job.finished else \
+        DownloadRequestResponse(message=f"Downloading {install.model_name}... (job {install.job.id})", success=True)
+    return InstallResponse(message=result.message, success=result.success, **install.summary())
+
+def enqueue_download_batch(request:BatchDownloadRequest) -> BatchDownloadResponse:
+    """
+    Validates every job first and only enqueues the batch if all of them are valid
+    """
+    if not request.jobs:
+        return BatchDownloadResponse(message="No jobs provided", success=False)
+    refined = []
+    errors = []
+    destinations:Dict[str, int] = {}
+    for index, job in enumerate(request.jobs):
+        result = assert_download_conditions(job.url, job.file_name, job.content_type, job.use_new_folder, job.model_name)
+        if isinstance(result, DownloadRequestResponse):
+            errors.append(f"job {index}: {result.message}")
+            continue
+        url, file_name, content_type, use_new_folder, model_name = result
+        destination = os.path.join(get_router().model_folder(content_type, replace_invalid_chars(model_name), use_new_folder), file_name)
+        if destination in destinations:
+            errors.append(f"job {index}: same destination as job {destinations[destination]}")
+            continue
+        destinations[destination] = index
+        refined.append((result, job))
+    if errors:
+        return BatchDownloadResponse(message=f"{len(errors)} of {len(request.jobs)} jobs are invalid, nothing was queued", success=False, job_count=len(request.jobs), errors=errors)
+    scheduler = get_scheduler()
+    existing = {job.id for job in scheduler.jobs()}
+    jobs = []
+    try:
+        for (url, file_name, content_type, use_new_folder, model_name), job in refined:
+            hashes = {"SHA256": job.sha256} if job.sha256 else None
+            jobs.append(download_file_thread(url, file_name, content_type, use_new_folder, model_name, job.priority, hashes))
+    except OSError:
+        # all or nothing: take back what this batch queued, jobs that were already queued before are left alone
+        for job in jobs:
+            if job.id not in existing:
+                scheduler.cancel(job.id)
+        raise
+    total_bytes = sum(job.size_bytes for job in request.jobs)
+    batch = scheduler.add_batch(jobs, total_bytes)
+    return BatchDownloadResponse(message=f"Queued {len(jobs)} downloads", success=True, batch_id=batch.id,
+                                 job_ids=[job.id for job in jobs], job_count=len(jobs), total_bytes=total_bytes)
+
+def limits_status() -> LimitsResponse:
+    """
+    Current limits, with throughput measured over the running jobs
+    """
+    running = [job.status() for job in get_scheduler().jobs() if job.state == RUNNING]
+    return LimitsResponse(max_bytes_per_second=throttle.max_bytes_per_second, job_bytes_per_second=throttle.job_bytes_per_second,
+                          max_connections_per_host=throttle.max_connections_per_host, host_connection_limits=dict(throttle.host_connection_limits),
+                          max_workers=get_scheduler().workers, running_jobs=len(running),
+                          bytes_per_second=sum(job["bytes_per_second"] for job in running),
+                          active_connections=dict(throttle.get_host_limiter().active))
 
 def register_download_api(app:FastAPI):
     # single function, everything here...
@@ -90,11 +366,169 @@ def register_download_api(app:FastAPI):
         """
         return wrapped_download_file_thread(url, model_name, file_name, content_type, use_new_folder, wait)
 
+    @app.post("/download/model/async", response_model=DownloadRequestResponse, dependencies=dependencies)
+    async def download_model_async(url:str=Form(""), model_name:str=Form(""), file_name:str=Form(""), content_type:str=Form(""), use_new_folder:bool=Form(False), wait:bool=Form(False)):
+        """
+        Download a model from a URL. Same form as /download/model, but wait=true does not hold a worker thread
+        example : curl -X POST "http://localhost:7860/download/model/async" -F "url=https://www.example.com/model.zip" -F "file_name=example_model.zip" -F "content_type=Checkpoint" -F "wait=true"
+        """
+        return await async_download_file(url, model_name, file_name, content_type, use_new_folder, wait)
+
+    @app.post("/download/install", response_model=InstallResponse, dependencies=dependencies)
+    async def download_install(request:InstallRequest):
+        """
+        Install a model by id: the model file plus its trained words text, previews and .civitai.info, written while the file downloads
+        example : curl -X POST "http://localhost:7860/download/install" -H "Content-Type: application/json" -d '{"version_id": 12345, "wait": true}'
+        """
+        return await install_model(request)
+
+    @app.post("/download/batch", response_model=BatchDownloadResponse, dependencies=dependencies)
+    async def download_batch(request:BatchDownloadRequest):
+        """
+        Queue many downloads at once
+        example : curl -X POST "http://localhost:7860/download/batch" -H "Content-Type: application/json" -d '{"jobs": [{"url": "https://civitai.com/api/download/models/1234", "file_name": "example.safetensors", "content_type": "LORA", "model_name": "example", "use_new_folder": false}]}'
+        """
+        return await run_in_threadpool(enqueue_download_batch, request)
+
+    @app.get("/download/batch/{batch_id}", response_model=BatchStatusResponse, dependencies=dependencies)
+    def download_batch_status(batch_id:str):
+        """
+        Job count, declared bytes and per-state job counts of a batch
+        """
+        batch = get_scheduler().batches.get(batch_id)
+        if batch is None:
+            raise HTTPException(status_code=404, detail=f"Unknown batch {batch_id}")
+        return batch.summary()
+
+    @app.get("/download/jobs", response_model=List[JobStatusResponse], dependencies=dependencies)
+    def download_jobs(state:Optional[str]=None):
+        """
+        All known download jobs, optionally only those in one state (queued, running, done, failed, cancelled, skipped)
+        example : curl "http://localhost:7860/download/jobs?state=running"
+        """
+        return [job.status() for job in get_scheduler().jobs() if state is None or job.state == state]
+
+    @app.get("/download/jobs/{job_id}", response_model=JobStatusResponse, dependencies=dependencies)
+    def download_job_status(job_id:str):
+        """
+        Progress of one download job
+        """
+        job = get_scheduler().get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+        return job.status()
+
+    @app.delete("/download/jobs/{job_id}", response_model=DownloadRequestResponse, dependencies=dependencies)
+    def cancel_download_job(job_id:str):
+        """
+        Cancel a queued or running download. Its partial file is removed
+        example : curl -X DELETE "http://localhost:7860/download/jobs/0123456789ab"
+        """
+        scheduler = get_scheduler()
+        job = scheduler.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+        if not scheduler.cancel(job_id):
+            return DownloadRequestResponse(message=f"Job {job_id} already {job.state}", success=False)
+        return DownloadRequestResponse(message=f"Cancelling {job.file_name}", success=True)
+
+    @app.post("/download/jobs/{job_id}/limit", response_model=JobStatusResponse, dependencies=dependencies)
+    def limit_download_job(job_id:str, request:JobLimitRequest):
+        """
+        Cap (or uncap) the bandwidth of one queued or running job
+        example : curl -X POST "http://localhost:7860/download/jobs/0123456789ab/limit" -H "Content-Type: application/json" -d '{"bytes_per_second": 5000000}'
+        """
+        job = get_scheduler().get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+        throttle.job_bucket(job.progress).set_rate(request.bytes_per_second)
+        return job.status()
+
+    @app.get("/download/limits", response_model=LimitsResponse, dependencies=dependencies)
+    def download_limits():
+        """
+        Bandwidth and connection limits, plus the measured throughput and open connections per host
+        """
+        return limits_status()
+
+    @app.post("/download/limits", response_model=LimitsResponse, dependencies=dependencies)
+    def set_download_limits(request:LimitsRequest):
+        """
+        Change the limits at runtime, they apply to running downloads as well
+        example : curl -X POST "http://localhost:7860/download/limits" -H "Content-Type: application/json" -d '{"max_bytes_per_second": 20000000, "host_connection_limits": {"civitai.com": 2}}'
+        """
+        throttle.set_limits(request.max_bytes_per_second, request.max_connections_per_host, request.host_connection_limits, request.job_bytes_per_second)
+        if request.max_workers is not None:
+            get_scheduler().set_workers(request.max_workers)
+        return limits_status()
+
+    @app.get("/download/cache", response_model=CacheStatsResponse, dependencies=dependencies)
+    def api_cache_stats():
+        """
+        Hit / miss counters and size of the API listing cache
+        example : curl "http://localhost:7860/download/cache"
+        """
+        return get_api_cache().stats()
+
+    @app.get("/download/jobs/{job_id}/wait", response_model=JobStatusResponse, dependencies=dependencies)
+    async def wait_download_job(job_id:str, timeout:float=30.0):
+        """
+        Long-poll: returns as soon as the job finishes, or its current status after timeout seconds (at most 300)
+        example : curl "http://localhost:7860/download/jobs/0123456789ab/wait?timeout=60"
+        """
+        job = get_scheduler().get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+        await wait_for_job(job, min(max(timeout, 0.0), 300.0))
+        return job.status()
+
+    @app.get("/download/jobs/{job_id}/events", dependencies=dependencies)
+    async def download_job_events(job_id:str, interval:float=1.0):
+        """
+        Server-Sent Events stream of the job's progress until it finishes
+        example : curl -N "http://localhost:7860/download/jobs/0123456789ab/events?interval=2"
+        """
+        job = get_scheduler().get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+        return StreamingResponse(job_events(job, max(interval, 0.1)), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+
+def register_thumbnail_route(app:FastAPI):
+    """
+    Serves the thumbnails of the model info panel. No auth: the page loads them as plain <img> tags,
+    and only images the panel requested can be looked up, by the hash of their URL
+    """
+    @app.get(thumbnails.route_prefix + "/{key}")
+    async def thumbnail(key:str, timeout:float=30.0):
+        cache = thumbnails.get_thumbnail_cache()
+        path = cache.path(key)
+        if path is None:
+            future = cache.future(key)
+            try:
+                path = await asyncio.wait_for(asyncio.wrap_future(future), min(max(timeout, 0.0), 60.0)) if future else None
+            except asyncio.TimeoutError:
+                path = None
+        if path is None:
+            # scaling failed or is slow, let the browser load the original instead
+            original = cache.original(key)
+            if original is None:
+                # never requested, or forgotten since, see thumbnails.max_urls
+                raise HTTPException(status_code=404, detail="Unknown thumbnail")
+            return RedirectResponse(original)
+        return FileResponse(path, headers={"Cache-Control": "public, max-age=86400"})
+    thumbnails.route_registered = True
+
 def register_api(_:gr.Blocks, app:FastAPI):
     """
     Registers hooks for app on webui startup
     """
+    # markers of downloads that died with a previous webui process would block those files forever
+    reclaim_stale_dummies(get_router().folders_in_use())
+    # start hashing installed models in the background so lookups are ready when needed
+    get_installed_inventory()
     register_download_api(app)
+    register_thumbnail_route(app)
 
 
 # only works in context of sdwebui
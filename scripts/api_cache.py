@@ -0,0 +1,263 @@
+"""
+TTL + LRU cache for CivitAI API listing responses, with an optional SQLite spill file so results survive restarts.
+ETag / Last-Modified validators are kept with every response (and every saved preview image)
+so expired entries can be revalidated with a conditional request instead of downloaded again.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from scripts import records
+
+# Seconds a cached listing is served before it is fetched again
+cache_ttl = 300
+# Limits for the in-memory part of the cache, whichever is hit first evicts the least recently used entry
+max_entries = 256
+max_bytes = 64 * 1024 * 1024
+# Keep listings in a SQLite file in the extension folder as well
+use_disk_cache = True
+# Rows older than this (seconds) are dropped from the disk cache when it is opened
+disk_retention = 7 * 24 * 3600
+disk_cache_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "civitai_api_cache.sqlite3")
+
+def normalize_url(url:str) -> str:
+    """
+    Cache key for url: lower-cased scheme/host and sorted query parameters
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ""))
+
+class ApiCache:
+    """
+    Maps normalized request urls to decoded JSON responses.
+    Entries are kept in LRU order and expire after ttl seconds; sizes are the length of the response body.
+    """
+    def __init__(self, ttl:float=cache_ttl, max_entries:int=max_entries, max_bytes:int=max_bytes, disk_path:Optional[str]=None,
+                 loads:Callable[[str], Any]=json.loads):
+        self.ttl = ttl
+        self.loads = loads # decodes bodies read back from disk
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.revalidated = 0
+        self.bytes = 0
+        self._entries = OrderedDict() # key -> (stored_at, size, data, validators)
+        self._images = {} # image url -> validators, used when there is no disk cache
+        self._lock = threading.Lock()
+        self._db:Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self.disk_path is None:
+            return None
+        if self._db is None:
+            try:
+                self._db = sqlite3.connect(self.disk_path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, stored_at REAL, body TEXT, etag TEXT, last_modified TEXT, size INTEGER)")
+                columns = [row[1] for row in self._db.execute("PRAGMA table_info(responses)")]
+                for column, kind in (("etag", "TEXT"), ("last_modified", "TEXT"), ("size", "INTEGER")):
+                    # cache files written before validators and sizes were stored
+                    if column not in columns:
+                        self._db.execute(f"ALTER TABLE responses ADD COLUMN {column} {kind}")
+                self._db.execute("CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, path TEXT, etag TEXT, last_modified TEXT, stored_at REAL)")
+                self._db.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - disk_retention,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Disabling CivitAI disk cache: {e}")
+                self.disk_path = None
+                return None
+        return self._db
+
+    def get(self, url:str, max_age:Optional[float]=None):
+        """
+        Returns the cached data for url, or None if it is missing or older than max_age (default: ttl)
+        """
+        key = normalize_url(url)
+        max_age = self.ttl if max_age is None else max_age
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            db = self._connect()
+            if db is not None:
+                row = db.execute("SELECT stored_at, body, etag, last_modified, size FROM responses WHERE url = ?", (key,)).fetchone()
+                if row is not None and now - row[0] <= max_age:
+                    data = self.loads(row[1])
+                    self._store(key, row[0], row[4] or len(row[1]), data, _validators(row[2], row[3]))
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return data
+            self.misses += 1
+            return None
+
+    def contains(self, url:str, max_age:Optional[float]=None) -> bool:
+        """
+        Whether get(url, max_age) would hit. Nothing is loaded and the counters are left alone
+        """
+        key = normalize_url(url)
+        max_age = self.ttl if max_age is None else max_age
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= max_age:
+                return True
+            db = self._connect()
+            if db is not None:
+                row = db.execute("SELECT stored_at FROM responses WHERE url = ?", (key,)).fetchone()
+                return row is not None and now - row[0] <= max_age
+        return False
+
+    def stale(self, url:str):
+        """
+        Returns (data, validators) for url whatever its age, or None if it is not cached.
+        validators holds the ETag / Last-Modified of the stored response, either may be missing
+        """
+        key = normalize_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry[2], entry[3]
+            db = self._connect()
+            if db is not None:
+                row = db.execute("SELECT body, etag, last_modified FROM responses WHERE url = ?", (key,)).fetchone()
+                if row is not None:
+                    return self.loads(row[0]), _validators(row[1], row[2])
+        return None
+
+    def revalidate(self, url:str):
+        """
+        The server answered 304 for url: the stored response is fresh again.
+        The lookup that found it expired was counted as a miss, a 304 is only counted as revalidated
+        """
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (now,) + entry[1:]
+                self._entries.move_to_end(key)
+            db = self._connect()
+            if db is not None:
+                if entry is None:
+                    row = db.execute("SELECT body, etag, last_modified, size FROM responses WHERE url = ?", (key,)).fetchone()
+                    if row is not None:
+                        self._store(key, now, row[3] or len(row[0]), self.loads(row[0]), _validators(row[1], row[2]))
+                db.execute("UPDATE responses SET stored_at = ? WHERE url = ?", (now, key))
+                db.commit()
+            self.revalidated += 1
+
+    def put(self, url:str, data, body=None, validators:Optional[dict]=None, size:Optional[int]=None):
+        """
+        Cache data for url. body is the disk copy, text or bytes that loads decodes, the raw response text by default.
+        size is what the entry counts against max_bytes, the length of body unless given (e.g. for a compressed body).
+        validators are the ETag / Last-Modified of the response, see response_validators
+        """
+        key = normalize_url(url)
+        if body is None:
+            body = json.dumps(data)
+        size = len(body) if size is None else size
+        validators = validators or {}
+        now = time.time()
+        with self._lock:
+            self._store(key, now, size, data, validators)
+            db = self._connect()
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO responses (url, stored_at, body, etag, last_modified, size) VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, now, body, validators.get("etag"), validators.get("last_modified"), size))
+                db.commit()
+
+    def _store(self, key, stored_at, size, data, validators):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._entries[key] = (stored_at, size, data, validators)
+        self.bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, (_, evicted_size, _, _) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def image_validators(self, url:str) -> Optional[dict]:
+        """
+        Validators and local path ("path") of a preview image saved earlier, or None
+        """
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                return self._images.get(url)
+            row = db.execute("SELECT path, etag, last_modified FROM images WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return dict(_validators(row[1], row[2]), path=row[0])
+
+    def put_image(self, url:str, path:str, validators:dict):
+        """
+        Remember where the image at url was saved and the validators it was served with
+        """
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                self._images[url] = dict(validators, path=path)
+                return
+            db.execute("INSERT OR REPLACE INTO images (url, path, etag, last_modified, stored_at) VALUES (?, ?, ?, ?, ?)",
+                       (url, path, validators.get("etag"), validators.get("last_modified"), time.time()))
+            db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._images.clear()
+            self.bytes = 0
+            db = self._connect()
+            if db is not None:
+                db.execute("DELETE FROM responses")
+                db.execute("DELETE FROM images")
+                db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits, "revalidated": self.revalidated,
+                    "entries": len(self._entries), "bytes": self.bytes}
+
+def _validators(etag:Optional[str], last_modified:Optional[str]) -> dict:
+    return {name: value for name, value in (("etag", etag), ("last_modified", last_modified)) if value}
+
+def response_validators(response) -> dict:
+    """
+    The ETag / Last-Modified headers of a response
+    """
+    return _validators(response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+def conditional_headers(validators:Optional[dict]) -> dict:
+    """
+    If-None-Match / If-Modified-Since headers revalidating a response stored with validators
+    """
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+_cache:Optional[ApiCache] = None
+_cache_lock = threading.Lock()
+
+def get_api_cache() -> ApiCache:
+    """
+    Returns the process-wide listing cache, creating it on first use
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ApiCache(cache_ttl, max_entries, max_bytes, disk_cache_path if use_disk_cache else None, records.loads_page)
+        return _cache
@@ -0,0 +1,79 @@
+"""
+Indexed view over one page of CivitAI API results, so UI handlers don't rescan json_data['items']
+"""
+from typing import Dict, List, Optional, Tuple
+
+class ModelCatalog:
+    """
+    Built once per page load (and extended by streaming searches). Models are addressed by their dropdown label,
+    which is the model name, or "name [id]" for later models that share a name with an earlier one in the catalog.
+    """
+    def __init__(self, data:Optional[dict]=None):
+        self.data = data or {}
+        self.items:List[dict] = list(self.data.get("items") or [])
+        self.by_id:Dict[int, dict] = {}
+        self.by_name:Dict[str, List[dict]] = {}
+        self.by_label:Dict[str, dict] = {}
+        self.labels:Dict[int, str] = {}
+        self.versions:Dict[Tuple[int, str], dict] = {}
+        self.files:Dict[Tuple[int, str, str], dict] = {}
+        for item in self.items:
+            self.add(item)
+
+    def add(self, item:dict):
+        """
+        Index one model item. Items already in the catalog (same id) are ignored
+        """
+        model_id = item.get("id")
+        if model_id in self.by_id:
+            return
+        self.by_id[model_id] = item
+        self.by_name.setdefault(item["name"], []).append(item)
+        label = item["name"] if len(self.by_name[item["name"]]) == 1 else f'{item["name"]} [{model_id}]'
+        self.by_label[label] = item
+        self.labels[model_id] = label
+        for version in item.get("modelVersions") or []:
+            self.versions.setdefault((model_id, version["name"]), version)
+            for file in version.get("files") or []:
+                self.files.setdefault((model_id, version["name"], file["name"]), file)
+
+    def extend(self, data:dict):
+        """
+        Merge another page into the catalog. Models already indexed are skipped and next_page follows the new page
+        """
+        self.data = data
+        for item in data.get("items") or []:
+            if item.get("id") not in self.by_id:
+                self.items.append(item)
+                self.add(item)
+
+    @property
+    def next_page(self) -> Optional[str]:
+        return (self.data.get("metadata") or {}).get("nextPage")
+
+    def model_labels(self, show_nsfw:bool=True) -> List[str]:
+        return [self.labels[item["id"]] for item in self.by_id.values() if show_nsfw or not item.get("nsfw")]
+
+    def model(self, label:str) -> Optional[dict]:
+        return self.by_label.get(label)
+
+    def version_labels(self, label:str) -> List[str]:
+        item = self.model(label)
+        if item is None:
+            return []
+        return [f'{version["name"]} - {label}' for version in item.get("modelVersions") or []]
+
+    def version(self, label:str, version_label:str) -> Optional[dict]:
+        """
+        Look up a version by the model label and the "version - model" label shown in the dropdown
+        """
+        item = self.model(label)
+        if item is None or not version_label:
+            return None
+        return self.versions.get((item["id"], version_label.replace(f' - {label}', '').strip()))
+
+    def file(self, label:str, version_label:str, filename:str) -> Optional[dict]:
+        item = self.model(label)
+        if item is None or not version_label:
+            return None
+        return self.files.get((item["id"], version_label.replace(f' - {label}', '').strip(), filename))
@@ -0,0 +1,320 @@
+"""
+Central download scheduler: a bounded pool of worker threads fed by a priority queue
+"""
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+# Number of downloads allowed to run at the same time
+max_workers = 2
+# Finished jobs kept for status queries, the oldest are forgotten beyond this
+max_finished_jobs = 500
+# Throughput is averaged over this many seconds
+throughput_window = 5.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+SKIPPED = "skipped"
+FINISHED_STATES = (DONE, FAILED, CANCELLED, SKIPPED)
+
+class DownloadCancelled(Exception):
+    """
+    Raised inside a download when its job has been cancelled
+    """
+
+class JobProgress:
+    """
+    Thread-safe byte counters of one job, updated by the download threads and read by the status API
+    """
+    def __init__(self):
+        self.downloaded = 0
+        self.total = 0
+        self.retries = 0
+        self.bucket = None # per-job throttle.TokenBucket, attached when the download starts
+        self._samples = deque() # (monotonic time, downloaded)
+        self._lock = threading.Lock()
+
+    def start(self, downloaded:int=0, total:int=0):
+        """
+        (Re)start counting, e.g. when a resumed download already has bytes on disk
+        """
+        with self._lock:
+            self.downloaded = downloaded
+            if total:
+                self.total = total
+            self._samples.clear()
+            self._samples.append((time.monotonic(), downloaded))
+
+    def add(self, n:int):
+        with self._lock:
+            self.downloaded += n
+            now = time.monotonic()
+            self._samples.append((now, self.downloaded))
+            while len(self._samples) > 2 and now - self._samples[0][0] > throughput_window:
+                self._samples.popleft()
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            speed = 0.0
+            if len(self._samples) > 1:
+                (t0, b0), (_, b1) = self._samples[0], self._samples[-1]
+                # include the time since the last sample so a stalled download decays to 0
+                elapsed = time.monotonic() - t0
+                if elapsed > 0:
+                    speed = (b1 - b0) / elapsed
+            eta = (self.total - self.downloaded) / speed if speed > 0 and self.total else None
+            return {"downloaded_bytes": self.downloaded, "total_bytes": self.total, "bytes_per_second": round(speed, 1),
+                    "eta_seconds": round(eta, 1) if eta is not None else None, "retries": self.retries,
+                    "bytes_per_second_limit": self.bucket.rate if self.bucket is not None else 0}
+
+class DownloadJob:
+    """
+    A single queued download. Mimics the parts of threading.Thread callers used to rely on (join)
+    """
+    def __init__(self, url:str, file_name:str, priority:int=0, sha256:Optional[str]=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.url = url
+        self.file_name = file_name
+        self.priority = priority
+        self.sha256 = sha256 # expected hash of the finished file, if known
+        self.progress = JobProgress()
+        self.created = time.time()
+        self.started:Optional[float] = None
+        self.finished_at:Optional[float] = None
+        self.state = QUEUED
+        self.error:Optional[str] = None
+        self.message:Optional[str] = None
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+        self._callbacks:List[Callable] = []
+        self._callbacks_lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def join(self, timeout:Optional[float]=None) -> bool:
+        """
+        Block until the job has finished. Returns False on timeout
+        """
+        return self.done_event.wait(timeout)
+
+    def add_done_callback(self, callback:Callable):
+        """
+        Call callback(job) once the job has finished, right away if it already has.
+        Callbacks run on the worker thread and must not block
+        """
+        with self._callbacks_lock:
+            if not self.done_event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def remove_done_callback(self, callback:Callable):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def _finish(self, state:str, error:Optional[str]=None):
+        self.state = state
+        self.error = error
+        self.finished_at = time.time()
+        with self._callbacks_lock:
+            self.done_event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Download callback failed: {e}")
+
+    def status(self) -> dict:
+        """
+        Snapshot of the job for the status API
+        """
+        status = {"id": self.id, "url": self.url, "file_name": self.file_name, "state": self.state, "priority": self.priority,
+                  "error": self.error, "message": self.message, "created": self.created, "started": self.started, "finished": self.finished_at}
+        status.update(self.progress.snapshot())
+        if self.finished:
+            # the rolling rate decays once the job stops, report the average over the run instead
+            elapsed = (self.finished_at or 0) - (self.started or self.finished_at or 0)
+            status["bytes_per_second"] = round(status["downloaded_bytes"] / elapsed, 1) if elapsed > 0 else 0.0
+            status["eta_seconds"] = None
+        return status
+
+class DownloadBatch:
+    """
+    A group of jobs submitted together, reported on as one
+    """
+    def __init__(self, jobs:List[DownloadJob], total_bytes:int=0):
+        self.id = uuid.uuid4().hex[:12]
+        self.jobs = jobs
+        self.total_bytes = total_bytes # sum of the sizes the client declared, 0 if unknown
+        self.created = time.time()
+
+    def summary(self) -> dict:
+        states:Dict[str, int] = {}
+        for job in self.jobs:
+            states[job.state] = states.get(job.state, 0) + 1
+        # the declared size wins, otherwise whatever the servers reported so far
+        total_bytes = self.total_bytes or sum(job.progress.total for job in self.jobs)
+        return {"batch_id": self.id, "job_count": len(self.jobs), "total_bytes": total_bytes, "states": states,
+                "downloaded_bytes": sum(job.progress.downloaded for job in self.jobs), "finished": all(job.finished for job in self.jobs)}
+
+class DownloadScheduler:
+    """
+    Runs download jobs on a fixed number of worker threads.
+    Higher priority jobs are started first, equal priorities are served FIFO.
+    """
+    def __init__(self, target:Callable, workers:int=max_workers):
+        self.target = target # called as target(url, file_name, cancel_event, sha256, progress)
+        self.workers = max(1, int(workers))
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._jobs:Dict[str, DownloadJob] = {}
+        self.batches:Dict[str, DownloadBatch] = {}
+        self._threads:List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, url:str, file_name:str, priority:int=0, sha256:Optional[str]=None) -> DownloadJob:
+        """
+        Queue a download. If the same destination is already queued or running, that job is returned instead
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if job.file_name == file_name and not job.finished:
+                    return job
+            job = DownloadJob(url, file_name, priority, sha256)
+            self._prune()
+            self._jobs[job.id] = job
+            self._queue.put((-priority, next(self._counter), job))
+            self._spawn_workers()
+        return job
+
+    def skip(self, url:str, file_name:str, reason:str) -> DownloadJob:
+        """
+        Record a download that is not needed (e.g. the model is already installed) as a finished job
+        """
+        job = DownloadJob(url, file_name)
+        job.message = reason
+        job._finish(SKIPPED)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - max_finished_jobs)]:
+            del self._jobs[job_id]
+        # a finished batch goes with the first of its jobs
+        for batch_id in [batch_id for batch_id, batch in self.batches.items()
+                         if all(job.finished for job in batch.jobs) and any(job.id not in self._jobs for job in batch.jobs)]:
+            del self.batches[batch_id]
+
+    def add_batch(self, jobs:List[DownloadJob], total_bytes:int=0) -> DownloadBatch:
+        batch = DownloadBatch(jobs, total_bytes)
+        with self._lock:
+            self.batches[batch.id] = batch
+        return batch
+
+    def get(self, job_id:str) -> Optional[DownloadJob]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> List[DownloadJob]:
+        return list(self._jobs.values())
+
+    def cancel(self, job_id:str) -> bool:
+        """
+        Cancel a queued or running job. Returns False if the job is unknown or already finished
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return False
+            job.cancel()
+            # claimed under the lock, so a worker can no longer start it
+            queued = job.state == QUEUED
+            if queued:
+                job.state = CANCELLED
+        if queued:
+            job._finish(CANCELLED)
+        return True
+
+    def set_workers(self, workers:int):
+        """
+        Change the worker count. Extra workers exit once they finish their current job
+        """
+        with self._lock:
+            self.workers = max(1, int(workers))
+            self._spawn_workers()
+
+    def _spawn_workers(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f"civitai-download-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if len(self._threads) > self.workers:
+                    self._threads.remove(threading.current_thread())
+                    return
+            _, _, job = self._queue.get()
+            try:
+                with self._lock:
+                    # cancel() takes the same lock, a job is either started here or cancelled there
+                    if job.finished:
+                        continue
+                    cancelled = job.cancel_event.is_set()
+                    job.state = CANCELLED if cancelled else RUNNING
+                if cancelled:
+                    job._finish(CANCELLED)
+                    continue
+                job.started = time.time()
+                try:
+                    self.target(job.url, job.file_name, job.cancel_event, job.sha256, job.progress)
+                except DownloadCancelled:
+                    job._finish(CANCELLED)
+                except Exception as e:
+                    print(f"Download failed: {job.file_name} ({e})")
+                    job._finish(FAILED, str(e))
+                else:
+                    if job.cancel_event.is_set():
+                        # the file was already in place when the cancel arrived
+                        job.message = "Cancelled too late, the download had already finished"
+                    job._finish(DONE)
+            finally:
+                self._queue.task_done()
+
+_scheduler:Optional[DownloadScheduler] = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler(target:Optional[Callable]=None) -> DownloadScheduler:
+    """
+    Returns the process-wide scheduler, creating it on first use
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            if target is None:
+                from scripts.functions import download_file
+                target = download_file
+            _scheduler = DownloadScheduler(target, max_workers)
+        return _scheduler
@@ -0,0 +1,327 @@
+"""
+Download engine helpers: server capability probing, multi-connection (HTTP Range) segmented downloads
+and the on-disk resume journal that lets partial downloads survive a webui restart
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
+
+from requests.exceptions import ConnectionError
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from scripts.download_queue import DownloadCancelled
+from scripts.http_client import get_session
+from scripts.retry import RETRYABLE_STATUSES, RetryPolicy, raise_for_status
+from scripts.throttle import get_host_limiter, job_throttle
+
+# Number of parallel connections used for a segmented download, 1 disables segmented mode
+segment_count = 4
+# Files smaller than this are always fetched as a single stream
+min_segment_size = 16 * 1024 * 1024
+# Size of the reusable read buffer used while streaming a response to disk
+buffer_size = 4 * 1024 * 1024
+# Progress callbacks are batched until this many bytes (or progress_interval seconds) have accumulated
+progress_bytes = 8 * 1024 * 1024
+progress_interval = 0.5
+# Reserve disk blocks for segmented downloads up front (os.posix_fallocate) instead of a sparse file
+preallocate_files = True
+# Attempts per segment (with backoff, see scripts.retry) before the segmented download gives up
+segment_retries = 4
+# The journal is rewritten at most this often (seconds) while a download is running
+journal_interval = 2.0
+
+ProbeResult = namedtuple("ProbeResult", ["total_size", "accepts_ranges", "url", "etag"])
+
+class RangeNotSupported(IOError):
+    """
+    Raised when the server answers a range request with the whole file, segments cannot be fetched from it
+    """
+
+class PartMismatch(IOError):
+    """
+    Raised when a partial download does not fit the file on the server, so it can only be discarded
+    """
+
+def part_path(dest:str) -> str:
+    """
+    Deterministic location of the partial download for dest
+    """
+    return dest + ".part"
+
+def journal_path(dest:str) -> str:
+    return dest + ".part.json"
+
+class ResumeJournal:
+    """
+    Records what has been fetched into the .part file of a download.
+    segments is a list of [start, end, position] where position is the next byte still to fetch.
+    The journal is only ever written after the bytes it describes were flushed to the part file,
+    and it is replaced atomically, so a killed process leaves a journal that is safe to resume from.
+    """
+    def __init__(self, dest:str, url:str, total_size:int=0, etag:Optional[str]=None, mode:str="stream", segments:Optional[List[List[int]]]=None):
+        self.dest = dest
+        self.url = url
+        self.total_size = total_size
+        self.etag = etag
+        self.mode = mode
+        self.segments = segments or []
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @classmethod
+    def load(cls, dest:str) -> Optional["ResumeJournal"]:
+        try:
+            with open(journal_path(dest), "r") as f:
+                data = json.load(f)
+            return cls(dest, data["url"], data.get("total_size", 0), data.get("etag"), data.get("mode", "stream"), data.get("segments"))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def matches(self, url:str, total_size:int, etag:Optional[str], mode:str) -> bool:
+        """
+        True if the partial file was produced from the same remote file in the same download mode
+        """
+        if self.url != url or self.mode != mode or not os.path.exists(part_path(self.dest)):
+            return False
+        if total_size and self.total_size and total_size != self.total_size:
+            return False
+        if etag and self.etag and etag != self.etag:
+            return False
+        return True
+
+    @property
+    def downloaded(self) -> int:
+        return sum(position - start for start, _, position in self.segments)
+
+    def save(self):
+        with self._lock:
+            data = {"url": self.url, "total_size": self.total_size, "etag": self.etag, "mode": self.mode, "segments": self.segments}
+            tmp_path = journal_path(self.dest) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, journal_path(self.dest))
+            self._saved_at = time.monotonic()
+
+    def record(self, index:int, position:int):
+        """
+        Update the position of a segment, saving the journal if it is due
+        """
+        self.segments[index][2] = position
+        if time.monotonic() - self._saved_at >= journal_interval:
+            self.save()
+
+    def remove(self):
+        """
+        Forget the journal, keeping the part file
+        """
+        if os.path.exists(journal_path(self.dest)):
+            os.remove(journal_path(self.dest))
+
+    def discard(self):
+        """
+        Remove both the journal and the partial data
+        """
+        self.remove()
+        if os.path.exists(part_path(self.dest)):
+            os.remove(part_path(self.dest))
+
+def preallocate(f, size:int):
+    """
+    Size f to `size` bytes, reserving the blocks with posix_fallocate where available
+    """
+    if preallocate_files and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # not supported by this filesystem (e.g. some network mounts), fall back to a sparse file
+            pass
+    f.truncate(size)
+
+def copy_stream(response, f, limit:Optional[int]=None, stopped=None, on_progress=None, hasher=None, throttle=None) -> int:
+    """
+    Copy the body of a streamed requests response into the unbuffered file f.
+    Reads go straight into one reusable buffer with readinto and on_progress is called in batches,
+    so a multi-GB file costs a few thousand Python iterations instead of millions.
+    Stops after `limit` bytes if given. Every block written is also fed to hasher, if given.
+    A throttle.Throttle, if given, caps the read size and sleeps between reads to hold its rate.
+    Returns the number of bytes written.
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    raw = response.raw
+    raw.decode_content = True
+    written = 0
+    pending = 0
+    reported_at = time.monotonic()
+    try:
+        while limit is None or written < limit:
+            if stopped is not None and stopped():
+                raise DownloadCancelled("Download cancelled")
+            want = buffer_size if limit is None else min(buffer_size, limit - written)
+            if throttle is not None:
+                want = min(want, throttle.chunk_size() or want)
+            try:
+                n = raw.readinto(view[:want])
+            except (ProtocolError, ReadTimeoutError) as e:
+                # raw reads bypass the exception wrapping iter_content does
+                raise ConnectionError(e) from e
+            if not n:
+                break
+            if throttle is not None:
+                throttle.consume(n, stopped)
+            offset = 0
+            while offset < n:
+                offset += f.write(view[offset:n])
+            if hasher is not None:
+                hasher.update(view[:n])
+            written += n
+            pending += n
+            if on_progress is not None and (pending >= progress_bytes or time.monotonic() - reported_at >= progress_interval):
+                on_progress(pending)
+                pending = 0
+                reported_at = time.monotonic()
+    finally:
+        # bytes already written count even when the connection drops, so a resume starts after them
+        if on_progress is not None and pending:
+            on_progress(pending)
+    return written
+
+def probe(url:str, stopped=None) -> ProbeResult:
+    """
+    Ask the server for the size of url and whether it serves byte ranges.
+    total_size is 0 if unknown. url is the final url after redirects,
+    so segments don't each repeat the redirect.
+    Throttling and server errors are retried, other statuses are left to the single-stream download.
+    """
+    def request():
+        # the probe is a connection like any other and waits for a slot on the host
+        with get_host_limiter().slot(url, stopped), get_session().get(url, headers={"Range": "bytes=0-0"}, stream=True, allow_redirects=True) as response:
+            if response.status_code in RETRYABLE_STATUSES:
+                raise_for_status(response)
+            final_url = response.url or url
+            etag = response.headers.get("ETag")
+            if response.status_code == 206:
+                content_range = response.headers.get("Content-Range", "")
+                # bytes 0-0/12345
+                total = content_range.rsplit("/", 1)[-1]
+                if total.isdigit():
+                    return ProbeResult(int(total), True, final_url, etag)
+                return ProbeResult(0, False, final_url, etag)
+            if response.status_code == 200:
+                total_size = int(response.headers.get("Content-Length", 0) or 0)
+                accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+                return ProbeResult(total_size, accepts_ranges and total_size > 0, final_url, etag)
+            return ProbeResult(0, False, final_url, etag)
+    return RetryPolicy().run(request, stopped)
+
+def content_total(response, offset:int=0) -> Optional[int]:
+    """
+    Size of the whole file from a response that starts at offset: the total of Content-Range,
+    or Content-Length plus offset. None if the server sent neither
+    """
+    content_range = response.headers.get("Content-Range", "")
+    total = content_range.rsplit("/", 1)[-1]
+    if total.isdigit():
+        return int(total)
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit():
+        return int(length) + offset
+    return None
+
+def split_ranges(total_size:int, segments:int) -> List[Tuple[int, int]]:
+    """
+    Split [0, total_size) into at most `segments` inclusive (start, end) byte ranges
+    """
+    segments = max(1, min(segments, total_size // max(1, min_segment_size) or 1))
+    step = -(-total_size // segments)
+    return [(start, min(start + step, total_size) - 1) for start in range(0, total_size, step)]
+
+def should_segment(total_size:int, accepts_ranges:bool) -> bool:
+    return accepts_ranges and segment_count > 1 and total_size >= 2 * min_segment_size
+
+def _fetch_segment(url:str, journal:ResumeJournal, index:int, stopped, on_progress, on_retry=None, throttle=None):
+    start, end, position = journal.segments[index]
+    checked = position
+
+    def fetch():
+        if position > end:
+            return
+        with get_host_limiter().slot(url, stopped), get_session().get(url, headers={"Range": f"bytes={position}-{end}"}, stream=True) as response:
+            if response.status_code == 200:
+                raise RangeNotSupported("Server ignored range request (status 200)")
+            raise_for_status(response, (206,))
+            with open(part_path(journal.dest), "r+b", buffering=0) as f:
+                f.seek(position)
+                def advance(n):
+                    nonlocal position
+                    position += n
+                    journal.record(index, position)
+                    on_progress(n)
+                copy_stream(response, f, end + 1 - position, stopped, advance, throttle=throttle)
+        if position <= end:
+            raise ConnectionError(f"Segment {start}-{end} ended early at {position}")
+
+    def progressed():
+        nonlocal checked
+        moved, checked = position > checked, position
+        return moved
+
+    RetryPolicy(segment_retries).run(fetch, stopped, on_retry, progressed)
+
+def segmented_download(url:str, journal:ResumeJournal, cancel_event:Optional[threading.Event]=None, progress=None, job_progress=None):
+    """
+    Fetch the unfinished segments of journal from url using concurrent Range requests.
+    The part file is preallocated to the full size and every segment writes into its own slice of it.
+    Raises on any failed segment; the journal keeps whatever was completed.
+    job_progress (a download_queue.JobProgress) is kept up to date for the status API.
+    """
+    if not os.path.exists(part_path(journal.dest)):
+        with open(part_path(journal.dest), "wb") as f:
+            preallocate(f, journal.total_size)
+    journal.save()
+
+    lock = threading.Lock()
+    abort = threading.Event()
+    def stopped():
+        return abort.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+    def on_progress(n):
+        if progress is not None:
+            with lock:
+                progress.update(n)
+        if job_progress is not None:
+            job_progress.add(n)
+
+    on_retry = job_progress.retry if job_progress is not None else None
+    throttle = job_throttle(job_progress)
+    if job_progress is not None:
+        job_progress.start(journal.downloaded, journal.total_size)
+
+    pending = [i for i, (_, end, position) in enumerate(journal.segments) if position <= end]
+    failed = []
+    if pending:
+        with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="civitai-segment") as pool:
+            futures = [pool.submit(_fetch_segment, url, journal, i, stopped, on_progress, on_retry, throttle) for i in pending]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [future for future in done if future.exception() is not None]
+            if failed:
+                # make the remaining segments stop as soon as possible
+                abort.set()
+    journal.save()
+    if failed:
+        raise failed[0].exception()
+
+def finalize(journal:ResumeJournal, stopped=None):
+    """
+    Atomically move a completed part file into place and drop its journal.
+    A cancel that arrived while the last block was being read still stops the download here
+    """
+    if stopped is not None and stopped():
+        raise DownloadCancelled("Download cancelled")
+    os.replace(part_path(journal.dest), journal.dest)
+    journal.remove()
@@ -1,32 +1,52 @@
-import requests
-import json
+import hashlib
 import time
-import threading
-import urllib.request
-import urllib.error
 import os
 from tqdm import tqdm
 import re
 from requests.exceptions import ConnectionError
 import shutil
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import gradio as gr
-
-# Set the URL for the API endpoint
-api_url = "https://civitai.com/api/v1/models?limit=50"
-json_data = None
+from scripts.download_queue import DownloadCancelled, get_scheduler
+from scripts.throttle import get_host_limiter, job_throttle
+from scripts import downloader, hashing, records, retry, thumbnails
+from scripts.http_client import get_session
+from scripts.api_cache import conditional_headers, get_api_cache, response_validators
+from scripts.sessions import find_browse_state, get_browse_state
+from scripts.prefetch import get_prefetcher
+from scripts.search_index import get_search_index
+from scripts.inventory import get_inventory
+from scripts.routing import content_types, get_router
+
+# Set the URL for the API endpoint. CIVITAI_API_BASE points the browser at a mirror or at a local
+# stand-in such as benchmarks/fixture_server.py
+default_api_root = "https://civitai.com/api/v1"
+api_root = os.environ.get("CIVITAI_API_BASE", default_api_root).rstrip("/")
+api_url = f"{api_root}/models?limit=50"
+# Budget for stream_model_list, whichever is reached first ends the crawl
+stream_max_items = 1000
+stream_max_pages = 20
+# Number of preview images fetched in parallel by save_image_files
+image_workers = 8
+
+
+def set_api_root(url=None):
+    """Switch the API base url at runtime, None goes back to civitai.com. Pages cached for the old one are not reused"""
+    global api_root, api_url
+    api_root = (url or default_api_root).rstrip("/")
+    api_url = f"{api_root}/models?limit=50"
+    return api_root
 
 def create_dummy(file_name):
     dummy_path = get_dummy_path(file_name)
     os.makedirs(os.path.dirname(dummy_path), exist_ok=True)
     with open(dummy_path, 'w') as f:
-        f.write('dummy')
+        # the owner pid lets later runs tell a live download from one left behind by a dead process
+        f.write(str(os.getpid()))
         
 def get_dummy_path(file_name):
     """Get the path to the dummy file for the given file_name"""
-    dir_name = os.path.dirname(file_name)
-    dir_name = os.path.abspath(dir_name)
-    return os.path.join(dir_name,file_name + ".dummy")
+    return os.path.abspath(file_name) + ".dummy"
         
 def remove_dummy(file_name):
     dummy_path = get_dummy_path(file_name)
@@ -34,28 +54,55 @@ def remove_dummy(file_name):
         os.remove(dummy_path)
         
 def check_dummy(file_name):
-    return os.path.exists(get_dummy_path(file_name))
-
-def remove_empty_directories(path):
-    if not os.path.isdir(path):
-        return
-    files = os.listdir(path)
-    if len(files):
-        for f in files:
-            fullpath = os.path.join(path, f)
-            if os.path.isdir(fullpath):
-                remove_empty_directories(fullpath)
-    files = os.listdir(path)
-    if len(files) == 0:
-        print("Removing empty directory:", path)
-        os.rmdir(path)
-        
-def download_file(url, file_name):
-    # Maximum number of retries
-    max_retries = 5
-
-    # Delay between retries (in seconds)
-    retry_delay = 10
+    """Returns True if a live process is downloading file_name. Markers of dead processes are reclaimed."""
+    dummy_path = get_dummy_path(file_name)
+    if not os.path.exists(dummy_path):
+        return False
+    if is_stale_dummy(dummy_path):
+        print(f"Reclaiming stale download marker: {dummy_path}")
+        os.remove(dummy_path)
+        return False
+    return True
+
+def pid_alive(pid):
+    if pid <= 0:
+        return False
+    if os.name == "nt":
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def is_stale_dummy(dummy_path):
+    try:
+        with open(dummy_path, 'r') as f:
+            content = f.read().strip()
+    except OSError:
+        return False
+    # markers written by older versions only contain 'dummy' and have no owner to check
+    if not content.isdigit():
+        return True
+    return not pid_alive(int(content))
+
+def reclaim_stale_dummies(folders):
+    """Remove .dummy markers left behind by processes that are no longer running"""
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for f in files:
+                if f.endswith(".dummy") and is_stale_dummy(os.path.join(root, f)):
+                    print(f"Reclaiming stale download marker: {os.path.join(root, f)}")
+                    os.remove(os.path.join(root, f))
+
+def download_file(url, file_name, cancel_event=None, sha256=None, job_progress=None):
     if os.path.exists(file_name):
         # skip if exists
         return
@@ -63,86 +110,221 @@ def download_file(url, file_name):
     if check_dummy(file_name):
         return
     
+    # the folder may have been cleaned up by a failed job since this one was queued
+    get_router().ensure_dir(os.path.dirname(file_name))
     create_dummy(file_name)
     try:
         dest = file_name
-        file_name = tempfile.NamedTemporaryFile().name
+        # partial data is kept next to the destination so it can be resumed after a restart
+        file_name = downloader.part_path(dest)
+        stopped = lambda: cancel_event is not None and cancel_event.is_set()
 
-        while True:
-            # Check if the file has already been partially downloaded
-            if os.path.exists(file_name):
-                # Get the size of the downloaded file
+        try:
+            probe = downloader.probe(url, stopped)
+        except (ConnectionError, retry.HttpStatusError) as e:
+            print(f"Could not probe {url}: {e}")
+            probe = None
+        digest = download_segmented(url, dest, probe, cancel_event, sha256, job_progress)
+        if digest:
+            get_installed_inventory().add_file(dest, digest, persist=True)
+            return
+
+        # what the probe saw of the file, a partial download of another version of it is not resumed
+        total_size, etag = (probe.total_size, probe.etag) if probe is not None else (0, None)
+        journal = downloader.ResumeJournal.load(dest)
+        if journal is None or not journal.matches(url, total_size, etag, "stream"):
+            if journal is not None or os.path.exists(file_name):
+                print(f"Discarding partial download of {os.path.basename(dest)}")
+            journal = downloader.ResumeJournal(dest, url, total_size, etag, "stream")
+            journal.discard()
+        journal.save()
+
+        downloaded_size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+        # the file is hashed as it is written, only bytes from an earlier run are read back
+        hasher = hashing.update_from_file(hashlib.sha256(), file_name) if downloaded_size else hashlib.sha256()
+        file_name_display = os.path.basename(dest)
+
+        # Initialize the progress bar, its total is set once the server has told us the size
+        progress = tqdm(unit="B", unit_scale=True, desc=f"Downloading {file_name_display}", initial=downloaded_size, leave=False)
+        on_progress = track_progress(progress, job_progress)
+        throttle = job_throttle(job_progress)
+        # the redirect was followed by the probe, so the slot is taken on the host that serves the file
+        stream_url = probe.url if probe is not None else url
+        checked_size = downloaded_size
+
+        def restart(f):
+            nonlocal hasher
+            f.truncate(0)
+            hasher = hashlib.sha256()
+            progress.reset()
+
+        def fetch(f):
+            while True:
+                # Resume from what is on disk now, an earlier attempt may have added to it
                 downloaded_size = os.path.getsize(file_name)
+                headers = {"Range": f"bytes={downloaded_size}-"} if downloaded_size else {}
+                # the server only sends the rest if the file is still the one the part came from, else all of it
+                if downloaded_size and journal.etag and not journal.etag.startswith("W/"):
+                    headers["If-Range"] = journal.etag
+                # the host slot is held until the body has been copied
+                with get_host_limiter().slot(stream_url, stopped), get_session().get(stream_url, headers=headers, stream=True) as response:
+                    if response.status_code == 416 and downloaded_size:
+                        # nothing left to send, unless the file on the server changed
+                        total_size = downloader.content_total(response, 0)
+                        if total_size == downloaded_size:
+                            return total_size
+                        raise downloader.PartMismatch(f"{file_name_display} changed on the server, {downloaded_size} bytes on disk but the file has {total_size}")
+                    # error pages must never end up in the model file
+                    retry.raise_for_status(response, (200, 206) if downloaded_size else (200,))
+
+                    # A server that ignores the Range header (or If-Range saw a new file) sends the whole file again
+                    if response.status_code == 200 and downloaded_size:
+                        restart(f)
+                        downloaded_size = 0
+
+                    # None when the server doesn't say, the download then ends with the stream
+                    total_size = downloader.content_total(response, downloaded_size)
+                    response_etag = response.headers.get("ETag")
+                    if downloaded_size and (journal.etag and response_etag and response_etag != journal.etag
+                                            or journal.total_size and total_size and total_size != journal.total_size):
+                        # the rest of a different file, start over from the first byte
+                        print(f"{file_name_display} changed on the server, restarting the download")
+                        restart(f)
+                        journal.etag, journal.total_size = response_etag, total_size or 0
+                        journal.save()
+                        continue
+                    journal.etag = response_etag or journal.etag
+                    journal.total_size = total_size or 0
+                    journal.save()
+                    progress.total = total_size
+                    if job_progress is not None:
+                        job_progress.start(downloaded_size, total_size or 0)
+
+                    # Write the response to the local file and update the progress bar
+                    downloader.copy_stream(response, f, stopped=stopped, on_progress=on_progress, hasher=hasher, throttle=throttle)
 
-                # Set the range of the request to start from the current size of the downloaded file
-                headers = {"Range": f"bytes={downloaded_size}-"}
-            else:
-                downloaded_size = 0
-                headers = {}
-
-            # Split filename from included path
-            tokens = re.split(re.escape('\\'), dest)
-            file_name_display = tokens[-1]
-
-            # Initialize the progress bar
-            progress = tqdm(total=1000000000, unit="B", unit_scale=True, desc=f"Downloading {file_name_display}", initial=downloaded_size, leave=False)
-
-            # Open a local file to save the download
-            with open(file_name, "ab") as f:
-                while True:
-                    try:
-                        # Send a GET request to the URL and save the response to the local file
-                        response = requests.get(url, headers=headers, stream=True)
-
-                        # Get the total size of the file
-                        total_size = int(response.headers.get("Content-Length", 0))
-
-                        # Update the total size of the progress bar if the `Content-Length` header is present
-                        if total_size == 0:
-                            total_size = downloaded_size
-                        progress.total = total_size 
-
-                        # Write the response to the local file and update the progress bar
-                        for chunk in response.iter_content(chunk_size=1024):
-                            if chunk:  # filter out keep-alive new chunks
-                                f.write(chunk)
-                                progress.update(len(chunk))
-
-                        downloaded_size = os.path.getsize(file_name)
-                        # Break out of the loop if the download is successful
-                        break
-                    except ConnectionError as e:
-                        # Decrement the number of retries
-                        max_retries -= 1
-
-                        # If there are no more retries, raise the exception
-                        if max_retries == 0:
-                            # remove temp file
-                            if os.path.exists(file_name):
-                                os.remove(file_name)
-                            remove_dummy(dest)
-                            raise ConnectionError(f"Failed to download from {url}.") from e
-
-                        # Wait for the specified delay before retrying
-                        time.sleep(retry_delay)
+                downloaded_size = os.path.getsize(file_name)
+                if total_size is not None and downloaded_size < total_size:
+                    raise ConnectionError(f"Download of {file_name_display} ended early at {downloaded_size} of {total_size} bytes")
+                if total_size is not None and downloaded_size > total_size:
+                    raise downloader.PartMismatch(f"Download of {file_name_display} is larger than the {total_size} bytes announced")
+                return downloaded_size
+
+        def progressed():
+            nonlocal checked_size
+            size = os.path.getsize(file_name)
+            moved, checked_size = size > checked_size, size
+            return moved
 
+        try:
+            # Open a local file to save the download, unbuffered since copy_stream writes in large blocks
+            with open(file_name, "ab", buffering=0) as f:
+                retry.RetryPolicy().run(lambda: fetch(f), stopped, job_progress.retry if job_progress is not None else None, progressed)
+        except DownloadCancelled:
+            raise DownloadCancelled(f"Download of {file_name_display} cancelled")
+        except downloader.PartMismatch:
+            # the same journal would fail the same way on every later attempt
+            journal.discard()
+            raise
+        except retry.HttpStatusError:
+            # nothing worth resuming, e.g. a 404
+            if not os.path.getsize(file_name):
+                journal.discard()
+            raise
+        finally:
             # Close the progress bar
             progress.close()
-            downloaded_size = os.path.getsize(file_name)
-            # Check if the download was successful
-            if downloaded_size >= total_size:
-                print(f"{file_name_display} successfully downloaded.")
-                # move to dest
-                shutil.move(file_name, dest)
-                break
-            else:
-                print(f"Error: File download failed. Retrying... {file_name_display}")
-        if os.path.exists(file_name):
-            os.remove(file_name)
+
+        digest = hasher.hexdigest().upper()
+        try:
+            hashing.check_sha256(digest, sha256, file_name_display)
+        except hashing.HashMismatch:
+            # never move a corrupt file into place
+            journal.discard()
+            raise
+        # move to dest
+        downloader.finalize(journal, stopped)
+        print(f"{file_name_display} successfully downloaded.")
+        get_installed_inventory().add_file(dest, digest, persist=True)
+    except DownloadCancelled:
+        # a cancelled download is not resumed
+        downloader.ResumeJournal(dest, url).discard()
+        raise
     finally:
         remove_dummy(dest)
-        # clean up empty directories
-        remove_empty_directories(os.path.dirname(dest))
+        # remove the model folder again if it was created for this download and nothing landed in it
+        get_router().remove_if_empty(os.path.dirname(dest))
+
+def track_progress(progress_bar, job_progress=None):
+    """Progress callback feeding both the console bar and the job's counters for the status API"""
+    if job_progress is None:
+        return progress_bar.update
+    def update(n):
+        progress_bar.update(n)
+        job_progress.add(n)
+    return update
+
+def download_segmented(url, dest, probe, cancel_event=None, sha256=None, job_progress=None):
+    """
+    Try to fetch url over several connections into a preallocated part file next to dest.
+    probe is the result of downloader.probe(url), None if the probe failed.
+    A matching journal from an earlier run is resumed from where it stopped.
+    Returns the SHA256 of the finished file, checked against sha256 if given, or None
+    when the server can't do ranges (or ignores them) so the caller streams instead.
+    """
+    if probe is None or not downloader.should_segment(probe.total_size, probe.accepts_ranges):
+        return None
+
+    journal = downloader.ResumeJournal.load(dest)
+    if journal is not None and journal.matches(url, probe.total_size, probe.etag, "segmented"):
+        print(f"Resuming {os.path.basename(dest)} at {journal.downloaded} of {probe.total_size} bytes")
+    else:
+        if journal is not None:
+            journal.discard()
+        segments = [[start, end, start] for start, end in downloader.split_ranges(probe.total_size, downloader.segment_count)]
+        journal = downloader.ResumeJournal(dest, url, probe.total_size, probe.etag, "segmented", segments)
+        if os.path.exists(downloader.part_path(dest)):
+            os.remove(downloader.part_path(dest))
+
+    file_name_display = os.path.basename(dest)
+    progress = tqdm(total=probe.total_size, unit="B", unit_scale=True, desc=f"Downloading {file_name_display}", initial=journal.downloaded, leave=False)
+    hasher = hashing.PrefixHasher(journal, downloader.part_path(dest))
+    try:
+        # segments are hashed in order while later ones are still arriving
+        hasher.start()
+        downloader.segmented_download(probe.url, journal, cancel_event, progress, job_progress)
+    except downloader.RangeNotSupported as e:
+        hasher.stop()
+        print(f"Segmented download failed, falling back to a single stream: {e}")
+        journal.discard()
+        return None
+    except Exception:
+        # anything else (dropped connections, timeouts, server errors...) keeps the journal so the next attempt resumes
+        hasher.stop()
+        raise
+    finally:
+        progress.close()
+    digest = hasher.finish()
+    try:
+        hashing.check_sha256(digest, sha256, file_name_display)
+    except hashing.HashMismatch:
+        # never move a corrupt file into place
+        journal.discard()
+        raise
+    downloader.finalize(journal, lambda: cancel_event is not None and cancel_event.is_set())
+    print(f"{file_name_display} successfully downloaded.")
+    return digest
+
+def get_installed_inventory():
+    """Inventory of the models in every content type folder, scanned in the background on first use"""
+    return get_inventory(get_router().folders_in_use())
+
+def download_selected_model(url, file_name, content_type, use_new_folder, model_name, model_version=None, session_id=None):
+    """Download button of the browser tab. Passes the file hashes from the catalog so installed copies are skipped"""
+    state = find_browse_state(session_id)
+    file = state.catalog.file(model_name, model_version, file_name)
+    job = download_file_thread(url, file_name, content_type, use_new_folder, model_name, hashes=(file or {}).get('hashes'))
+    return job
 
 def replace_invalid_chars(file_name):
     first_processed = file_name.replace(" ","_").replace("(","").replace(")","").replace("|","").replace(":","-")
@@ -163,8 +345,8 @@ def wrapped_download_file_thread(url, file_name:str, content_type, use_new_folde
     file_name = replace_invalid_chars(file_name)
     if "." not in file_name:
         file_name = file_name + ".safetensors"
-    if content_type not in ["Checkpoint", "Hypernetwork", "TextualInversion", "AestheticGradient", "VAE", "LORA", "LoCon"]:
-        return f"Invalid content type, given {content_type} but expected one of ['Checkpoint', 'Hypernetwork', 'TextualInversion', 'AestheticGradient', 'VAE', 'LORA', 'LoCon']"
+    if content_type not in content_types():
+        return f"Invalid content type, given {content_type} but expected one of {content_types()}"
     if not model_name:
         # remove ext from file name
         if "." in file_name:
@@ -176,118 +358,45 @@ def wrapped_download_file_thread(url, file_name:str, content_type, use_new_folde
     download_file_thread(url, file_name, content_type, use_new_folder, model_name)
     return f"Downloading {model_name}..."
 
-def download_file_thread(url, file_name, content_type, use_new_folder, model_name):
+def download_file_thread(url, file_name, content_type, use_new_folder, model_name, priority=0, hashes=None):
     """
-    Download the file and save it to a local file
+    Queue the file for download on the shared download scheduler
     
     @param url:string The URL of the file to download, example) https://example.com/file.txt (may or may not contain file name)
     @param file_name:string The name of the file to save the download to example) file.txt
     @param content_type:string The type of content being downloaded, example) Checkpoint, Hypernetwork, TextualInversion, AestheticGradient, VAE, LORA, LoCon
     @param use_new_folder:boolean Whether to save the file to a new folder or not (default: False)
     @param model_name:string The name of the model being downloaded, used for subfolder (default: None or use file_name)
+    @param priority:int Jobs with a higher priority are started first (default: 0)
+    @param hashes:dict The CivitAI files[].hashes of the file, if known. An installed copy with a matching hash skips the download
+                       and the finished download is checked against the SHA256
 
     """
     model_name = replace_invalid_chars(model_name)
-    if content_type == "Checkpoint":
-        folder = "models/Stable-diffusion"
-        new_folder = "models/Stable-diffusion/new"
-    elif content_type == "Hypernetwork":
-        folder = "models/hypernetworks"
-        new_folder = "models/hypernetworks/new"
-    elif content_type == "TextualInversion":
-        folder = "embeddings"
-        new_folder = "embeddings/new"
-    elif content_type == "AestheticGradient":
-        folder = "extensions/stable-diffusion-webui-aesthetic-gradients/aesthetic_embeddings"
-        new_folder = "extensions/stable-diffusion-webui-aesthetic-gradients/aesthetic_embeddings/new"
-    elif content_type == "VAE":
-        folder = "models/VAE"
-        new_folder = "models/VAE/new"
-    elif content_type == "LORA" or content_type == "LoCon":
-        folder = "models/Lora"
-        new_folder = "models/Lora/new"
-    if content_type == "TextualInversion" or content_type == "VAE" or content_type == "AestheticGradient":
-        if use_new_folder:
-            model_folder = new_folder
-            if not os.path.exists(new_folder):
-                os.makedirs(new_folder)
-            
-        else:
-            model_folder = folder
-            if not os.path.exists(model_folder):
-                os.makedirs(model_folder)
-    else:            
-        if use_new_folder:
-            model_folder = os.path.join(new_folder,model_name)
-            if not os.path.exists(new_folder):
-                os.makedirs(new_folder)
-            if not os.path.exists(model_folder):
-                os.makedirs(model_folder)
-            
-        else:
-            model_folder = os.path.join(folder,model_name)
-            if not os.path.exists(model_folder):
-                os.makedirs(model_folder)
+    installed = get_installed_inventory().find(hashes) if hashes else None
+    if installed:
+        print(f"{file_name} is already installed at {installed}, skipping download")
+        return get_scheduler().skip(url, installed, f"already installed at {installed}")
+    model_folder = get_router().prepare(content_type, model_name, use_new_folder)
 
     path_to_new_file = os.path.join(model_folder, file_name)     
 
-    thread = threading.Thread(target=download_file, args=(url, path_to_new_file))
-
-        # Start the thread
-    thread.start()
-    return thread # return the thread so we can wait for it to finish if we want
+    job = get_scheduler().submit(url, path_to_new_file, priority, (hashes or {}).get('SHA256'))
+    return job # return the job so we can wait for it to finish (job.join()) or cancel it
 
 def save_text_file(file_name, content_type, use_new_folder, trained_words, model_name):
     model_name = replace_invalid_chars(model_name)
     print("Save Text File Clicked")
-    if content_type == "Checkpoint":
-        folder = "models/Stable-diffusion"
-        new_folder = "models/Stable-diffusion/new"
-    elif content_type == "Hypernetwork":
-        folder = "models/hypernetworks"
-        new_folder = "models/hypernetworks/new"
-    elif content_type == "TextualInversion":
-        folder = "embeddings"
-        new_folder = "embeddings/new"
-    elif content_type == "AestheticGradient":
-        folder = "extensions/stable-diffusion-webui-aesthetic-gradients/aesthetic_embeddings"
-        new_folder = "extensions/stable-diffusion-webui-aesthetic-gradients/aesthetic_embeddings/new"
-    elif content_type == "VAE":
-        folder = "models/VAE"
-        new_folder = "models/VAE/new"
-    elif content_type == "LORA":
-        folder = "models/Lora"
-        new_folder = "models/Lora/new"
-    elif content_type == "LoCon":
-        folder = "models/Lora"
-        new_folder = "models/Lora/new"
-    if content_type == "TextualInversion" or content_type == "VAE" or content_type == "AestheticGradient":
-        if use_new_folder:
-            model_folder = new_folder
-            if not os.path.exists(new_folder):
-                os.makedirs(new_folder)
-            
-        else:
-            model_folder = folder
-            if not os.path.exists(model_folder):
-                os.makedirs(model_folder)
-    else:            
-        if use_new_folder:
-            model_folder = os.path.join(new_folder,model_name)
-            if not os.path.exists(new_folder):
-                os.makedirs(new_folder)
-            if not os.path.exists(model_folder):
-                os.makedirs(model_folder)
-            
-        else:
-            model_folder = os.path.join(folder,model_name)
-            if not os.path.exists(model_folder):
-                os.makedirs(model_folder)
-   
+    model_folder = get_router().prepare(content_type, model_name, use_new_folder)
+    return write_text_file(model_folder, file_name, trained_words)
+
+def write_text_file(model_folder, file_name, trained_words):
+    """Write the trained words next to the model file unless a text file is already there. Returns its path"""
     path_to_new_file = os.path.join(model_folder, file_name.replace(".ckpt",".txt").replace(".safetensors",".txt").replace(".pt",".txt").replace(".yaml",".txt"))
     if not os.path.exists(path_to_new_file):
-        with open(path_to_new_file, 'w') as f:
+        with get_router().open(path_to_new_file, 'w') as f:
             f.write(trained_words)
+    return path_to_new_file
 
 def api_to_data(content_type, sort_type, use_search_term, search_term=None):
     if use_search_term and search_term:
@@ -296,185 +405,243 @@ def api_to_data(content_type, sort_type, use_search_term, search_term=None):
     else:
         return request_civit_api(f"{api_url}&types={content_type}&sort={sort_type}")
 
-def api_next_page(next_page_url=None):
-    global json_data
-    try: json_data['metadata']['nextPage']
-    except: return
-    if json_data['metadata']['nextPage'] is not None:
-        next_page_url = json_data['metadata']['nextPage']
+def api_next_page(state, next_page_url=None):
+    if state.next_page is not None:
+        next_page_url = state.next_page
     if next_page_url is not None:
+        # usually already fetched in the background, see prefetch_next_page
+        get_prefetcher(request_civit_api).wait(next_page_url)
         return request_civit_api(next_page_url)
 
-def update_next_page(show_nsfw):
-    global json_data
-    json_data = api_next_page()
-    model_dict = {}
-    try: json_data['items']
-    except TypeError: return gr.Dropdown.update(choices=[], value=None)
-    if show_nsfw:
-        for item in json_data['items']:
-            model_dict[item['name']] = item['name']
-    else:
-        for item in json_data['items']:
-            temp_nsfw = item['nsfw']
-            if not temp_nsfw:
-                model_dict[item['name']] = item['name']
-    return gr.Dropdown.update(choices=[v for k, v in model_dict.items()], value=None), gr.Dropdown.update(choices=[], value=None)
-
-def update_model_list(content_type, sort_type, use_search_term, search_term, show_nsfw):
-    global json_data
-    json_data = api_to_data(content_type, sort_type, use_search_term, search_term)
-    model_dict = {}
-    if show_nsfw:
-        for item in json_data['items']:
-            model_dict[item['name']] = item['name']
-    else:
-        for item in json_data['items']:
-            temp_nsfw = item['nsfw']
-            if not temp_nsfw:
-                model_dict[item['name']] = item['name']
+def prefetch_next_page(state):
+    """Start loading the page after the one just shown so Next Page is served from the cache"""
+    get_prefetcher(request_civit_api).prefetch(state.next_page)
 
-    return gr.Dropdown.update(choices=[v for k, v in model_dict.items()], value=None), gr.Dropdown.update(choices=[], value=None)
-
-def update_model_versions(model_name=None):
+def update_next_page(show_nsfw, session_id=None):
+    session_id, state = get_browse_state(session_id)
+    json_data = api_next_page(state)
+    try: json_data['items']
+    except TypeError:
+        # no further page, keep showing the current one
+        return gr.Dropdown.update(), gr.Dropdown.update(), session_id
+    state.load(json_data, next_page=True)
+    prefetch_next_page(state)
+    return gr.Dropdown.update(choices=state.catalog.model_labels(show_nsfw), value=None), gr.Dropdown.update(choices=[], value=None), session_id
+
+def local_search(content_type, search_term, show_nsfw):
+    """Answer a search from the local index of previously fetched models, None if it has no matches"""
+    index = get_search_index()
+    if index is None or not search_term:
+        return None
+    items = index.search(search_term, content_type, show_nsfw)
+    if not items:
+        return None
+    return {"items": [records.compact_item(item) for item in items], "metadata": {}}
+
+def update_model_list(content_type, sort_type, use_search_term, search_term, show_nsfw, local_first=False, session_id=None):
+    session_id, state = get_browse_state(session_id)
+    json_data = local_search(content_type, search_term, show_nsfw) if local_first and use_search_term else None
+    if json_data is None:
+        json_data = api_to_data(content_type, sort_type, use_search_term, search_term)
+    state.load(json_data)
+    prefetch_next_page(state)
+    return gr.Dropdown.update(choices=state.catalog.model_labels(show_nsfw), value=None), gr.Dropdown.update(choices=[], value=None), session_id
+
+def stream_model_list(content_type, sort_type, use_search_term, search_term, show_nsfw, max_items=None, session_id=None):
+    """
+    Generator version of update_model_list: follows nextPage cursors and yields the merged, de-duplicated
+    model list after every page until max_items models or stream_max_pages pages have been seen
+    """
+    max_items = int(max_items or stream_max_items)
+    session_id, state = get_browse_state(session_id)
+    state.load(api_to_data(content_type, sort_type, use_search_term, search_term))
+    generation = state.generation
+    yield gr.Dropdown.update(choices=state.catalog.model_labels(show_nsfw), value=None), gr.Dropdown.update(choices=[], value=None), session_id
+    while state.page < stream_max_pages and len(state.catalog.by_id) < max_items and state.next_page:
+        try:
+            json_data = api_next_page(state)
+        except gr.Error:
+            # already logged by request_civit_api, keep the pages shown so far and don't prefetch the failed one
+            return
+        # stop if another listing was started in this session meanwhile
+        if state.generation != generation:
+            break
+        state.extend(json_data)
+        # leave the selected model alone, only grow the choices
+        yield gr.Dropdown.update(choices=state.catalog.model_labels(show_nsfw)), gr.Dropdown.update(), session_id
+    prefetch_next_page(state)
+
+def update_model_versions(model_name=None, session_id=None):
     if model_name is not None:
-        global json_data
-        versions_dict = {}
-        for item in json_data['items']:
-            if item['name'] == model_name:
-
-                for model in item['modelVersions']:
-                    versions_dict[model['name']] = item["name"]
-        return gr.Dropdown.update(choices=[k + ' - ' + v for k, v in versions_dict.items()], value=f'{next(iter(versions_dict.keys()))} - {model_name}')
+        state = find_browse_state(session_id)
+        versions = state.catalog.version_labels(model_name)
+        return gr.Dropdown.update(choices=versions, value=versions[0] if versions else None)
     else:
         return gr.Dropdown.update(choices=[], value=None)
 
-def update_dl_url(model_name=None, model_version=None, model_filename=None):
+def update_dl_url(model_name=None, model_version=None, model_filename=None, session_id=None):
     if model_filename:
-        global json_data
-        dl_dict = {}
-        dl_url = None
-        model_version = model_version.replace(f' - {model_name}','').strip()
-        for item in json_data['items']:
-            if item['name'] == model_name:
-                for model in item['modelVersions']:
-                    if model['name'] == model_version:
-                        for file in model['files']:
-                            if file['name'] == model_filename:
-                                dl_url = file['downloadUrl']
-        return gr.Textbox.update(value=dl_url)
+        state = find_browse_state(session_id)
+        file = state.catalog.file(model_name, model_version, model_filename)
+        return gr.Textbox.update(value=file['downloadUrl'] if file else None)
     else:
         return gr.Textbox.update(value=None)
 
-def update_model_info(model_name=None, model_version=None):
-    if model_name and model_version:
+def update_model_info(model_name=None, model_version=None, session_id=None):
+    state = find_browse_state(session_id)
+    catalog = state.catalog
+    item = catalog.model(model_name) if model_name else None
+    model = catalog.version(model_name, model_version) if item else None
+    if model is not None:
         model_version = model_version.replace(f' - {model_name}','').strip()
-        global json_data
-        output_html = ""
         output_training = ""
-        img_html = ""
         model_desc = ""
-        dl_dict = {}
-        for item in json_data['items']:
-            if item['name'] == model_name:
-                model_uploader = item['creator']['username']
-                if item['description']:
-                    model_desc = item['description']
-                for model in item['modelVersions']:
-                    if model['name'] == model_version:
-                        if model['trainedWords']:
-                            output_training = ", ".join(model['trainedWords'])
-
-                        for file in model['files']:
-                            dl_dict[file['name']] = file['downloadUrl']
-
-                        model_url = model['downloadUrl']
-                        #model_filename = model['files']['name']
-
-                        img_html = '<HEAD><style>img { display: inline-block; }</style></HEAD><div class="column">'
-                        for pic in model['images']:
-                            img_html = img_html + f'<img src={pic["url"]} width=400px></img>'
-                        img_html = img_html + '</div>'
-                        output_html = f"<p><b>Model:</b> {model_name}<br><b>Version:</b> {model_version}<br><b>Uploaded by:</b> {model_uploader}<br><br><a href={model_url}><b>Download Here</b></a></p><br><br>{model_desc}<br><div align=center>{img_html}</div>"
-
-        return gr.HTML.update(value=output_html), gr.Textbox.update(value=output_training), gr.Dropdown.update(choices=[k for k, v in dl_dict.items()], value=next(iter(dl_dict.keys())))
+        model_uploader = item['creator']['username']
+        if item['description']:
+            model_desc = item['description']
+        if model['trainedWords']:
+            output_training = ", ".join(model['trainedWords'])
+
+        dl_dict = {file['name']: file['downloadUrl'] for file in model['files']}
+        inventory = get_installed_inventory()
+        installed_html = "".join(f"<br><b>Installed:</b> {path}" for path in (inventory.find(file.get('hashes')) for file in model['files'] if file.get('hashes')) if path)
+
+        model_url = model['downloadUrl']
+
+        img_html = '<HEAD><style>img { display: inline-block; }</style></HEAD><div class="column">'
+        for pic in model['images']:
+            # thumbnails are scaled in the background and served locally, each one links its original
+            src = thumbnails.thumbnail_url(pic["url"]) if thumbnails.route_registered else pic["url"]
+            img_html = img_html + f'<a href={pic["url"]} target=_blank><img src={src} width=400px></img></a>'
+        img_html = img_html + '</div>'
+        output_html = f"<p><b>Model:</b> {item['name']}<br><b>Version:</b> {model_version}<br><b>Uploaded by:</b> {model_uploader}{installed_html}<br><br><a href={model_url}><b>Download Here</b></a></p><br><br>{model_desc}<br><div align=center>{img_html}</div>"
+
+        return gr.HTML.update(value=output_html), gr.Textbox.update(value=output_training), gr.Dropdown.update(choices=[k for k, v in dl_dict.items()], value=next(iter(dl_dict.keys()), None))
     else:
         return gr.HTML.update(value=None), gr.Textbox.update(value=None), gr.Dropdown.update(choices=[], value=None)
 
-def request_civit_api(api_url=None):
-    # Make a GET request to the API
-    response = requests.get(api_url)
-
-    # Check the status code of the response
-    if response.status_code != 200:
-      print("Request failed with status code: {}".format(response.status_code))
-      exit()
-
-    data = json.loads(response.text)
+def request_civit_api(api_url=None, use_cache=True):
+    # Serve repeated listings from the cache
+    cache = get_api_cache()
+    if use_cache:
+        data = cache.get(api_url)
+        if data is not None:
+            return data
+
+    # An expired copy is revalidated instead of downloaded again
+    stale = cache.stale(api_url) if use_cache else None
+    headers = conditional_headers(stale[1]) if stale else {}
+
+    def read_page(response):
+        # items are parsed from the byte stream into compact records, the raw body is never held whole
+        with response:
+            if response.status_code == 304:
+                return None, None
+            return records.parse_page(response.iter_content(records.parse_chunk_size)), response_validators(response)
+
+    # Make a GET request to the API, transient failures are retried with backoff
+    try:
+        data, validators = retry.get(get_session(), api_url, expected=(200, 304) if headers else (200,), read=read_page, headers=headers, stream=True)
+    except (ConnectionError, retry.HttpStatusError, ValueError) as e:
+        print(f"Request failed: {e}")
+        raise gr.Error(f"CivitAI API request failed: {e}") from e
+
+    if data is None:
+        cache.revalidate(api_url)
+        return stale[0]
+
+    # the disk copy is compressed item by item, a second full copy of the page as text would outweigh the records
+    body, size = records.encode_page(data)
+    cache.put(api_url, data, body, validators, size)
+    # every model we see becomes searchable offline
+    index = get_search_index()
+    if index is not None:
+        index.add_items(data.get('items') or [])
     return data
 
-def update_everything(list_models, list_versions, model_filename, dl_url):
-    (a, d, f) = update_model_info(list_models, list_versions)
-    dl_url = update_dl_url(list_models, list_versions, f['value'])
+def update_everything(list_models, list_versions, model_filename, dl_url, session_id=None):
+    (a, d, f) = update_model_info(list_models, list_versions, session_id)
+    dl_url = update_dl_url(list_models, list_versions, f['value'], session_id)
     return (a, d, f, list_versions, list_models, dl_url)
 
-def save_image_files(preview_image_html, model_filename, list_models, content_type):
+def save_image_files(preview_image_html, model_filename, list_models, content_type, use_new_folder=False, model_version=None, session_id=None):
     print("Save Images Clicked")
-    img_urls = re.findall(r'src=[\'"]?([^\'" >]+)', preview_image_html)
-    
-    name = os.path.splitext(model_filename)[0]
-
-    if content_type == "Checkpoint":
-        folder = "models/Stable-diffusion"
-    elif content_type == "Hypernetwork":
-        folder = "models/hypernetworks"
-    elif content_type == "TextualInversion":
-        folder = "embeddings"
-    elif content_type == "AestheticGradient":
-        folder = "extensions/stable-diffusion-webui-aesthetic-gradients/aesthetic_embeddings"
-    elif content_type == "VAE":
-        folder = "models/VAE"
-    elif content_type == "LORA":
-        folder = "models/Lora"
-    elif content_type == "LoCon":
-        folder = "models/Lora"
-    
-    model_folder = os.path.join(folder,replace_invalid_chars(list_models))
-
-    opener = urllib.request.build_opener()
-    opener.addheaders = [('User-agent', 'Mozilla/5.0')]
-    urllib.request.install_opener(opener)
+    state = find_browse_state(session_id)
+    version = state.catalog.version(list_models, model_version) if list_models else None
+    if version is not None:
+        img_urls = [pic["url"] for pic in version["images"]]
+    else:
+        img_urls = re.findall(r'src=[\'"]?([^\'" >]+)', preview_image_html or "")
+        # local thumbnails stand for their originals
+        img_urls = [get_thumbnail_original(url) for url in img_urls]
 
-    for i, img_url in enumerate(img_urls):
-        filename = f'{name}_{i}.png'
-        img_url = img_url.replace("https", "http")
+    name = os.path.splitext(model_filename)[0]
 
-        print(img_url, filename)
-        # Permanent Redirect fix
-        save_success = False
-        try:
-            with urllib.request.urlopen(img_url) as url:
-                with open(os.path.join(model_folder, filename), 'wb') as f:
-                    f.write(url.read())
-                    print("\t\t\tDownloaded")
-
-                #for the first one, let's make an image name that works with preview
-                if i == 0:
-                    shutil.copy(os.path.join(model_folder, filename), os.path.join(model_folder, name + ".png") )
-                    save_success = True
-        except urllib.error.URLError as e:
-            print(f'Error: {e.reason}')
-        if not save_success:
-            # use requests.get to download the image
-            response = requests.get(img_url)
-            if not response.ok:
-                print(f'Error: {response.reason}')
-                continue
-            image_ext = response.headers['Content-Type'].split('/')[-1]
-            filename = f'{name}_{i}.{image_ext}'
-            with open(os.path.join(model_folder, filename), 'wb') as f:
-                f.write(response.content)
-                print("\t\t\tDownloaded")
-            #for the first one, let's make an image name that works with preview
-            if i == 0:
-                shutil.copy(os.path.join(model_folder, filename), os.path.join(model_folder, name + f".{image_ext}") )
+    model_folder = get_router().prepare(content_type, replace_invalid_chars(list_models), use_new_folder)
+    return save_preview_images(img_urls, model_folder, name, list_models)
+
+def save_preview_images(img_urls, model_folder, name, label=None):
+    """Save the preview images of one model into model_folder as name_<index>.<ext>. Returns the save_image_file results"""
+    if not img_urls:
+        return []
+    # all previews are fetched at once, so the whole call takes about as long as the slowest image
+    with ThreadPoolExecutor(max_workers=max(1, min(image_workers, len(img_urls)))) as pool:
+        results = list(pool.map(lambda args: save_image_file(args[1], model_folder, name, args[0]), enumerate(img_urls)))
+    saved = sum(1 for r in results if r["saved"])
+    not_modified = sum(1 for r in results if r["not_modified"])
+    print(f"Saved {saved} of {len(results)} images for {label or name} ({not_modified} unchanged)")
+    return results
+
+def get_thumbnail_original(url):
+    if url.startswith(thumbnails.route_prefix + "/"):
+        return thumbnails.get_thumbnail_cache().original(url[len(thumbnails.route_prefix) + 1:]) or url
+    return url
+
+def save_image_file(img_url, model_folder, name, index):
+    """
+    Download one preview image, naming it after its Content-Type.
+    The first image is also copied to name.<ext> so it is picked up as the model preview.
+    An image saved before under the same name is revalidated and kept if the server answers 304.
+    Returns a summary dict for the image.
+    """
+    result = {"url": img_url, "index": index, "saved": False, "path": None, "bytes": 0, "error": None, "not_modified": False}
+    start = time.perf_counter()
+    cache = get_api_cache()
+    previous = cache.image_validators(img_url)
+    # only trust validators for a file that is still where this model would save it
+    if previous and not (os.path.isfile(previous["path"]) and os.path.dirname(previous["path"]) == model_folder
+                         and os.path.splitext(os.path.basename(previous["path"]))[0] == f'{name}_{index}'):
+        previous = None
+    headers = conditional_headers(previous)
+    try:
+        response = retry.get(get_session(), img_url, expected=(200, 304) if headers else (200,), headers=headers)
+    except (ConnectionError, retry.HttpStatusError) as e:
+        result["error"] = str(e)
+        print(f'Error: {e}')
+        return result
+    if response.status_code == 304:
+        path = previous["path"]
+        filename = os.path.basename(path)
+        result["not_modified"] = True
+    else:
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        image_ext = content_type.split('/')[-1] if content_type.startswith('image/') else 'png'
+        data = response.content
+        # previews are only ever shown small, full size originals would just take up disk space
+        scaled = thumbnails.shrink_image(data, thumbnails.preview_size) if thumbnails.preview_size else None
+        if scaled is not None:
+            data, image_ext = scaled
+        filename = f'{name}_{index}.{image_ext}'
+        path = os.path.join(model_folder, filename)
+        with get_router().open(path, 'wb') as f:
+            f.write(data)
+        cache.put_image(img_url, path, response_validators(response))
+        result["bytes"] = len(data)
+    #for the first one, let's make an image name that works with preview
+    if index == 0:
+        preview = os.path.join(model_folder, name + os.path.splitext(filename)[1])
+        if not result["not_modified"] or not os.path.exists(preview):
+            shutil.copy(path, preview)
+    result.update(saved=True, path=path, seconds=round(time.perf_counter() - start, 3))
+    print(img_url, filename, "\t\t\tNot modified" if result["not_modified"] else "\t\t\tDownloaded")
+    return result
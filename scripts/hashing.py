@@ -0,0 +1,142 @@
+"""
+Model file hashing in the formats CivitAI publishes in files[].hashes.
+
+Downloads hash their data while it is written (see downloader.copy_stream and PrefixHasher),
+existing files are hashed through mmap on a pool of workers, one file per worker.
+"""
+import hashlib
+import mmap
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+# Bytes handed to the hash per update call. hashlib releases the GIL for large updates,
+# which is what lets a thread pool hash several files on several cores
+hash_chunk_size = 64 * 1024 * 1024
+# Files hashed at the same time by hash_files, defaults to the number of cores
+hash_workers = os.cpu_count() or 1
+# Hash in worker processes instead of threads
+use_processes = False
+
+class HashMismatch(IOError):
+    """
+    Raised when a finished download does not match the SHA256 CivitAI lists for it
+    """
+
+def update_from_file(h, path:str, start:int=0, end:Optional[int]=None):
+    """
+    Feed bytes [start, end) of path into the hash object h through a read-only mmap
+    """
+    size = os.path.getsize(path)
+    end = size if end is None else min(end, size)
+    if end <= start:
+        return h
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for offset in range(start, end, hash_chunk_size):
+                h.update(view[offset:min(offset + hash_chunk_size, end)])
+        finally:
+            view.release()
+    return h
+
+def sha256_file(path:str) -> str:
+    """
+    Upper-case hex SHA256 of the file at path, as CivitAI lists it
+    """
+    return update_from_file(hashlib.sha256(), path).hexdigest().upper()
+
+def hash_files(paths:Iterable[str], workers:Optional[int]=None, processes:Optional[bool]=None) -> Dict[str, Optional[str]]:
+    """
+    SHA256 of several files in parallel. Files that can't be read map to None
+    """
+    paths = list(paths)
+    workers = max(1, min(workers or hash_workers, len(paths) or 1))
+    processes = use_processes if processes is None else processes
+    executor = ProcessPoolExecutor if processes and workers > 1 else ThreadPoolExecutor
+    with executor(max_workers=workers) as pool:
+        futures = {path: pool.submit(sha256_file, path) for path in paths}
+    results = {}
+    for path, future in futures.items():
+        try:
+            results[path] = future.result()
+        except OSError as e:
+            print(f"Could not hash {path}: {e}")
+            results[path] = None
+    return results
+
+def autov2(sha256:str) -> str:
+    """
+    AutoV2 is the first 10 hex digits of the SHA256
+    """
+    return sha256[:10].upper()
+
+def check_sha256(actual:str, expected:Optional[str], file_name:str):
+    """
+    Raise HashMismatch if an expected hash is known and differs
+    """
+    if expected and actual.upper() != expected.upper():
+        raise HashMismatch(f"SHA256 mismatch for {file_name}: expected {expected.upper()}, got {actual.upper()}")
+
+class PrefixHasher:
+    """
+    Hashes a segmented download while it is running. The contiguous completed prefix of the part file
+    (as recorded in the resume journal) is read back and hashed as it grows, so the digest is ready
+    shortly after the last segment lands instead of needing a second full pass.
+    """
+    def __init__(self, journal, path:str):
+        self.journal = journal
+        self.path = path
+        self.hash = hashlib.sha256()
+        self.hashed = 0
+        self._done = threading.Event()
+        self._stopped = False
+        self._error:Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="civitai-hash", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _prefix(self) -> int:
+        prefix = 0
+        for start, end, position in sorted(self.journal.segments):
+            if start != prefix:
+                break
+            prefix = min(position, end + 1)
+            if position <= end:
+                break
+        return prefix
+
+    def _run(self):
+        try:
+            while not self._stopped:
+                prefix = self._prefix()
+                if prefix > self.hashed:
+                    update_from_file(self.hash, self.path, self.hashed, prefix)
+                    self.hashed = prefix
+                elif self._done.is_set() or self.hashed >= self.journal.total_size:
+                    break
+                else:
+                    self._done.wait(0.1)
+        except BaseException as e:
+            self._error = e
+
+    def finish(self) -> str:
+        """
+        Wait for the remaining bytes to be hashed and return the upper-case hex digest
+        """
+        self._done.set()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if self.hashed < self.journal.total_size:
+            update_from_file(self.hash, self.path, self.hashed, self.journal.total_size)
+            self.hashed = self.journal.total_size
+        return self.hash.hexdigest().upper()
+
+    def stop(self):
+        self._stopped = True
+        self._done.set()
+        self._thread.join()
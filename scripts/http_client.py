@@ -0,0 +1,56 @@
+"""
+Process-wide pooled HTTP session shared by the API client, image saving and the downloader
+"""
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of hosts whose connection pools are kept around (civitai.com, image CDN, model CDN...)
+pool_connections = 8
+# Connections kept alive per host, enough for every download worker's segments plus image fetches
+pool_maxsize = 32
+# Transport-level retries for failed connects. Error statuses are retried by scripts.retry, which knows
+# whether a request can be repeated (e.g. a download resumes from the current file size)
+connect_retries = 3
+backoff_factor = 0.5
+user_agent = "Mozilla/5.0"
+# (connect, read) timeout in seconds for requests that don't pass their own, so a stalled server
+# surfaces as a retryable error instead of hanging a download forever
+default_timeout = (10, 60)
+
+_session:Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=default_timeout if timeout is None else timeout, **kwargs)
+
+def build_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(
+        total=connect_retries,
+        connect=connect_retries,
+        read=0, # a stalled body is resumed by the downloader, not replayed here
+        status=0,
+        backoff_factor=backoff_factor,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = user_agent
+    return session
+
+def get_session() -> requests.Session:
+    """
+    Returns the shared session, creating it on first use. Connections are kept alive between calls
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session()
+        return _session
@@ -0,0 +1,199 @@
+"""
+"Install model" pipeline: one call that queues the model file and, while it downloads, writes the files that
+go next to it - the trained words text, the preview images and a .civitai.info JSON sidecar.
+The folder is resolved once and the previews come straight from the API data, not from rendered HTML.
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import gradio as gr
+from requests.exceptions import ConnectionError
+
+from scripts import functions, retry
+from scripts.download_queue import DONE, SKIPPED, DownloadJob
+from scripts.http_client import get_session
+from scripts.routing import content_types, get_router
+from scripts.sessions import find_browse_state
+
+# Extension of the metadata sidecar, the name other webui extensions look for
+info_extension = ".civitai.info"
+# Image nsfw levels treated as safe when previews are limited to sfw images
+sfw_levels = (None, False, "None")
+
+class InstallError(Exception):
+    """
+    Raised when the model, version or file to install cannot be resolved
+    """
+
+def fetch_json(url:str):
+    try:
+        return retry.get(get_session(), url, read=lambda response: response.json())
+    except (ConnectionError, retry.HttpStatusError, ValueError) as e:
+        raise InstallError(f"CivitAI API request failed: {e}") from e
+
+def fetch_version(model_id:Optional[int]=None, version_id:Optional[int]=None) -> dict:
+    """
+    The full API data of a model version, shaped like /model-versions/{id} (the version with a "model" summary).
+    With only model_id, its latest version is used
+    """
+    if model_id is None:
+        if version_id is None:
+            raise InstallError("No model or version id provided")
+        return fetch_json(f"{functions.api_root}/model-versions/{version_id}")
+    item = fetch_json(f"{functions.api_root}/models/{model_id}")
+    versions = item.get("modelVersions") or []
+    version = next((v for v in versions if version_id is None or v.get("id") == version_id), None)
+    if version is None:
+        raise InstallError(f"Model {model_id} has no version {version_id}" if version_id is not None else f"Model {model_id} has no versions")
+    return dict(version, modelId=item.get("id"), model={key: item.get(key) for key in ("name", "type", "nsfw", "poi")})
+
+def pick_file(version:dict, file_name:Optional[str]=None) -> dict:
+    """
+    The file called file_name, else the primary file, else the first one
+    """
+    files = version.get("files") or []
+    if file_name:
+        file = next((f for f in files if f.get("name") == file_name), None)
+        if file is None:
+            raise InstallError(f"Version {version.get('id')} has no file {file_name}")
+        return file
+    file = next((f for f in files if f.get("primary")), files[0] if files else None)
+    if file is None:
+        raise InstallError(f"Version {version.get('id')} has no files")
+    return file
+
+class ModelInstall:
+    """
+    One run of the pipeline. timings holds the seconds spent in each stage; the sidecar stages run concurrently
+    with each other and with the model download, whose stage is only known once the job has finished
+    """
+    def __init__(self, version:dict, file:dict, content_type:str):
+        self.version = version
+        self.file = file
+        self.content_type = content_type
+        self.model_name = functions.replace_invalid_chars((version.get("model") or {}).get("name") or os.path.splitext(file["name"])[0])
+        self.job:Optional[DownloadJob] = None
+        self.text_path:Optional[str] = None
+        self.info_path:Optional[str] = None
+        self.previews:List[dict] = []
+        self.errors:Dict[str, str] = {}
+        self.timings:Dict[str, float] = {}
+        self.started = time.time()
+        self.sidecars_done:Optional[float] = None
+
+    @property
+    def target(self) -> Tuple[str, str]:
+        """
+        Folder and base name the sidecars are written to: next to the model file, or next to the installed copy when it was skipped
+        """
+        path = self.job.file_name
+        return os.path.dirname(path), os.path.splitext(os.path.basename(path))[0]
+
+    def summary(self) -> dict:
+        timings = dict(self.timings)
+        job = self.job
+        if job is not None and job.finished:
+            timings["model"] = round(job.finished_at - job.started, 3) if job.started else 0.0
+            if self.sidecars_done is not None:
+                timings["total"] = round(max(job.finished_at, self.sidecars_done) - self.started, 3)
+        return {
+            "model_id": self.version.get("modelId"), "version_id": self.version.get("id"), "model_name": self.model_name,
+            "version_name": self.version.get("name"), "content_type": self.content_type, "file_name": self.file["name"],
+            "job_id": job.id if job else None, "state": job.state if job else None, "path": job.file_name if job else None,
+            "text_path": self.text_path, "info_path": self.info_path,
+            "previews": [p["path"] for p in self.previews if p["saved"]], "previews_failed": sum(1 for p in self.previews if not p["saved"]),
+            "errors": dict(self.errors), "timings": timings,
+        }
+
+def _timed(install:ModelInstall, stage:str, call):
+    start = time.perf_counter()
+    try:
+        return call()
+    except Exception as e:
+        install.errors[stage] = str(e)
+        print(f"Install {install.model_name}: {stage} failed: {e}")
+    finally:
+        install.timings[stage] = round(time.perf_counter() - start, 3)
+
+def write_info_file(version:dict, model_folder:str, name:str) -> str:
+    """
+    Write the version data to name.civitai.info. The file is replaced atomically, so readers never see half of it
+    """
+    path = os.path.join(model_folder, name + info_extension)
+    tmp = path + ".tmp"
+    with get_router().open(tmp, "w", encoding="utf-8") as f:
+        json.dump(version, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, path)
+    return path
+
+def preview_urls(version:dict, include_nsfw:bool=True) -> List[str]:
+    return [image["url"] for image in version.get("images") or [] if image.get("url") and (include_nsfw or image.get("nsfw") in sfw_levels)]
+
+def start_install(model_id:Optional[int]=None, version_id:Optional[int]=None, content_type:Optional[str]=None, file_name:Optional[str]=None,
+                  use_new_folder:bool=False, include_nsfw:bool=True, priority:int=0) -> ModelInstall:
+    """
+    Resolve the version, queue the model download and write the sidecars while it runs.
+    Returns once the sidecars are written; the model keeps downloading, install.job can be joined or awaited (see scripts/api.py).
+    content_type defaults to the model's own type
+    """
+    start = time.perf_counter()
+    version = fetch_version(model_id, version_id)
+    file = pick_file(version, file_name)
+    content_type = content_type or (version.get("model") or {}).get("type")
+    if content_type not in content_types():
+        raise InstallError(f"Invalid content type, given {content_type} but expected one of {content_types()}")
+    install = ModelInstall(version, file, content_type)
+    install.timings["resolve"] = round(time.perf_counter() - start, 3)
+
+    url = file.get("downloadUrl") or version.get("downloadUrl")
+    install.job = _timed(install, "queue", lambda: functions.download_file_thread(url, file["name"], content_type, use_new_folder,
+                                                                                  install.model_name, priority, file.get("hashes")))
+    if install.job is None:
+        raise InstallError(f"Could not queue {file['name']}: {install.errors.get('queue')}")
+    model_folder, name = install.target
+    get_router().ensure_dir(model_folder)
+
+    trained_words = ", ".join(version.get("trainedWords") or [])
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        text = pool.submit(_timed, install, "text", lambda: functions.write_text_file(model_folder, name + ".txt", trained_words) if trained_words else None)
+        previews = pool.submit(_timed, install, "previews", lambda: functions.save_preview_images(preview_urls(version, include_nsfw), model_folder, name, install.model_name))
+        info = pool.submit(_timed, install, "info", lambda: write_info_file(version, model_folder, name))
+        install.text_path = text.result()
+        install.previews = previews.result() or []
+        install.info_path = info.result()
+    install.sidecars_done = time.time()
+    return install
+
+def install_message(install:ModelInstall) -> str:
+    summary = install.summary()
+    job = install.job
+    if job.state == SKIPPED:
+        model = f"{job.message}"
+    elif job.state == DONE:
+        model = f"downloaded to {job.file_name}"
+    elif job.finished:
+        model = f"download {job.state}: {job.error or ''}".strip()
+    else:
+        model = f"downloading to {job.file_name} (job {job.id})"
+    timings = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in summary["timings"].items())
+    errors = "".join(f"<br><b>{stage} failed:</b> {error}" for stage, error in summary["errors"].items())
+    return (f"<p><b>{install.model_name}</b> {summary['version_name']}: {model}<br>"
+            f"{len(summary['previews'])} previews, text {'saved' if summary['text_path'] else 'skipped (no trained words)'}, "
+            f"info saved to {summary['info_path']}{errors}<br><b>Timings:</b> {timings}</p>")
+
+def install_selected_model(model_name, model_version, model_filename, content_type, use_new_folder, show_nsfw=True, session_id=None):
+    """Install Model button of the browser tab: the selected model file with its text, previews and info file"""
+    state = find_browse_state(session_id)
+    item = state.catalog.model(model_name) if model_name else None
+    version = state.catalog.version(model_name, model_version) if item else None
+    if version is None:
+        raise gr.Error("Select a model and version first")
+    try:
+        install = start_install(version_id=version["id"], content_type=content_type, file_name=model_filename or None,
+                                use_new_folder=use_new_folder, include_nsfw=show_nsfw)
+    except InstallError as e:
+        raise gr.Error(str(e)) from e
+    return gr.HTML.update(value=install_message(install))
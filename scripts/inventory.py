@@ -0,0 +1,159 @@
+"""
+Inventory of installed model files with a persistent hash cache, used to spot models that are already installed
+"""
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from scripts.hashing import autov2, hash_files, sha256_file
+
+model_extensions = (".safetensors", ".ckpt", ".pt", ".pth", ".bin")
+# Hashes of scanned files, keyed by absolute path and only trusted while size and mtime are unchanged
+hash_cache_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "civitai_hash_cache.json")
+
+class ModelInventory:
+    """
+    Maps SHA256 / AutoV2 hashes and file names of installed models to their paths
+    """
+    def __init__(self, cache_path:str=hash_cache_path):
+        self.cache_path = cache_path
+        self.by_sha256:Dict[str, str] = {}
+        self.by_autov2:Dict[str, str] = {}
+        self.by_name:Dict[str, List[str]] = {}
+        self.scanning = False
+        self._cache:Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                self._cache = json.load(f)
+        except (OSError, ValueError):
+            self._cache = {}
+
+    def save_cache(self):
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self._cache)
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, self.cache_path)
+
+    def _cached(self, path:str) -> bool:
+        with self._lock:
+            entry = self._cache.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+
+    def add_file(self, path:str, sha256:Optional[str]=None, persist:bool=False) -> Optional[str]:
+        """
+        Record one model file, hashing it unless the cache (or the caller) already knows its hash.
+        With persist the hash cache file is written right away, as for a finished download.
+        Returns the SHA256, or None if the file vanished
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._cache.get(path)
+        if sha256 is None:
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                sha256 = entry["sha256"]
+            else:
+                sha256 = sha256_file(path)
+        with self._lock:
+            self._cache[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+            self.by_sha256[sha256] = path
+            self.by_autov2[autov2(sha256)] = path
+            paths = self.by_name.setdefault(os.path.basename(path).lower(), [])
+            if path not in paths:
+                paths.append(path)
+        if persist:
+            self.save_cache()
+        return sha256
+
+    def _forget(self, path:str):
+        # caller holds self._lock
+        self._cache.pop(path, None)
+        for index in (self.by_sha256, self.by_autov2):
+            for key in [key for key, value in index.items() if value == path]:
+                del index[key]
+        name = os.path.basename(path).lower()
+        paths = self.by_name.get(name)
+        if paths and path in paths:
+            paths.remove(path)
+            if not paths:
+                del self.by_name[name]
+
+    def scan(self, folders:Iterable[str]):
+        """
+        Walk folders and index every model file. Unchanged files are served from the hash cache
+        """
+        self.scanning = True
+        try:
+            seen = set()
+            for folder in folders:
+                for root, _, files in os.walk(folder):
+                    for f in files:
+                        if f.lower().endswith(model_extensions):
+                            seen.add(os.path.abspath(os.path.join(root, f)))
+            # cached files are indexed right away, the rest is hashed on all cores at once
+            stale = [path for path in seen if not self._cached(path)]
+            for path in seen.difference(stale):
+                self.add_file(path)
+            for path, sha256 in hash_files(stale).items():
+                if sha256 is not None:
+                    self.add_file(path, sha256)
+            with self._lock:
+                # forget files that were deleted since the last scan
+                for path in [p for p in self._cache if p not in seen and not os.path.exists(p)]:
+                    self._forget(path)
+            self.save_cache()
+        finally:
+            self.scanning = False
+
+    def find(self, hashes:Optional[dict]=None, file_name:Optional[str]=None) -> Optional[str]:
+        """
+        Path of an installed copy matching the CivitAI files[].hashes dict, or (without hashes) the file name
+        """
+        hashes = {k.upper(): str(v).upper() for k, v in (hashes or {}).items()}
+        while True:
+            with self._lock:
+                path = None
+                if "SHA256" in hashes and hashes["SHA256"] in self.by_sha256:
+                    path = self.by_sha256[hashes["SHA256"]]
+                elif "AUTOV2" in hashes and hashes["AUTOV2"] in self.by_autov2:
+                    path = self.by_autov2[hashes["AUTOV2"]]
+                elif not hashes and file_name:
+                    paths = self.by_name.get(os.path.basename(file_name).lower())
+                    if paths:
+                        path = paths[0]
+            if path is None or os.path.exists(path):
+                return path
+            # deleted behind our back, forget it and look for another copy
+            with self._lock:
+                self._forget(path)
+
+_inventory:Optional[ModelInventory] = None
+_inventory_lock = threading.Lock()
+
+def get_inventory(folders:Optional[Iterable[str]]=None) -> ModelInventory:
+    """
+    Returns the process-wide inventory. The first call with folders starts a background scan of them
+    """
+    global _inventory
+    with _inventory_lock:
+        if _inventory is None:
+            _inventory = ModelInventory(hash_cache_path)
+            if folders is not None:
+                threading.Thread(target=_inventory.scan, args=(list(folders),), name="civitai-inventory", daemon=True).start()
+        return _inventory
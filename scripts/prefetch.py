@@ -0,0 +1,79 @@
+"""
+Background prefetch of the next API page into the listing cache
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from scripts.api_cache import get_api_cache
+
+# How many pages ahead of the one on screen are fetched
+prefetch_depth = 1
+# Pages fetched at the same time across all sessions
+prefetch_workers = 2
+# Prefetches waiting for a worker beyond this are dropped
+max_pending = 16
+
+class PagePrefetcher:
+    """
+    Fetches `nextPage` urls on a small thread pool. fetch(url) must return the decoded page and store it
+    in the listing cache; a click that arrives while its page is still in flight waits for that fetch.
+    """
+    def __init__(self, fetch:Callable[[str], Optional[dict]], workers:int=prefetch_workers, depth:int=prefetch_depth):
+        self.fetch = fetch
+        self.depth = depth
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="civitai-prefetch")
+        self._in_flight:Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, url:Optional[str], depth:Optional[int]=None):
+        """
+        Start fetching url (and up to depth - 1 pages after it) unless it is cached or already in flight
+        """
+        depth = self.depth if depth is None else depth
+        if not url or depth <= 0:
+            return
+        with self._lock:
+            if url in self._in_flight or len(self._in_flight) >= max_pending:
+                return
+            if get_api_cache().contains(url):
+                return
+            self._in_flight[url] = self._pool.submit(self._run, url, depth)
+
+    def _run(self, url:str, depth:int) -> Optional[dict]:
+        try:
+            data = self.fetch(url)
+        except BaseException as e:
+            print(f"Prefetch of {url} failed: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._in_flight.pop(url, None)
+        if depth > 1 and data:
+            self.prefetch((data.get("metadata") or {}).get("nextPage"), depth - 1)
+        return data
+
+    def wait(self, url:Optional[str], timeout:Optional[float]=None):
+        """
+        If url is being prefetched, block until that fetch is done so the caller hits the cache
+        """
+        with self._lock:
+            future = self._in_flight.get(url)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+
+_prefetcher:Optional[PagePrefetcher] = None
+_prefetcher_lock = threading.Lock()
+
+def get_prefetcher(fetch:Callable[[str], Optional[dict]]) -> PagePrefetcher:
+    """
+    Returns the process-wide prefetcher, creating it around fetch on first use
+    """
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = PagePrefetcher(fetch, prefetch_workers, prefetch_depth)
+        return _prefetcher
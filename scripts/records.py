@@ -0,0 +1,265 @@
+"""
+Compact records for CivitAI API items and an incremental page parser.
+
+A listing page is parsed straight from the response byte stream one item at a time, and every item is
+projected onto __slots__ records holding only the fields the browser uses. Only the records are kept.
+Records support read-only dict access (item["name"], item.get("modelVersions")) with the API key names,
+so handlers work the same on records and on plain API dicts.
+"""
+import codecs
+import json
+import zlib
+from typing import Iterable, Iterator, Optional, Tuple
+
+# Bytes handed to the parser per step
+parse_chunk_size = 64 * 1024
+
+class Record:
+    """
+    Base class: FIELDS are the API keys a record keeps, stored under the same names
+    """
+    __slots__ = ()
+    FIELDS = ()
+
+    def __getitem__(self, key:str):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key:str, default=None):
+        if key not in self.FIELDS:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __contains__(self, key:str) -> bool:
+        return key in self.FIELDS
+
+    def keys(self):
+        return self.FIELDS
+
+    def to_dict(self) -> dict:
+        return {key: _plain(getattr(self, key)) for key in self.FIELDS}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({getattr(self, 'name', None)!r})"
+
+class ImageRecord(Record):
+    __slots__ = FIELDS = ("url", "nsfw", "width", "height")
+
+    def __init__(self, image:dict):
+        self.url = image.get("url")
+        self.nsfw = image.get("nsfw")
+        self.width = image.get("width")
+        self.height = image.get("height")
+
+class FileRecord(Record):
+    __slots__ = FIELDS = ("id", "name", "type", "sizeKB", "primary", "downloadUrl", "hashes")
+
+    def __init__(self, file:dict):
+        self.id = file.get("id")
+        self.name = file.get("name")
+        self.type = file.get("type")
+        self.sizeKB = file.get("sizeKB")
+        self.primary = file.get("primary")
+        self.downloadUrl = file.get("downloadUrl")
+        self.hashes = file.get("hashes") or {}
+
+class VersionRecord(Record):
+    __slots__ = FIELDS = ("id", "name", "baseModel", "trainedWords", "downloadUrl", "files", "images")
+
+    def __init__(self, version:dict):
+        self.id = version.get("id")
+        self.name = version.get("name")
+        self.baseModel = version.get("baseModel")
+        self.trainedWords = version.get("trainedWords") or []
+        self.downloadUrl = version.get("downloadUrl")
+        self.files = [FileRecord(file) for file in version.get("files") or []]
+        self.images = [ImageRecord(image) for image in version.get("images") or []]
+
+class ModelRecord(Record):
+    """
+    One model. The description (often the largest field) is kept zlib-compressed and decoded on access
+    """
+    __slots__ = ("id", "name", "type", "nsfw", "creator", "tags", "modelVersions", "_description")
+    FIELDS = ("id", "name", "type", "nsfw", "creator", "tags", "description", "modelVersions")
+
+    def __init__(self, item:dict):
+        self.id = item.get("id")
+        self.name = item.get("name")
+        self.type = item.get("type")
+        self.nsfw = item.get("nsfw")
+        creator = item.get("creator") or {}
+        self.creator = {"username": creator.get("username")} if creator else None
+        # tags have been returned both as plain strings and as {"name": ...} objects
+        self.tags = [tag.get("name", "") if isinstance(tag, dict) else str(tag) for tag in item.get("tags") or []]
+        self.modelVersions = [VersionRecord(version) for version in item.get("modelVersions") or []]
+        description = item.get("description")
+        self._description = zlib.compress(description.encode("utf-8")) if description else None
+
+    @property
+    def description(self) -> Optional[str]:
+        return zlib.decompress(self._description).decode("utf-8") if self._description is not None else None
+
+def _plain(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+def to_json(value):
+    """
+    json.dumps default= hook for records
+    """
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def compact_item(item):
+    return item if isinstance(item, ModelRecord) else ModelRecord(item)
+
+def compact_page(data:Optional[dict]) -> Optional[dict]:
+    """
+    Same page with its items projected onto records. Pages that are already compact are returned as is
+    """
+    if not data or "items" not in data:
+        return data
+    items = data["items"] or []
+    if all(isinstance(item, ModelRecord) for item in items):
+        return data
+    return dict(data, items=[compact_item(item) for item in items])
+
+def loads_page(body) -> dict:
+    """
+    Decode a page stored by encode_page, or a plain JSON body from cache files written before pages were compressed
+    """
+    if isinstance(body, bytes):
+        return parse_page(_inflate(body))
+    return compact_page(json.loads(body))
+
+def encode_page(data:dict) -> Tuple[bytes, int]:
+    """
+    The page as zlib-compressed JSON, serialized one item at a time so the whole page never exists as text.
+    Returns the compressed bytes and the length of the JSON they hold
+    """
+    compressor = zlib.compressobj()
+    parts = []
+    length = 0
+    def write(text:str):
+        nonlocal length
+        encoded = text.encode("utf-8")
+        length += len(encoded)
+        parts.append(compressor.compress(encoded))
+    write('{"items": [')
+    for index, item in enumerate(data.get("items") or []):
+        write((", " if index else "") + json.dumps(item, default=to_json))
+    write("]")
+    for key, value in data.items():
+        if key != "items":
+            write(f", {json.dumps(key)}: {json.dumps(value, default=to_json)}")
+    write("}")
+    parts.append(compressor.flush())
+    return b"".join(parts), length
+
+def _inflate(body:bytes) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj()
+    for start in range(0, len(body), parse_chunk_size):
+        yield decompressor.decompress(body[start:start + parse_chunk_size])
+    yield decompressor.flush()
+
+class _StreamReader:
+    """
+    Text buffer over an iterable of byte chunks that decodes one JSON value at a time
+    """
+    def __init__(self, chunks:Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self._text.decode(b"", final=True)
+        else:
+            text = self._text.decode(chunk)
+        # drop what has been consumed so the buffer only ever holds the value being parsed
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON")
+            self._fill()
+
+    def take(self, expected:str) -> str:
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f"Expected one of {expected!r} at offset {self.pos}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            if not self.eof and (end == len(self.buf) or self._number_may_continue(value, end)):
+                # a number at the end of the buffer may continue in the next chunk
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def _number_may_continue(self, value, end:int) -> bool:
+        # "12." or "1e" at the end of the buffer decode as 12 and 1 with the rest left over
+        return (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and all(char in "0123456789.eE+-" for char in self.buf[end:]))
+
+def iter_page(chunks:Iterable[bytes], page:dict) -> Iterator[ModelRecord]:
+    """
+    Yield the items of a listing as records while parsing it from byte chunks.
+    The other top-level keys (metadata...) are stored into page as they are met
+    """
+    reader = _StreamReader(chunks)
+    reader.take("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.take(":")
+        if key == "items" and reader.peek() == "[":
+            reader.take("[")
+            if reader.peek() == "]":
+                reader.take("]")
+            else:
+                while True:
+                    yield ModelRecord(reader.value())
+                    if reader.take(",]") == "]":
+                        break
+        else:
+            page[key] = reader.value()
+        if reader.take(",}") == "}":
+            return
+
+def parse_page(chunks:Iterable[bytes]) -> dict:
+    """
+    Parse a listing response body given as byte chunks (e.g. response.iter_content()) into a compact page
+    """
+    page = {}
+    page["items"] = list(iter_page(chunks, page))
+    return page
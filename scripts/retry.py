@@ -0,0 +1,129 @@
+"""
+Retry policy shared by the API client and the downloader: exponential backoff with full jitter,
+Retry-After support, HTTP status classification and a total time budget
+"""
+import email.utils
+import random
+import time
+from typing import Callable, Optional
+
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+from scripts.download_queue import DownloadCancelled
+from scripts.throttle import interruptible_sleep
+
+# Attempts per call, the first one included
+max_attempts = 6
+# Backoff before retry n is a random delay in [0, min(max_delay, base_delay * 2 ** n)]
+base_delay = 0.5
+max_delay = 30.0
+# A call gives up once this many seconds have passed without progress, whatever attempts are left
+time_budget = 300.0
+# Honour Retry-After up to this many seconds, longer waits fail right away
+max_retry_after = 120.0
+
+# Statuses worth another try: timeouts, throttling and temporary server / CDN failures
+RETRYABLE_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524])
+
+class HttpStatusError(IOError):
+    """
+    Raised for a response with an unexpected status, instead of reading its error body as data
+    """
+    def __init__(self, status:int, url:str, retry_after:Optional[float]=None):
+        super().__init__(f"HTTP {status} from {url}")
+        self.status = status
+        self.url = url
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRYABLE_STATUSES
+
+def parse_retry_after(value:Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+def raise_for_status(response, expected=(200,)):
+    """
+    Raise HttpStatusError unless the response status is one of expected. The response is closed first
+    """
+    if response.status_code in expected:
+        return
+    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    response.close()
+    raise HttpStatusError(response.status_code, response.url, retry_after)
+
+def is_retryable(error:BaseException) -> bool:
+    if isinstance(error, HttpStatusError):
+        return error.retryable
+    return isinstance(error, (ConnectionError, ChunkedEncodingError, Timeout))
+
+class RetryPolicy:
+    """
+    How often and how long a call is retried. Defaults come from the module settings
+    """
+    def __init__(self, attempts:Optional[int]=None, budget:Optional[float]=None):
+        self.attempts = max_attempts if attempts is None else attempts
+        self.budget = time_budget if budget is None else budget
+
+    def delay(self, attempt:int, error:Optional[BaseException]=None) -> float:
+        """
+        Wait before retry number attempt (0 based). A Retry-After from the server replaces the backoff
+        """
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+    def run(self, call:Callable, stopped:Optional[Callable[[], bool]]=None, on_retry:Optional[Callable] = None,
+            progressed:Optional[Callable[[], bool]]=None):
+        """
+        Return call(), retrying transient failures. progressed(), if given, is asked after a failed attempt;
+        when it returns True (e.g. bytes were written) the attempt count and time budget start over,
+        so a long download that keeps moving is never cut off by the budget.
+        """
+        attempt = 0
+        deadline = time.monotonic() + self.budget
+        while True:
+            try:
+                return call()
+            except DownloadCancelled:
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                if progressed is not None and progressed():
+                    attempt = 0
+                    deadline = time.monotonic() + self.budget
+                attempt += 1
+                delay = self.delay(attempt - 1, e)
+                if attempt >= self.attempts or delay > max_retry_after or time.monotonic() + delay > deadline:
+                    raise
+                print(f"{e}, retrying in {delay:.1f}s ({attempt}/{self.attempts - 1})")
+                if on_retry is not None:
+                    on_retry()
+                interruptible_sleep(delay, stopped)
+
+def get(session, url:str, policy:Optional[RetryPolicy]=None, expected=(200,), read:Optional[Callable]=None, **kwargs):
+    """
+    session.get(url) with retries. Returns the response, whose status is one of expected, or raises.
+    With read, returns read(response) instead; reading the body is then retried along with the request
+    """
+    def call():
+        response = session.get(url, **kwargs)
+        raise_for_status(response, expected)
+        return read(response) if read is not None else response
+    return (policy or RetryPolicy()).run(call)
@@ -0,0 +1,170 @@
+"""
+Content type routing: which folder each CivitAI content type is installed to.
+Folders are resolved once and directories known to exist are cached, so placing a file costs no stat calls
+after the first time (which matters on network-mounted model shares).
+"""
+import os
+import threading
+from typing import Dict, List, Optional, Set
+
+# Root the relative folders below are resolved against, "" for the webui working directory
+models_root = ""
+# Base folder of each content type. Absolute paths are used as they are, which gives a type its own root
+content_type_folders:Dict[str, str] = {
+    "Checkpoint": "models/Stable-diffusion",
+    "Hypernetwork": "models/hypernetworks",
+    "TextualInversion": "embeddings",
+    "AestheticGradient": "extensions/stable-diffusion-webui-aesthetic-gradients/aesthetic_embeddings",
+    "VAE": "models/VAE",
+    "LORA": "models/Lora",
+    "LoCon": "models/Lora",
+}
+# Types whose files go straight into their folder instead of a subfolder per model
+flat_content_types:Set[str] = {"TextualInversion", "AestheticGradient", "VAE"}
+# Subfolder used by "Save Model to new folder"
+new_folder_name = "new"
+
+class ContentRouter:
+    """
+    Maps content types to folders and creates folders on demand, remembering which ones exist.
+    Directories it created are tracked so a failed download can remove just those again.
+    """
+    def __init__(self, folders:Optional[Dict[str, str]]=None, flat:Optional[Set[str]]=None, root:Optional[str]=None):
+        self.root = models_root if root is None else root
+        self.folders = dict(content_type_folders if folders is None else folders)
+        self.flat = set(flat_content_types if flat is None else flat)
+        self._known:Set[str] = set()
+        self._created:Set[str] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def types(self) -> List[str]:
+        return list(self.folders)
+
+    def register(self, content_type:str, folder:str, per_model:bool=True):
+        """
+        Add a content type, or move an existing one to another folder
+        """
+        with self._lock:
+            self.folders[content_type] = folder
+            if per_model:
+                self.flat.discard(content_type)
+            else:
+                self.flat.add(content_type)
+
+    def folder(self, content_type:str) -> str:
+        """
+        Base folder of a content type. Raises KeyError for unknown types
+        """
+        return os.path.normpath(os.path.join(self.root, self.folders[content_type]))
+
+    def folders_in_use(self) -> Set[str]:
+        return {self.folder(content_type) for content_type in self.folders}
+
+    def model_folder(self, content_type:str, model_name:str, use_new_folder:bool=False) -> str:
+        """
+        Where the files of a model go. Nothing is created
+        """
+        folder = self.folder(content_type)
+        if use_new_folder:
+            folder = os.path.join(folder, new_folder_name)
+        if content_type not in self.flat:
+            folder = os.path.join(folder, model_name)
+        return folder
+
+    def ensure_dir(self, path:str) -> str:
+        """
+        Create path (and missing parents) unless it is already known to exist. Returns path
+        """
+        path = target = os.path.normpath(path)
+        with self._lock:
+            if path in self._known:
+                return path
+        missing = []
+        parent = path
+        while parent and not os.path.isdir(parent):
+            missing.append(parent)
+            next_parent = os.path.dirname(parent)
+            if next_parent == parent:
+                break
+            parent = next_parent
+        created = []
+        for directory in reversed(missing):
+            try:
+                os.mkdir(directory)
+                created.append(directory)
+            except FileExistsError:
+                pass
+        with self._lock:
+            self._created.update(created)
+            # every parent of an existing directory exists as well
+            while path and path not in self._known:
+                self._known.add(path)
+                next_path = os.path.dirname(path)
+                if next_path == path:
+                    break
+                path = next_path
+        return target
+
+    def forget(self, path:str):
+        """
+        Drop path and everything below it from the known directories, e.g. after it was deleted outside the extension
+        """
+        path = os.path.normpath(path)
+        below = lambda known: known == path or known.startswith(path + os.sep)
+        with self._lock:
+            self._known = {known for known in self._known if not below(known)}
+            self._created = {created for created in self._created if not below(created)}
+
+    def open(self, path:str, mode:str="r", **kwargs):
+        """
+        open() a file in a directory passed to ensure_dir before. If the directory has been deleted since,
+        it is forgotten, created again and the open retried once
+        """
+        try:
+            return open(path, mode, **kwargs)
+        except FileNotFoundError:
+            folder = os.path.dirname(path)
+            self.forget(folder)
+            self.ensure_dir(folder)
+            return open(path, mode, **kwargs)
+
+    def prepare(self, content_type:str, model_name:str, use_new_folder:bool=False) -> str:
+        """
+        model_folder, created if needed
+        """
+        return self.ensure_dir(self.model_folder(content_type, model_name, use_new_folder))
+
+    def remove_if_empty(self, path:str):
+        """
+        Remove path if this router created it and it is empty, then its parents on the same terms.
+        Directories that existed before are never touched and nothing below path is walked
+        """
+        path = os.path.normpath(path)
+        while True:
+            with self._lock:
+                if path not in self._created:
+                    return
+            try:
+                os.rmdir(path) # fails unless empty
+            except OSError:
+                return
+            print("Removing empty directory:", path)
+            self.forget(path)
+            path = os.path.dirname(path)
+
+_router:Optional[ContentRouter] = None
+_router_lock = threading.Lock()
+
+def get_router() -> ContentRouter:
+    """
+    Returns the process-wide router, built from the module settings on first use
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ContentRouter()
+        return _router
+
+def content_types() -> List[str]:
+    return get_router().types
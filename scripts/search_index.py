@@ -0,0 +1,120 @@
+"""
+Local full-text index over every model item seen through the CivitAI API, for offline / local-first search
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from scripts.records import to_json
+
+# Index file in the extension folder
+index_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "civitai_search_index.sqlite3")
+# Most results returned by a local search
+max_results = 200
+
+def _tag_names(tags) -> List[str]:
+    # the API has returned tags both as plain strings and as {"name": ...} objects
+    return [tag.get("name", "") if isinstance(tag, dict) else str(tag) for tag in tags or []]
+
+def _strip_html(text:Optional[str]) -> str:
+    return re.sub(r"<[^>]+>", " ", text or "")
+
+def _fts_query(query:str) -> str:
+    """
+    Turn free text into an FTS5 query: every word must match, as a prefix
+    """
+    words = re.findall(r"\w+", query, re.UNICODE)
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+class SearchIndex:
+    """
+    SQLite FTS5 index of name, creator, tags, trained words and description, keyed by model id.
+    Falls back to LIKE matching when the sqlite build has no FTS5.
+    """
+    def __init__(self, path:str=index_path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS models (id INTEGER PRIMARY KEY, type TEXT, nsfw INTEGER, name TEXT, search_text TEXT, updated_at REAL, item TEXT)")
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS models_fts USING fts5(name, creator, tags, trained_words, description)")
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self._db.commit()
+
+    def add_items(self, items:List[dict]):
+        """
+        Insert or refresh the given API items
+        """
+        now = time.time()
+        with self._lock:
+            for item in items:
+                if "id" not in item:
+                    continue
+                creator = (item.get("creator") or {}).get("username") or ""
+                tags = " ".join(_tag_names(item.get("tags")))
+                trained_words = " ".join(word for version in item.get("modelVersions") or [] for word in version.get("trainedWords") or [])
+                description = _strip_html(item.get("description"))
+                fields = (item.get("name") or "", creator, tags, trained_words, description)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO models (id, type, nsfw, name, search_text, updated_at, item) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (item["id"], item.get("type"), int(bool(item.get("nsfw"))), fields[0], " ".join(fields).lower(), now, json.dumps(item, default=to_json)))
+                if self.fts:
+                    self._db.execute("DELETE FROM models_fts WHERE rowid = ?", (item["id"],))
+                    self._db.execute("INSERT INTO models_fts (rowid, name, creator, tags, trained_words, description) VALUES (?, ?, ?, ?, ?, ?)", (item["id"],) + fields)
+            self._db.commit()
+
+    def search(self, query:str, content_type:Optional[str]=None, show_nsfw:bool=True, limit:int=max_results) -> List[dict]:
+        """
+        Returns the stored API items matching query, best matches first
+        """
+        filters = ""
+        params = []
+        if content_type:
+            filters += " AND m.type = ?"
+            params.append(content_type)
+        if not show_nsfw:
+            filters += " AND m.nsfw = 0"
+        with self._lock:
+            if self.fts:
+                match = _fts_query(query)
+                if not match:
+                    return []
+                rows = self._db.execute(
+                    f"SELECT m.item FROM models_fts f JOIN models m ON m.id = f.rowid WHERE models_fts MATCH ?{filters} ORDER BY bm25(models_fts, 10.0, 3.0, 3.0, 3.0, 1.0) LIMIT ?",
+                    [match] + params + [limit]).fetchall()
+            else:
+                words = re.findall(r"\w+", query.lower(), re.UNICODE)
+                if not words:
+                    return []
+                likes = " AND ".join("m.search_text LIKE ?" for _ in words)
+                rows = self._db.execute(
+                    f"SELECT m.item FROM models m WHERE {likes}{filters} ORDER BY m.updated_at DESC LIMIT ?",
+                    [f"%{word}%" for word in words] + params + [limit]).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM models").fetchone()[0]
+
+_index:Optional[SearchIndex] = None
+_index_lock = threading.Lock()
+
+def get_search_index() -> Optional[SearchIndex]:
+    """
+    Returns the process-wide index, or None if it could not be opened
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            try:
+                _index = SearchIndex(index_path)
+            except sqlite3.Error as e:
+                print(f"CivitAI local search index unavailable: {e}")
+                return None
+        return _index
@@ -0,0 +1,114 @@
+"""
+Per-session browse state. The UI keeps only a session id in gr.State, the state itself lives in a bounded store here
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from scripts.catalog import ModelCatalog
+
+# Most sessions kept at once, the least recently used one is dropped beyond this
+max_sessions = 64
+# Sessions untouched for this many seconds are dropped
+idle_timeout = 3600
+
+class BrowseState:
+    """
+    What one browser tab is looking at: the current API page, its catalog and the cursor to the next page
+    """
+    def __init__(self):
+        self.json_data:Optional[dict] = None
+        self.catalog = ModelCatalog()
+        self.page = 0
+        # bumped by every new listing, lets a running streaming search notice it was superseded
+        self.generation = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def next_page(self) -> Optional[str]:
+        return self.catalog.next_page
+
+    def load(self, json_data:dict, next_page:bool=False):
+        self.json_data = json_data
+        self.catalog = ModelCatalog(json_data)
+        self.page = self.page + 1 if next_page else 1
+        self.generation += 1
+
+    def extend(self, json_data:dict):
+        """
+        Add another page to the current listing instead of replacing it
+        """
+        self.json_data = json_data
+        self.catalog.extend(json_data)
+        self.page += 1
+
+class SessionStore:
+    """
+    LRU map of session id -> BrowseState with idle eviction
+    """
+    def __init__(self, max_sessions:int=max_sessions, idle_timeout:float=idle_timeout):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id:Optional[str]) -> Tuple[str, BrowseState]:
+        """
+        Returns (session_id, state). Unknown or evicted ids get a fresh state under a new id
+        """
+        with self._lock:
+            self._evict_idle()
+            state = self._sessions.get(session_id) if session_id else None
+            if state is None:
+                session_id = uuid.uuid4().hex
+                state = BrowseState()
+                self._sessions[session_id] = state
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            state.last_used = time.monotonic()
+            return session_id, state
+
+    def find(self, session_id:Optional[str]) -> Optional[BrowseState]:
+        """
+        The state of a live session, or None. Unlike get, never creates one
+        """
+        with self._lock:
+            self._evict_idle()
+            state = self._sessions.get(session_id) if session_id else None
+            if state is not None:
+                self._sessions.move_to_end(session_id)
+                state.last_used = time.monotonic()
+            return state
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest.last_used >= cutoff:
+                break
+            del self._sessions[oldest_id]
+
+    def __len__(self):
+        return len(self._sessions)
+
+_store:Optional[SessionStore] = None
+_store_lock = threading.Lock()
+
+def get_session_store() -> SessionStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore(max_sessions, idle_timeout)
+        return _store
+
+def get_browse_state(session_id:Optional[str]) -> Tuple[str, BrowseState]:
+    return get_session_store().get(session_id)
+
+def find_browse_state(session_id:Optional[str]) -> BrowseState:
+    """
+    For handlers that cannot hand a new session id back to gr.State: the live state, or an empty one that is not stored
+    """
+    return get_session_store().find(session_id) or BrowseState()
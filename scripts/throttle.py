@@ -0,0 +1,186 @@
+"""
+Bandwidth and connection limits for downloads: token buckets (global and per job) and per-host connection slots
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from scripts.download_queue import DownloadCancelled
+
+# Global download bandwidth cap in bytes per second, 0 for unlimited
+max_bytes_per_second = 0
+# Default per-job cap in bytes per second, 0 for unlimited
+job_bytes_per_second = 0
+# Concurrent download connections per host, 0 for unlimited. host_connection_limits overrides it per host name
+max_connections_per_host = 0
+host_connection_limits:Dict[str, int] = {}
+# A throttled read never asks for more than this fraction of a second worth of bytes, so the rate stays smooth
+throttle_slice = 0.25
+min_throttle_chunk = 64 * 1024
+
+def interruptible_sleep(seconds:float, stopped=None):
+    """
+    Sleep in short steps so a cancelled download doesn't wait out its whole debt
+    """
+    deadline = time.monotonic() + seconds
+    while True:
+        if stopped is not None and stopped():
+            raise DownloadCancelled("Download cancelled")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 0.1))
+
+class TokenBucket:
+    """
+    Token bucket in bytes. A rate of 0 means unlimited. Consumers may go into debt and then sleep it off,
+    which keeps the accounting exact without splitting reads into token-sized pieces.
+    """
+    def __init__(self, rate:float=0, burst:Optional[float]=None):
+        self._lock = threading.Lock()
+        self.rate = 0.0
+        self.burst = 0.0
+        self.tokens = 0.0
+        self._updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate:float, burst:Optional[float]=None):
+        """
+        Change the rate at runtime. The burst defaults to one second worth of bytes
+        """
+        with self._lock:
+            self._refill()
+            self.rate = max(0.0, float(rate or 0))
+            self.burst = float(burst) if burst else self.rate
+            self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, n:int, stopped=None):
+        """
+        Take n bytes worth of tokens, sleeping while the bucket is in debt
+        """
+        with self._lock:
+            if not self.rate:
+                return
+            self._refill()
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            interruptible_sleep(wait, stopped)
+
+    def chunk_size(self) -> Optional[int]:
+        """
+        Largest read that keeps the rate smooth, None when unlimited
+        """
+        rate = self.rate
+        return max(min_throttle_chunk, int(rate * throttle_slice)) if rate else None
+
+class Throttle:
+    """
+    The buckets one download has to pass: the global one and its own
+    """
+    def __init__(self, *buckets:Optional[TokenBucket]):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+
+    def consume(self, n:int, stopped=None):
+        for bucket in self.buckets:
+            bucket.consume(n, stopped)
+
+    def chunk_size(self) -> Optional[int]:
+        sizes = [size for size in (bucket.chunk_size() for bucket in self.buckets) if size]
+        return min(sizes) if sizes else None
+
+class HostLimiter:
+    """
+    Counts open download connections per host and makes new ones wait for a free slot
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.active:Dict[str, int] = {}
+
+    def limit(self, host:str) -> int:
+        return host_connection_limits.get(host, max_connections_per_host)
+
+    def notify(self):
+        """
+        Wake waiting connections after the limits were changed
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, url:str, stopped=None):
+        host = urlsplit(url).hostname or ""
+        with self._cond:
+            while 0 < self.limit(host) <= self.active.get(host, 0):
+                if stopped is not None and stopped():
+                    raise DownloadCancelled("Download cancelled")
+                self._cond.wait(0.1)
+            self.active[host] = self.active.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active[host] -= 1
+                if not self.active[host]:
+                    del self.active[host]
+                self._cond.notify_all()
+
+_global_bucket:Optional[TokenBucket] = None
+_host_limiter:Optional[HostLimiter] = None
+_lock = threading.Lock()
+
+def get_global_bucket() -> TokenBucket:
+    global _global_bucket
+    with _lock:
+        if _global_bucket is None:
+            _global_bucket = TokenBucket(max_bytes_per_second)
+        return _global_bucket
+
+def get_host_limiter() -> HostLimiter:
+    global _host_limiter
+    with _lock:
+        if _host_limiter is None:
+            _host_limiter = HostLimiter()
+        return _host_limiter
+
+def job_bucket(job_progress) -> TokenBucket:
+    """
+    The per-job bucket of a download_queue.JobProgress, attached on first use
+    """
+    with _lock:
+        if job_progress.bucket is None:
+            job_progress.bucket = TokenBucket(job_bytes_per_second)
+        return job_progress.bucket
+
+def job_throttle(job_progress=None) -> Throttle:
+    """
+    Throttle for one download: the global cap plus the job's own, if it has a JobProgress
+    """
+    return Throttle(get_global_bucket(), job_bucket(job_progress) if job_progress is not None else None)
+
+def set_limits(bytes_per_second:Optional[float]=None, connections_per_host:Optional[int]=None, host_limits:Optional[Dict[str, int]]=None,
+               per_job_bytes_per_second:Optional[float]=None):
+    """
+    Change the limits at runtime. Arguments left as None are unchanged.
+    per_job_bytes_per_second is the default for jobs started afterwards
+    """
+    global max_bytes_per_second, max_connections_per_host, job_bytes_per_second
+    if bytes_per_second is not None:
+        max_bytes_per_second = max(0, bytes_per_second)
+        get_global_bucket().set_rate(max_bytes_per_second)
+    if per_job_bytes_per_second is not None:
+        job_bytes_per_second = max(0, per_job_bytes_per_second)
+    if connections_per_host is not None:
+        max_connections_per_host = max(0, int(connections_per_host))
+    if host_limits is not None:
+        host_connection_limits.clear()
+        host_connection_limits.update({host.lower(): max(0, int(limit)) for host, limit in host_limits.items()})
+    get_host_limiter().notify()
@@ -0,0 +1,239 @@
+"""
+Local thumbnail cache for preview images.
+The model info panel shows CivitAI images at 400px, but their URLs point at multi-MB originals. Images are
+fetched and downscaled with Pillow on a small worker pool, kept on disk under a size cap with least recently
+used eviction, and served to the browser from a local route.
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Set, Tuple
+
+from PIL import Image, ImageOps
+
+from scripts import retry
+from scripts.http_client import get_session
+
+# Directory of the cached thumbnails
+thumbnail_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "civitai_thumbnails")
+# Thumbnails fit in this box (width, height), the panel shows them 400px wide
+thumbnail_size = (400, 800)
+# Least recently used thumbnails are removed once the directory grows past this
+max_cache_bytes = 256 * 1024 * 1024
+# Image URLs remembered for the thumbnail route, least recently requested ones are forgotten first
+max_urls = 4096
+# Images fetched and scaled at the same time
+thumbnail_workers = 4
+# JPEG quality of thumbnails and shrunk preview files
+jpeg_quality = 85
+# Preview images saved next to models are shrunk to fit this box, None keeps the originals
+preview_size:Optional[Tuple[int, int]] = (768, 1152)
+# Path the thumbnails are served from, see register_thumbnail_route in scripts/api.py
+route_prefix = "/civitai-browser/thumbnails"
+# Set once the route is registered, until then the info panel links the original images
+route_registered = False
+
+def shrink_image(data:bytes, size:Tuple[int, int]) -> Optional[Tuple[bytes, str]]:
+    """
+    Downscale encoded image bytes to fit size. Returns (bytes, extension), or None when the image
+    already fits or cannot be decoded. Images with transparency stay PNG, everything else becomes JPEG
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width <= size[0] and image.height <= size[1]:
+                return None
+            alpha = image.mode in ("RGBA", "LA") or image.mode == "P" and "transparency" in image.info
+            # JPEG can decode straight at a fraction of the resolution, which is most of the saving
+            image.draft("RGB", size)
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(size, Image.LANCZOS)
+            out = io.BytesIO()
+            if alpha:
+                image.save(out, "PNG", optimize=True)
+                return out.getvalue(), "png"
+            image.convert("RGB").save(out, "JPEG", quality=jpeg_quality, optimize=True)
+            return out.getvalue(), "jpeg"
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Could not scale image: {e}")
+        return None
+
+def thumbnail_key(url:str) -> str:
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+class ThumbnailCache:
+    """
+    Thumbnails on disk named by the hash of their image URL, in least recently used order.
+    Only URLs handed to request() are ever fetched, the route looks thumbnails up by key
+    """
+    def __init__(self, directory:Optional[str]=None, max_bytes:Optional[int]=None, size:Optional[Tuple[int, int]]=None, workers:Optional[int]=None,
+                 url_limit:Optional[int]=None):
+        self.directory = thumbnail_dir if directory is None else directory
+        self.max_bytes = max_cache_bytes if max_bytes is None else max_bytes
+        self.url_limit = max_urls if url_limit is None else url_limit
+        self.size = thumbnail_size if size is None else size
+        self._pool = ThreadPoolExecutor(max_workers=max(1, thumbnail_workers if workers is None else workers), thread_name_prefix="civitai-thumbnail")
+        self._lru:"OrderedDict[str, int]" = OrderedDict() # key -> bytes on disk
+        self._bytes = 0
+        self._urls:"OrderedDict[str, str]" = OrderedDict() # key -> image url, least recently requested first
+        self._pending:Dict[str, Future] = {}
+        self._failed:Set[str] = set() # not retried until requested again
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._load()
+
+    def _load(self):
+        # thumbnails from earlier runs, oldest access first
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith((".jpeg", ".png")):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, os.path.splitext(entry.name)[0], stat.st_size))
+            elif entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+        for _, key, size in sorted(entries):
+            self._lru[key] = size
+            self._bytes += size
+        self._evict()
+
+    def path(self, key:str) -> Optional[str]:
+        """
+        File of a cached thumbnail, marked as used. None if it is not cached
+        """
+        with self._lock:
+            if key not in self._lru:
+                return None
+            self._lru.move_to_end(key)
+        for ext in ("jpeg", "png"):
+            path = os.path.join(self.directory, f"{key}.{ext}")
+            if os.path.exists(path):
+                try:
+                    os.utime(path) # keeps the order across restarts
+                except OSError:
+                    pass
+                return path
+        with self._lock:
+            self._bytes -= self._lru.pop(key, 0)
+        return None
+
+    def request(self, url:str) -> str:
+        """
+        Make sure a thumbnail of url is cached or being made. Returns its key
+        """
+        key = thumbnail_key(url)
+        with self._lock:
+            self._urls[key] = url
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.url_limit:
+                # a forgotten key is only served while its thumbnail is still on disk
+                forgotten, _ = self._urls.popitem(last=False)
+                self._failed.discard(forgotten)
+            self._failed.discard(key)
+            if key in self._lru:
+                self.hits += 1
+                return key
+            if key not in self._pending:
+                self.misses += 1
+                self._pending[key] = self._pool.submit(self._make, key, url)
+        return key
+
+    def future(self, key:str) -> Optional[Future]:
+        """
+        The running job of a requested thumbnail, or a fresh one if it was evicted since.
+        None for unknown keys and thumbnails that failed
+        """
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            url = self._urls.get(key)
+            if url is None or key in self._failed:
+                return None
+        self.request(url)
+        with self._lock:
+            return self._pending.get(key)
+
+    def original(self, key:str) -> Optional[str]:
+        with self._lock:
+            return self._urls.get(key)
+
+    def _make(self, key:str, url:str) -> Optional[str]:
+        try:
+            data = retry.get(get_session(), url).content
+            scaled = shrink_image(data, self.size)
+            if scaled is None:
+                # already small, keep as is if it is an image at all
+                try:
+                    with Image.open(io.BytesIO(data)) as image:
+                        ext = "png" if image.format == "PNG" else "jpeg"
+                        if image.format not in ("PNG", "JPEG"):
+                            out = io.BytesIO()
+                            image.convert("RGB").save(out, "JPEG", quality=jpeg_quality)
+                            data = out.getvalue()
+                except (OSError, ValueError) as e:
+                    print(f"Not an image: {url} ({e})")
+                    with self._lock:
+                        self._failed.add(key)
+                    return None
+            else:
+                data, ext = scaled
+            path = os.path.join(self.directory, f"{key}.{ext}")
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            with self._lock:
+                self._bytes += len(data) - self._lru.pop(key, 0)
+                self._lru[key] = len(data)
+            self._evict()
+            return path
+        except Exception as e:
+            print(f"Thumbnail of {url} failed: {e}")
+            with self._lock:
+                self._failed.add(key)
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._bytes <= self.max_bytes or len(self._lru) <= 1:
+                    return
+                key, size = self._lru.popitem(last=False)
+                self._bytes -= size
+                self.evicted += 1
+            for ext in ("jpeg", "png"):
+                try:
+                    os.remove(os.path.join(self.directory, f"{key}.{ext}"))
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._lru), "bytes": self._bytes, "pending": len(self._pending),
+                    "hits": self.hits, "misses": self.misses, "evicted": self.evicted}
+
+_cache:Optional[ThumbnailCache] = None
+_cache_lock = threading.Lock()
+
+def get_thumbnail_cache() -> ThumbnailCache:
+    """
+    Returns the process-wide thumbnail cache, built from the module settings on first use
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ThumbnailCache()
+        return _cache
+
+def thumbnail_url(url:str) -> str:
+    """
+    Local URL of the thumbnail of an image URL. The thumbnail is started in the background
+    """
+    return f"{route_prefix}/{get_thumbnail_cache().request(url)}"
@@ -1,6 +1,7 @@
 import gradio as gr
 from modules import script_callbacks
 from scripts.functions import *
+from scripts.install import install_selected_model
 
 def on_ui_tabs_called():
     with gr.Blocks(analytics_enabled=False) as civitai_interface:
@@ -8,7 +9,7 @@ def on_ui_tabs_called():
             with gr.TabItem("CivitAi-Browser"):
                 with gr.Row():
                     with gr.Column(scale=2):
-                        content_type = gr.Radio(label='Content type:', choices=["Checkpoint","Hypernetwork","TextualInversion","AestheticGradient", "VAE", "LORA", "LoCon"], value="Checkpoint", type="value")
+                        content_type = gr.Radio(label='Content type:', choices=content_types(), value="Checkpoint", type="value")
                     with gr.Column(scale=2):
                         sort_type = gr.Radio(label='Sort List by:', choices=["Newest","Most Downloaded","Highest Rated","Most Liked"], value="Newest", type="value")
                     with gr.Column(scale=1):
@@ -16,9 +17,12 @@ def on_ui_tabs_called():
                 with gr.Row():
                     use_search_term = gr.Checkbox(label="Search by term?", value=True)
                     search_term = gr.Textbox(label="Search Term", interactive=True, lines=1)
+                    local_first = gr.Checkbox(label="Search local index first", value=False)
                 with gr.Row():
                     get_list_from_api = gr.Button(label="Get List", value="Get List")
                     get_next_page = gr.Button(value="Next Page")
+                    get_all_pages = gr.Button(value="Search All Pages")
+                    max_items = gr.Number(label="Max models (all pages)", value=1000, precision=0)
                 with gr.Row():
                     list_models = gr.Dropdown(label="Model", choices=[], interactive=True, elem_id="quicksettings", value=None)
                     list_versions = gr.Dropdown(label="Version", choices=[], interactive=True, elem_id="quicksettings", value=None)
@@ -33,8 +37,13 @@ def on_ui_tabs_called():
                     save_images = gr.Button(value="3rd - Save Images")
                     download_model = gr.Button(value="4th - Download Model")
                     save_model_in_new = gr.Checkbox(label="Save Model to new folder", value=False)
+                with gr.Row():
+                    install_model = gr.Button(value="Install Model (all of the above)")
+                    install_status = gr.HTML()
                 with gr.Row(elem_id="html_row"):
                     preview_image_html = gr.HTML()
+                # id of this tab's browse state, see scripts/sessions.py
+                browse_session = gr.State(None)
                 save_text.click(
                     fn=save_text_file,
                     inputs=[
@@ -52,21 +61,41 @@ def on_ui_tabs_called():
                     preview_image_html,
                     model_filename,
                     list_models,
-                    content_type
+                    content_type,
+                    save_model_in_new,
+                    list_versions,
+                    browse_session,
                     ],
                     outputs=[]
                 )
                 download_model.click(
-                    fn=download_file_thread,
+                    fn=download_selected_model,
                     inputs=[
                     dl_url,
                     model_filename,
                     content_type,
                     save_model_in_new,
                     list_models,
+                    list_versions,
+                    browse_session,
                     ],
                     outputs=[]
                 )
+                install_model.click(
+                    fn=install_selected_model,
+                    inputs=[
+                    list_models,
+                    list_versions,
+                    model_filename,
+                    content_type,
+                    save_model_in_new,
+                    show_nsfw,
+                    browse_session,
+                    ],
+                    outputs=[
+                    install_status,
+                    ]
+                )
                 get_list_from_api.click(
                     fn=update_model_list,
                     inputs=[
@@ -75,10 +104,30 @@ def on_ui_tabs_called():
                     use_search_term,
                     search_term,
                     show_nsfw,
+                    local_first,
+                    browse_session,
                     ],
                     outputs=[
                     list_models,
                     list_versions,
+                    browse_session,
+                    ]
+                )
+                get_all_pages.click(
+                    fn=stream_model_list,
+                    inputs=[
+                    content_type,
+                    sort_type,
+                    use_search_term,
+                    search_term,
+                    show_nsfw,
+                    max_items,
+                    browse_session,
+                    ],
+                    outputs=[
+                    list_models,
+                    list_versions,
+                    browse_session,
                     ]
                 )
                 update_info.click(
@@ -88,7 +137,8 @@ def on_ui_tabs_called():
                     list_models,
                     list_versions,
                     model_filename,
-                    dl_url
+                    dl_url,
+                    browse_session,
                     ],
                     outputs=[
                     preview_image_html,
@@ -103,6 +153,7 @@ def on_ui_tabs_called():
                     fn=update_model_versions,
                     inputs=[
                     list_models,
+                    browse_session,
                     ],
                     outputs=[
                     list_versions,
@@ -114,6 +165,7 @@ def on_ui_tabs_called():
                     inputs=[
                     list_models,
                     list_versions,
+                    browse_session,
                     ],
                     outputs=[
                     preview_image_html,
@@ -123,17 +175,19 @@ def on_ui_tabs_called():
                 )
                 model_filename.change(
                     fn=update_dl_url,
-                    inputs=[list_models, list_versions, model_filename,],
+                    inputs=[list_models, list_versions, model_filename, browse_session,],
                     outputs=[dl_url,]
                 )
                 get_next_page.click(
                     fn=update_next_page,
                     inputs=[
                     show_nsfw,
+                    browse_session,
                     ],
                     outputs=[
                     list_models,
                     list_versions,
+                    browse_session,
                     ]
                 )
             with gr.TabItem("Manual-CivitAi-Download"):
@@ -142,7 +196,7 @@ def on_ui_tabs_called():
                     input_url_textbox = gr.Textbox(label="URL", interactive=True, lines=1)
                     input_filename_textbox = gr.Textbox(label="File Name", interactive=True, lines=1)
                     content_type_dropdown = gr.Dropdown(label="Content Type",
-                                                        choices=["Checkpoint","Hypernetwork","TextualInversion","AestheticGradient", "VAE", "LORA", "LoCon"],
+                                                        choices=content_types(),
                                                         interactive=True, value="Checkpoint")
                     use_new_folder_checkbox = gr.Checkbox(label="Save to new folder", value=False)
                     input_foldername_textbox = gr.Textbox(label="Folder Name(Optional)", interactive=True, lines=1) # can be empty
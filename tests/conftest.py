@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, "benchmarks")]
+
+import fixture_server
+from scripts import retry
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    # backoff is random up to base_delay * 2 ** n, keep it short
+    monkeypatch.setattr(retry, "base_delay", 0.01)
+
+@pytest.fixture
+def make_server():
+    """
+    Start a FixtureServer over synthetic items, stopped when the test ends
+    """
+    servers = []
+    def make(count=3, **kwargs):
+        server = fixture_server.FixtureServer(fixture_server.synthetic_items(count), **kwargs).start()
+        servers.append(server)
+        return server
+    yield make
+    for server in servers:
+        server.stop()
+
+@pytest.fixture
+def extension(monkeypatch, tmp_path):
+    """
+    scripts.functions with models, hash cache, API cache and search index under tmp_path and a scheduler of its own.
+    Needs gradio
+    """
+    pytest.importorskip("gradio")
+    from scripts import api_cache, download_queue, functions, inventory, routing, search_index
+    monkeypatch.setattr(download_queue, "_scheduler", None)
+    monkeypatch.setattr(routing, "models_root", str(tmp_path))
+    monkeypatch.setattr(routing, "_router", None)
+    monkeypatch.setattr(inventory, "hash_cache_path", str(tmp_path / "hash_cache.json"))
+    monkeypatch.setattr(inventory, "_inventory", None)
+    monkeypatch.setattr(api_cache, "_cache", None)
+    monkeypatch.setattr(api_cache, "disk_cache_path", str(tmp_path / "api_cache.sqlite3"))
+    monkeypatch.setattr(search_index, "_index", None)
+    monkeypatch.setattr(search_index, "index_path", str(tmp_path / "search_index.sqlite3"))
+    return functions
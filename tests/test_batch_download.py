@@ -0,0 +1,95 @@
+"""
+POST /download/batch validation (all or nothing) and file / model name sanitization, downloading from the fixture server
+"""
+import hashlib
+import os
+
+import pytest
+
+from fixture_server import file_sha256
+from scripts.download_queue import DONE
+
+file_size = 256 * 1024
+
+@pytest.fixture
+def api(extension):
+    pytest.importorskip("fastapi")
+    from scripts import api
+    return api
+
+def sha256_of(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest().upper()
+
+def job_request(api, server, index, **fields):
+    file = server.items[index]["modelVersions"][0]["files"][0]
+    return api.DownloadJobRequest(**dict({"url": file["downloadUrl"], "file_name": file["name"], "content_type": "LORA",
+                                          "model_name": server.items[index]["name"], "size_bytes": file_size}, **fields))
+
+def test_sanitizes_file_name(api):
+    url, file_name, _, _, model_name = api.assert_download_conditions("http://example.invalid/1", "../../evil:model?.safetensors", "LORA", False)
+    assert os.sep not in file_name and "/" not in file_name
+    assert file_name == "....evil-model.safetensors"
+    assert model_name == "....evil-model"
+
+@pytest.mark.parametrize("file_name, model_name, message", [
+    ("..", None, "Invalid file name"),
+    ("/", None, "Invalid file name"),
+    ("model.safetensors", "..", "Invalid model name"),
+    ("model.safetensors", "?*", "Invalid model name"),
+])
+def test_rejects_names_outside_the_folder(api, file_name, model_name, message):
+    result = api.assert_download_conditions("http://example.invalid/1", file_name, "LORA", False, model_name)
+    assert isinstance(result, api.DownloadRequestResponse)
+    assert not result.success and result.message == message
+
+def test_batch_downloads_every_job(api, make_server, extension):
+    server = make_server(count=3, file_size=file_size)
+    response = api.enqueue_download_batch(api.BatchDownloadRequest(jobs=[job_request(api, server, i) for i in range(3)]))
+    assert response.success and response.job_count == 3 and response.total_bytes == 3 * file_size
+    scheduler = extension.get_scheduler()
+    for index, job_id in enumerate(response.job_ids):
+        job = scheduler.get(job_id)
+        assert job.join(30) and job.state == DONE, job.error
+        assert sha256_of(job.file_name) == file_sha256(f"{server.items[index]['modelVersions'][0]['id']}/0", file_size)
+    assert scheduler.batches[response.batch_id].summary()["finished"]
+
+def test_batch_with_an_invalid_job_queues_nothing(api, make_server, extension):
+    server = make_server(count=3, file_size=file_size)
+    jobs = [job_request(api, server, 0), job_request(api, server, 1, content_type="Nope"), job_request(api, server, 2, file_name="..")]
+    response = api.enqueue_download_batch(api.BatchDownloadRequest(jobs=jobs))
+    assert not response.success
+    assert [error.split(":")[0] for error in response.errors] == ["job 1", "job 2"]
+    assert extension.get_scheduler().jobs() == []
+
+def test_batch_rejects_duplicate_destinations(api, make_server, extension):
+    server = make_server(count=2, file_size=file_size)
+    # the names only differ in characters that are dropped from paths
+    jobs = [job_request(api, server, 0), job_request(api, server, 1, file_name=server.items[0]["modelVersions"][0]["files"][0]["name"],
+                                                     model_name=server.items[0]["name"] + "?")]
+    response = api.enqueue_download_batch(api.BatchDownloadRequest(jobs=jobs))
+    assert not response.success
+    assert response.errors == ["job 1: same destination as job 0"]
+    assert extension.get_scheduler().jobs() == []
+
+def test_batch_rolls_back_when_queueing_fails(api, make_server, extension, monkeypatch):
+    server = make_server(count=3, file_size=file_size)
+    scheduler = extension.get_scheduler()
+    # already queued before the batch, must survive its rollback
+    earlier = extension.download_file_thread(server.items[0]["modelVersions"][0]["files"][0]["downloadUrl"],
+                                             server.items[0]["modelVersions"][0]["files"][0]["name"], "LORA", False, server.items[0]["name"])
+    router = extension.get_router()
+    prepare = router.prepare
+    def fail_last(content_type, model_name, use_new_folder=False):
+        if model_name == extension.replace_invalid_chars(server.items[2]["name"]):
+            raise OSError("disk full")
+        return prepare(content_type, model_name, use_new_folder)
+    monkeypatch.setattr(router, "prepare", fail_last)
+    with pytest.raises(OSError):
+        api.enqueue_download_batch(api.BatchDownloadRequest(jobs=[job_request(api, server, i) for i in range(3)]))
+    queued = {job.id: job for job in scheduler.jobs()}
+    batch_jobs = [job for job in queued.values() if job is not earlier]
+    assert batch_jobs and all(job.cancel_event.is_set() for job in batch_jobs)
+    assert not earlier.cancel_event.is_set()
+    assert earlier.join(30) and earlier.state == DONE
+    assert scheduler.batches == {}
@@ -0,0 +1,138 @@
+"""
+DownloadScheduler: claiming jobs, cancelling them and cancels that arrive too late
+"""
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from fixture_server import Faults, file_sha256
+from scripts import downloader
+from scripts.download_queue import CANCELLED, DONE, DownloadCancelled, DownloadScheduler
+from scripts.http_client import get_session
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def sha256_of(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest().upper()
+
+def test_cancel_races_claim():
+    calls = []
+    def target(url, file_name, cancel_event, sha256, progress):
+        calls.append(file_name)
+        if cancel_event.is_set():
+            raise DownloadCancelled("cancelled")
+    scheduler = DownloadScheduler(target, workers=4)
+    finishes = {}
+    jobs = []
+    for i in range(300):
+        job = scheduler.submit(f"http://example.invalid/{i}", f"file_{i}")
+        job.add_done_callback(lambda job: finishes.__setitem__(job.id, finishes.get(job.id, 0) + 1))
+        scheduler.cancel(job.id)
+        jobs.append(job)
+    for job in jobs:
+        assert job.join(10)
+    assert all(finishes[job.id] == 1 for job in jobs)
+    # a job the cancel caught while queued never reaches the target
+    started = set(calls)
+    assert all(job.state == CANCELLED for job in jobs if job.file_name not in started)
+    assert not scheduler.cancel(jobs[0].id)
+
+def test_cancel_after_finish_is_reported_too_late():
+    release = threading.Event()
+    def target(url, file_name, cancel_event, sha256, progress):
+        # already past the point where the download could be stopped
+        release.wait(10)
+    scheduler = DownloadScheduler(target, workers=1)
+    job = scheduler.submit("http://example.invalid/model", "model.safetensors")
+    wait_until(lambda: job.started is not None)
+    assert scheduler.cancel(job.id)
+    release.set()
+    assert job.join(10)
+    assert job.state == DONE
+    assert "too late" in job.message
+
+@pytest.fixture
+def cancel_in_last_block(monkeypatch):
+    """
+    copy_stream returns only once the job has been cancelled, as if the cancel arrived while its last block was read
+    """
+    copy_stream = downloader.copy_stream
+    copied = threading.Event()
+    def copy_then_wait(response, f, limit=None, stopped=None, *args, **kwargs):
+        written = copy_stream(response, f, limit, stopped, *args, **kwargs)
+        copied.set()
+        wait_until(stopped)
+        return written
+    monkeypatch.setattr(downloader, "copy_stream", copy_then_wait)
+    return copied
+
+def stream_target(url, file_name, cancel_event, sha256, progress):
+    """
+    A single-stream download like functions.download_file, without the webui parts
+    """
+    stopped = cancel_event.is_set
+    journal = downloader.ResumeJournal(file_name, url)
+    with get_session().get(url, stream=True) as response, open(downloader.part_path(file_name), "wb", buffering=0) as f:
+        downloader.copy_stream(response, f, stopped=stopped, on_progress=progress.add)
+    downloader.finalize(journal, stopped)
+
+def cancel_once_copied(scheduler, job, copied):
+    assert copied.wait(10)
+    assert scheduler.cancel(job.id)
+    assert job.join(10)
+
+def test_cancel_during_last_block(make_server, cancel_in_last_block, tmp_path):
+    server = make_server(file_size=1024 * 1024)
+    url = server.items[0]["modelVersions"][0]["files"][0]["downloadUrl"]
+    scheduler = DownloadScheduler(stream_target, workers=1)
+    dest = str(tmp_path / "model.safetensors")
+    job = scheduler.submit(url, dest)
+    cancel_once_copied(scheduler, job, cancel_in_last_block)
+    assert job.state == CANCELLED, (job.state, job.error)
+    assert not os.path.exists(dest)
+
+def test_download_file_cancel_during_last_block(make_server, cancel_in_last_block, extension, tmp_path):
+    server = make_server(file_size=1024 * 1024)
+    url = server.items[0]["modelVersions"][0]["files"][0]["downloadUrl"]
+    scheduler = DownloadScheduler(extension.download_file, workers=1)
+    dest = str(tmp_path / "model.safetensors")
+    job = scheduler.submit(url, dest)
+    cancel_once_copied(scheduler, job, cancel_in_last_block)
+    assert job.state == CANCELLED, (job.state, job.error)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(downloader.part_path(dest))
+
+def test_cancel_while_claiming_fixture_downloads(make_server, extension, tmp_path):
+    # slow enough that some jobs are cancelled while queued, some while running and some finish first
+    server = make_server(count=12, file_size=256 * 1024, faults=Faults(bandwidth=4 * 1024 * 1024))
+    scheduler = extension.get_scheduler()
+    scheduler.set_workers(3)
+    finishes = {}
+    jobs = []
+    for index, item in enumerate(server.items):
+        job = extension.download_file_thread(item["modelVersions"][0]["files"][0]["downloadUrl"], f"model_{index}.safetensors", "LORA", False, f"model {index}")
+        job.add_done_callback(lambda job: finishes.__setitem__(job.id, finishes.get(job.id, 0) + 1))
+        jobs.append(job)
+    for job in jobs[::2]:
+        scheduler.cancel(job.id)
+        time.sleep(0.03)
+    for job in jobs:
+        assert job.join(30)
+    assert all(finishes[job.id] == 1 for job in jobs)
+    for index, job in enumerate(jobs):
+        key = f"{server.items[index]['modelVersions'][0]['id']}/0"
+        if job.state == CANCELLED:
+            assert not os.path.exists(job.file_name) and not os.path.exists(downloader.part_path(job.file_name))
+        else:
+            assert job.state == DONE, job.error
+            assert sha256_of(job.file_name) == file_sha256(key, 256 * 1024)
+    assert all(job.state == DONE for job in jobs[1::2])
+    assert any(job.state == CANCELLED for job in jobs[::2])
@@ -0,0 +1,182 @@
+"""
+Downloads and API requests against benchmarks/fixture_server.py running in-process
+"""
+import hashlib
+import os
+
+import pytest
+from requests.exceptions import ChunkedEncodingError, ReadTimeout
+
+from fixture_server import Faults, file_sha256
+from scripts import downloader, records, retry
+from scripts.http_client import get_session
+
+file_size = 3 * 1024 * 1024
+
+def download_url(server, index=0):
+    return server.items[index]["modelVersions"][0]["files"][0]["downloadUrl"]
+
+def file_key(server, index=0):
+    return f"{server.items[index]['modelVersions'][0]['id']}/0"
+
+def sha256_of(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest().upper()
+
+def new_journal(probe, dest):
+    segments = [[start, end, start] for start, end in downloader.split_ranges(probe.total_size, downloader.segment_count)]
+    return downloader.ResumeJournal(dest, probe.url, probe.total_size, probe.etag, "segmented", segments)
+
+class Progress:
+    """
+    Counts the bytes written, in place of a tqdm bar
+    """
+    def __init__(self):
+        self.n = 0
+
+    def update(self, n):
+        self.n += n
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(downloader, "min_segment_size", 512 * 1024)
+
+def test_probe_follows_redirect(make_server):
+    server = make_server(file_size=file_size)
+    probe = downloader.probe(download_url(server))
+    assert probe.total_size == file_size
+    assert probe.accepts_ranges
+    assert "/files/" in probe.url
+
+def test_segmented_download(make_server, small_segments, tmp_path):
+    server = make_server(file_size=file_size)
+    probe = downloader.probe(download_url(server))
+    assert downloader.should_segment(probe.total_size, probe.accepts_ranges)
+    journal = new_journal(probe, str(tmp_path / "model.safetensors"))
+    downloader.segmented_download(probe.url, journal)
+    downloader.finalize(journal)
+    assert sha256_of(journal.dest) == file_sha256(file_key(server), file_size)
+    assert server.stats["ranges"] >= downloader.segment_count
+    assert not os.path.exists(downloader.journal_path(journal.dest))
+
+def test_segmented_download_resumes_after_fault(make_server, small_segments, monkeypatch, tmp_path):
+    server = make_server(file_size=file_size, faults=Faults(drop_rate=1.0), seed=1)
+    monkeypatch.setattr(downloader, "segment_retries", 1)
+    # small reads, so every dropped segment leaves some recorded progress behind
+    monkeypatch.setattr(downloader, "buffer_size", 64 * 1024)
+    dest = str(tmp_path / "model.safetensors")
+    probe = downloader.probe(download_url(server))
+    with pytest.raises(retry.ConnectionError):
+        downloader.segmented_download(probe.url, new_journal(probe, dest))
+
+    journal = downloader.ResumeJournal.load(dest)
+    assert journal is not None and journal.matches(probe.url, probe.total_size, probe.etag, "segmented")
+    resumed_from = journal.downloaded
+    assert 0 < resumed_from < file_size
+    server.faults.update({"drop_rate": 0.0})
+    progress = Progress()
+    downloader.segmented_download(probe.url, journal, progress=progress)
+    downloader.finalize(journal)
+    # only the missing ranges are fetched again
+    assert progress.n == file_size - resumed_from
+    assert sha256_of(dest) == file_sha256(file_key(server), file_size)
+
+def test_retries_failed_requests(make_server):
+    server = make_server(count=20, page_size=2, faults=Faults(fail_rate=0.3, retry_after=0), seed=2)
+    url = f"{server.api_base}/models?limit=2"
+    ids = []
+    while url:
+        page = retry.get(get_session(), url, read=lambda response: response.json())
+        ids += [item["id"] for item in page["items"]]
+        url = page["metadata"].get("nextPage")
+    assert ids == [item["id"] for item in server.items]
+    assert server.stats["failed"] > 0
+
+def test_gives_up_on_permanent_errors(make_server):
+    server = make_server(faults=Faults(fail_rate=1.0, fail_status=404))
+    with pytest.raises(retry.HttpStatusError) as error:
+        retry.get(get_session(), f"{server.api_base}/models")
+    assert error.value.status == 404
+    assert server.stats["requests"] == 1
+
+@pytest.fixture
+def civit_api(make_server, extension):
+    """
+    scripts.functions pointed at a fixture server
+    """
+    server = make_server(count=8, page_size=4)
+    api_root = extension.api_root
+    extension.set_api_root(server.api_base)
+    yield server, extension
+    extension.set_api_root(api_root)
+
+def test_api_cache_hit(civit_api):
+    server, functions = civit_api
+    url = f"{server.api_base}/models?limit=4"
+    page = functions.request_civit_api(url)
+    assert [item["id"] for item in page["items"]] == [item["id"] for item in server.items[:4]]
+    requests = server.stats["requests"]
+    assert functions.request_civit_api(url) is page
+    assert server.stats["requests"] == requests
+    stats = functions.get_api_cache().stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+def test_api_cache_reads_disk_copy(civit_api):
+    server, functions = civit_api
+    from scripts import api_cache
+    url = f"{server.api_base}/models?limit=4"
+    page = functions.request_civit_api(url)
+    # a new process starts with an empty memory cache
+    api_cache._cache = None
+    requests = server.stats["requests"]
+    cached = functions.request_civit_api(url)
+    assert server.stats["requests"] == requests
+    assert [item.to_dict() for item in cached["items"]] == [item.to_dict() for item in page["items"]]
+    assert isinstance(cached["items"][0], records.ModelRecord)
+    assert functions.get_api_cache().stats()["disk_hits"] == 1
+
+def test_api_cache_revalidates_expired_entry(civit_api):
+    server, functions = civit_api
+    url = f"{server.api_base}/models?limit=4"
+    page = functions.request_civit_api(url)
+    functions.get_api_cache().ttl = 0
+    assert functions.request_civit_api(url) is page
+    assert server.stats["not_modified"] == 1
+    stats = functions.get_api_cache().stats()
+    assert (stats["hits"], stats["misses"], stats["revalidated"]) == (0, 2, 1)
+
+@pytest.mark.parametrize("error", [ReadTimeout("read timed out"), ChunkedEncodingError("connection broken")])
+def test_segmented_download_keeps_journal_on_transient_errors(make_server, small_segments, extension, monkeypatch, tmp_path, error):
+    server = make_server(file_size=file_size)
+    dest = str(tmp_path / "model.safetensors")
+    def fail(url, journal, *args):
+        journal.save()
+        raise error
+    monkeypatch.setattr(downloader, "segmented_download", fail)
+    probe = downloader.probe(download_url(server))
+    with pytest.raises(type(error)):
+        extension.download_segmented(download_url(server), dest, probe)
+    assert downloader.ResumeJournal.load(dest) is not None
+
+def test_segmented_download_falls_back_when_ranges_are_ignored(make_server, small_segments, extension, monkeypatch, tmp_path):
+    server = make_server(file_size=file_size)
+    dest = str(tmp_path / "model.safetensors")
+    def fail(url, journal, *args):
+        journal.save()
+        raise downloader.RangeNotSupported("Server ignored range request (status 200)")
+    monkeypatch.setattr(downloader, "segmented_download", fail)
+    probe = downloader.probe(download_url(server))
+    assert extension.download_segmented(download_url(server), dest, probe) is None
+    assert downloader.ResumeJournal.load(dest) is None
+
+def test_stream_model_list_keeps_pages_before_a_failure(civit_api, monkeypatch):
+    server, functions = civit_api
+    monkeypatch.setattr(functions, "api_url", f"{server.api_base}/models?limit=4")
+    stream = functions.stream_model_list("", "Newest", False, "", True, max_items=100)
+    models, _, session_id = next(stream)
+    shown = models["choices"]
+    assert len(shown) == 4
+    server.faults.fail_rate, server.faults.fail_status = 1.0, 404
+    # the failed page ends the stream instead of raising into the UI
+    assert list(stream) == []
+    assert functions.find_browse_state(session_id).catalog.model_labels(True) == shown
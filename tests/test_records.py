@@ -0,0 +1,66 @@
+"""
+Incremental page parser: the result must not depend on where the body is split into chunks
+"""
+import json
+
+import pytest
+
+from scripts import records
+
+def chunked(body:bytes, size:int):
+    return [body[start:start + size] for start in range(0, len(body), size)]
+
+def listing(items, **metadata):
+    return json.dumps(dict({"items": items}, **metadata), ensure_ascii=False).encode("utf-8")
+
+items = [
+    {"id": 1234567, "name": "Ünïcödé 模型 🎨", "type": "LORA", "nsfw": False, "creator": {"username": "ßtudio"},
+     "tags": ["style", {"name": "動物"}], "description": "<p>Ça marche — 日本語</p>",
+     "modelVersions": [{"id": 98765432, "name": "v1.0", "baseModel": "SD 1.5", "trainedWords": ["ça"],
+                        "files": [{"id": 11, "name": "modèle.safetensors", "sizeKB": 144110.1234, "primary": True,
+                                   "downloadUrl": "https://example.invalid/11", "hashes": {"SHA256": "AB" * 32}}],
+                        "images": [{"url": "https://example.invalid/1.png", "nsfw": "None", "width": 512, "height": 768}]}]},
+    {"id": 7, "name": "plain", "type": "Checkpoint", "nsfw": True, "tags": [], "modelVersions": []},
+]
+body = listing(items, metadata={"totalItems": 1234567890, "currentPage": 12, "pageSize": 2.5,
+                                "nextPage": "https://example.invalid/?page=13"})
+expected = records.compact_page(json.loads(body))
+
+def plain(page):
+    return json.loads(json.dumps(page, default=records.to_json))
+
+@pytest.mark.parametrize("size", range(1, len(body) + 1))
+def test_every_chunk_size(size):
+    assert plain(records.parse_page(chunked(body, size))) == plain(expected)
+
+def test_multibyte_characters_split_across_chunks():
+    # one byte per chunk splits every multibyte character
+    page = records.parse_page(chunked(body, 1))
+    assert page["items"][0]["name"] == "Ünïcödé 模型 🎨"
+    assert page["items"][0]["tags"] == ["style", "動物"]
+    assert page["items"][0].description == "<p>Ça marche — 日本語</p>"
+
+@pytest.mark.parametrize("number", ["1234567890", "98765.4321", "-1.5e+10", "2E-3"])
+def test_numbers_split_across_chunks(number):
+    text = f'{{"items": [], "metadata": {{"totalItems": {number}}}, "count": {number}}}'.encode()
+    for start in (text.index(number.encode()), text.rindex(number.encode())):
+        for split in range(1, len(number)):
+            page = records.parse_page([text[:start + split], text[start + split:]])
+            assert page["metadata"]["totalItems"] == page["count"] == json.loads(number)
+
+@pytest.mark.parametrize("text", [b'{"items": []}', b'{"items": [], "metadata": {}}', b' { "items" : [ ] } ', b'{}'])
+def test_empty_items(text):
+    page = records.parse_page(chunked(text, 1))
+    assert page["items"] == []
+
+@pytest.mark.parametrize("end", [1, len(body) // 2, len(body) - 1])
+def test_truncated_body(end):
+    with pytest.raises(ValueError):
+        records.parse_page(chunked(body[:end], 7))
+
+def test_encoded_page_round_trip():
+    data, length = records.encode_page(expected)
+    assert length == len(json.dumps(expected, default=records.to_json).encode("utf-8"))
+    assert plain(records.loads_page(data)) == plain(expected)
+    # cache files written before pages were compressed hold plain JSON
+    assert plain(records.loads_page(body.decode("utf-8"))) == plain(expected)
@@ -0,0 +1,83 @@
+"""
+Single-stream downloads (files below the segmented size) resuming from a .part file and its journal
+"""
+import hashlib
+import os
+
+import pytest
+
+from fixture_server import file_chunks, file_sha256
+from scripts import downloader
+from scripts.http_client import get_session
+
+file_size = 2 * 1024 * 1024
+part_size = 1024 * 1024
+
+@pytest.fixture
+def stream(make_server, extension, tmp_path):
+    server = make_server(file_size=file_size)
+    version_id = server.items[0]["modelVersions"][0]["id"]
+    url = server.items[0]["modelVersions"][0]["files"][0]["downloadUrl"]
+    return server, extension, url, f"{version_id}/0", str(tmp_path / "model.safetensors")
+
+def write_part(dest, data, url, total_size, etag):
+    with open(downloader.part_path(dest), "wb") as f:
+        f.write(data)
+    downloader.ResumeJournal(dest, url, total_size, etag, "stream").save()
+
+def sha256_of(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest().upper()
+
+def file_etag(url):
+    with get_session().head(url, allow_redirects=True) as response:
+        return response.headers["ETag"]
+
+def probe_fails(monkeypatch):
+    def probe(url, stopped=None):
+        raise downloader.ConnectionError("probe failed")
+    monkeypatch.setattr(downloader, "probe", probe)
+
+def test_resumes_matching_part(stream):
+    server, functions, url, key, dest = stream
+    write_part(dest, b"".join(file_chunks(key, 0, part_size - 1)), url, file_size, file_etag(url))
+    sent = server.stats["bytes_sent"]
+    functions.download_file(url, dest, sha256=file_sha256(key, file_size))
+    assert sha256_of(dest) == file_sha256(key, file_size)
+    # the probe's single byte and the rest of the file
+    assert server.stats["bytes_sent"] - sent == 1 + file_size - part_size
+    assert not os.path.exists(downloader.part_path(dest))
+
+def test_discards_part_of_another_file(stream):
+    server, functions, url, key, dest = stream
+    write_part(dest, b"\0" * part_size, url, file_size, '"old"')
+    functions.download_file(url, dest)
+    assert sha256_of(dest) == file_sha256(key, file_size)
+
+def test_restarts_when_if_range_does_not_match(stream, monkeypatch):
+    server, functions, url, key, dest = stream
+    # without a probe the journal cannot be checked up front, If-Range makes the server send the whole new file
+    probe_fails(monkeypatch)
+    write_part(dest, b"\0" * part_size, url, file_size, '"old"')
+    functions.download_file(url, dest)
+    assert sha256_of(dest) == file_sha256(key, file_size)
+    assert downloader.ResumeJournal.load(dest) is None
+
+def test_restarts_when_size_changed(stream, monkeypatch):
+    server, functions, url, key, dest = stream
+    probe_fails(monkeypatch)
+    write_part(dest, b"\0" * part_size, url, file_size // 2 * 3, None)
+    functions.download_file(url, dest)
+    assert sha256_of(dest) == file_sha256(key, file_size)
+
+def test_part_larger_than_file_is_discarded(stream, monkeypatch):
+    server, functions, url, key, dest = stream
+    probe_fails(monkeypatch)
+    write_part(dest, b"\0" * (file_size + 10), url, 0, None)
+    with pytest.raises(IOError, match="changed on the server"):
+        functions.download_file(url, dest)
+    assert not os.path.exists(downloader.part_path(dest))
+    assert downloader.ResumeJournal.load(dest) is None
+    # the next attempt starts from scratch instead of failing the same way
+    functions.download_file(url, dest)
+    assert sha256_of(dest) == file_sha256(key, file_size)